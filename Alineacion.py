@@ -1,113 +1,167 @@
+import argparse
 from pathlib import Path
 
-import numpy as np
 import rasterio
-from rasterio.transform import from_bounds
-from rasterio.warp import reproject, Resampling
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling
+
+from bloques import HILOS, agrega_argumentos_bloques, procesa_bloques, ventanas_grilla
+from grilla import RegistroGrillas, diferencias_grilla, ruta_recorte
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+from perfiles import agrega_argumento_perfil, aplica_perfil
 
 REQUIERE_REPROJECT = {"CRS", "RES", "ORIGIN", "EXTENT", "DIMENSIONS"}
 NODATA = -9999
 
 raster_path = Path("./RASTER/modificados")
 raster_ref = raster_path.joinpath("recorte_wc2.1_30s_bio_1.tif")
-if not raster_ref.exists():
-    print("ERROR: Raster referencia no encontrado")
-
-rasters_to_validate = [r for r in raster_path.glob("recorte_*.tif") if r != raster_ref]
 raster_out_name = "_ali.tif"
-
-
-def valida_alineacion(r_path, r_ref, tol=1e-6):
-    problems = set()
-
-    with rasterio.open(r_path) as r1, rasterio.open(r_ref) as ref:
-        if r1.crs != ref.crs:
-            problems.add("CRS")
-
-        if not np.allclose(r1.res, ref.res, atol=tol):
-            problems.add("RES")
-
-        if not np.allclose(
-            (r1.transform.c, r1.transform.f),
-            (ref.transform.c, ref.transform.f),
-            atol=tol,
-        ):
-            problems.add("ORIGIN")
-
-        if not np.allclose(r1.bounds, ref.bounds, atol=tol):
-            problems.add("EXTENT")
-
-        if (r1.width != ref.width) or (r1.height != ref.height):
-            problems.add("DIMENSIONS")
-
-    return problems
-
-
-results = {}
-
-for raster in rasters_to_validate:
-    problems = valida_alineacion(raster, raster_ref)
-    if problems:
-        results[raster] = problems
-
-for raster_in, problems in results.items():
-    if not problems & REQUIERE_REPROJECT:
-        print(f"{raster_in.name}: no requiere reproyección")
-        continue
-
-    print(f"{raster_in.name}: corrigiendo {sorted(problems)}")
-
-    salida_raster = raster_in.with_name(raster_in.stem + "_ali.tif")
-
-    # Raster referencia
-    with rasterio.open(raster_ref) as ref:
-        ref_crs = ref.crs
-        ref_transform = ref.transform
-        ref_width = ref.width
-        ref_height = ref.height
-        ref_bounds = ref.bounds
-
-    # Raster origen
-    with rasterio.open(raster_in) as src:
-        src_data = src.read(1)
-
-        dst_transform = from_bounds(
-            ref_bounds.left,
-            ref_bounds.bottom,
-            ref_bounds.right,
-            ref_bounds.top,
-            ref_width,
-            ref_height,
+raster_out_vrt = "_ali.vrt"
+TAM_BLOQUE = 512
+
+
+def _warped_vrt(src, r_ref):
+    # Vista del raster origen reproyectada sobre la grilla de referencia (sin leerlo)
+    # La grilla de referencia sale del registro (sin abrir r_ref). Se usa su
+    # transform tal cual: recalcularlo con from_bounds introduce errores de
+    # redondeo en la resolucion y la grilla deja de ser identica
+    ref = RegistroGrillas().grilla(r_ref)
+    ref_crs = CRS.from_wkt(ref["crs"]) if ref["crs"] else None
+    ref_height, ref_width = ref["shape"]
+    dst_transform = Affine(*ref["transform"])
+
+    return WarpedVRT(
+        src,
+        crs=ref_crs,
+        transform=dst_transform,
+        width=ref_width,
+        height=ref_height,
+        resampling=Resampling.bilinear,
+        src_nodata=src.nodata,
+        nodata=NODATA,
+        dtype="float32",
+    )
+
+
+def alineacion_virtual(raster_in, r_ref, salida=None):
+    # Guarda la reproyección como VRT: las etapas siguientes la leen como un raster
+    # más, sin materializar el _ali.tif
+    salida = salida or raster_in.with_name(raster_in.stem + raster_out_vrt)
+
+    with rasterio.open(raster_in) as src, _warped_vrt(src, r_ref) as vrt:
+        rasterio.shutil.copy(vrt, salida, driver="VRT")
+
+    return salida
+
+
+def corrige_alineacion(raster_in, r_ref, hilos=HILOS, perfil="nativo"):
+    salida_raster = raster_in.with_name(raster_in.stem + raster_out_name)
+
+    # El warp se hace ventana a ventana leyendo el VRT: la memoria no depende
+    # del tamaño de la grilla de referencia
+    vrt_path = alineacion_virtual(
+        raster_in, r_ref, raster_in.with_name(raster_in.stem + "_ali_tmp.vrt")
+    )
+
+    try:
+        with rasterio.open(vrt_path) as vrt:
+            profile = {
+                "driver": "GTiff",
+                "height": vrt.height,
+                "width": vrt.width,
+                "count": 1,
+                "dtype": "float32",
+                "crs": vrt.crs,
+                "transform": vrt.transform,
+                "nodata": NODATA,
+                "compress": "lzw",
+                "tiled": True,
+                "blockxsize": TAM_BLOQUE,
+                "blockysize": TAM_BLOQUE,
+            }
+            profile = aplica_perfil(profile, perfil)
+
+        procesa_bloques(
+            {"ali": (vrt_path, 1)},
+            lambda window, datos: {"ali": datos["ali"]},
+            salidas={"ali": (salida_raster, profile)},
+            ventanas=ventanas_grilla(profile["height"], profile["width"], TAM_BLOQUE),
+            hilos=hilos,
         )
-
-        dst_data = np.full((ref_height, ref_width), NODATA, dtype=np.float32)
-
-        reproject(
-            source=src_data,
-            destination=dst_data,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=dst_transform,
-            dst_crs=ref_crs,
-            resampling=Resampling.bilinear,
-            src_nodata=src.nodata,
-            dst_nodata=NODATA,
-        )
-
-    profile = {
-        "driver": "GTiff",
-        "height": ref_height,
-        "width": ref_width,
-        "count": 1,
-        "dtype": "float32",
-        "crs": ref_crs,
-        "transform": dst_transform,
-        "nodata": NODATA,
-        "compress": "lzw",
-        "tiled": True,
+    finally:
+        vrt_path.unlink(missing_ok=True)
+
+    return salida_raster
+
+
+@instrumenta("alineacion")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Valida y corrige la alineacion de los rasters recortados"
+    )
+    agrega_argumento_workers(parser)
+    agrega_argumentos_bloques(parser)
+    agrega_argumento_perfil(parser)
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="genera _ali.vrt (alineación virtual) en lugar de materializar _ali.tif",
+    )
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    # Los recortes pueden ser GeoTIFF o mosaicos VRT (recorte.py --mosaico)
+    ref = ruta_recorte(raster_ref)
+    if not ref.exists():
+        print("ERROR: Raster referencia no encontrado")
+        return
+
+    recortes = {
+        ruta_recorte(r.with_suffix(".tif"))
+        for r in [*raster_path.glob("recorte_*.tif"), *raster_path.glob("recorte_*.vrt")]
+        if not r.stem.endswith(("_ali", "_ali_tmp"))
     }
-
-    with rasterio.open(salida_raster, "w", **profile) as dst:
-        dst.write(dst_data, 1)
-
-    print(f"Guardado: {salida_raster.name}")
+    rasters_to_validate = sorted(recortes - {ref})
+
+    # Los rasters se agrupan por firma de grilla: un grupo con la firma de la
+    # referencia ya esta alineado y el resto pasa directo a la correccion
+    registro = RegistroGrillas()
+    grilla_ref = registro.grilla(ref)
+    grupos = registro.agrupa(rasters_to_validate)
+
+    a_corregir = {}
+    for firma, rasters in grupos.items():
+        for raster_in in rasters:
+            problems = set() if firma == grilla_ref["firma"] else diferencias_grilla(
+                registro.grilla(raster_in), grilla_ref
+            )
+            if not problems & REQUIERE_REPROJECT:
+                print(f"{raster_in.name}: no requiere reproyección")
+                continue
+
+            print(f"{raster_in.name}: corrigiendo {sorted(problems)}")
+            if args.virtual:
+                a_corregir[raster_in] = (raster_in, ref)
+            else:
+                a_corregir[raster_in] = (raster_in, ref, args.hilos, args.perfil)
+
+    funcion = alineacion_virtual if args.virtual else corrige_alineacion
+    correcciones = ejecuta_tareas(funcion, a_corregir, workers=args.workers)
+
+    for raster_in, resultado in correcciones.items():
+        if resultado.ok:
+            # La salida queda sobre la grilla de la referencia
+            registro.registra(resultado.valor, grilla_ref)
+            print(f"Guardado: {resultado.valor.name}")
+        else:
+            print(f"{raster_in.name}: ERROR al corregir: {resultado.error}")
+    registro.guarda()
+    return correcciones
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,191 @@
+import argparse
 from pathlib import Path
 
+import numpy as np
 import rasterio
 
-future_raster_path = Path(
-    "./RASTER/originales/wc2.1_30s_bioc_IPSL-CM6A-LR_ssp585_2021-2040.tif"
+from bloques import (
+    COLA_ESCRITURA,
+    HILOS,
+    MULTIPLO_BLOQUE,
+    PROFUNDIDAD,
+    agrega_argumentos_anticipacion,
+    agrega_argumentos_bloques,
+    procesa_bloques,
 )
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+
+ORIGINALES_DIR = Path("./RASTER/originales/")
+GCM = "IPSL-CM6A-LR"
+SSP = "ssp585"
+PERIODO = "2021-2040"
+
+
+def ruta_futuro(gcm=GCM, ssp=SSP, periodo=PERIODO):
+    return ORIGINALES_DIR.joinpath(f"wc2.1_30s_bioc_{gcm}_{ssp}_{periodo}.tif")
+
+
+future_raster_path = ruta_futuro()
 bandas = [1, 5, 14, 15]
 
-for banda in bandas:
-    salida = Path(f"./RASTER/originales/bio_{banda}_fut.tif")
-    if not future_raster_path.exists():
-        print("ERROR: raster no encontrado")
+
+def ruta_banda(banda):
+    return ORIGINALES_DIR.joinpath(f"bio_{banda}_fut.tif")
+
+
+def perfil_salida(profile, compress="lzw", tiled=True, tam_bloque=512, predictor=None):
+    # Perfil de una banda individual: compresión, tiles y predictor configurables.
+    # predictor=None elige 3 (punto flotante) o 2 (enteros) según el tipo de dato.
+    profile = profile.copy()
+    profile.update(count=1, compress=compress, tiled=tiled)
+    # El orden de bandas no aplica a una salida de una sola banda
+    profile.pop("interleave", None)
+    if tiled:
+        profile.update(blockxsize=tam_bloque, blockysize=tam_bloque)
+    else:
+        profile.pop("blockxsize", None)
+        profile.pop("blockysize", None)
+    if compress is None or compress == "none":
+        profile.pop("compress")
+        profile.pop("predictor", None)
     else:
-        with rasterio.open(future_raster_path) as src:
+        if predictor is None:
+            predictor = 3 if np.issubdtype(np.dtype(profile["dtype"]), np.floating) else 2
+        profile.update(predictor=predictor)
+    return profile
+
+
+def extrae_banda(
+    future_raster_path, banda, salida, compress="lzw", tiled=True, tam_bloque=512, predictor=None
+):
+    # Mismo perfil de salida que extrae_bandas (compresión, tiles y predictor)
+    with rasterio.open(future_raster_path) as src:
+        if banda > src.count:
+            raise ValueError("La banda no existe")
+
+        profile = perfil_salida(src.profile, compress, tiled, tam_bloque, predictor)
+
+        with rasterio.open(salida, "w", **profile) as dst:
+            # Itera sobre los bloques de la salida: cada tile se comprime una vez
+            for _, window in dst.block_windows(1):
+                data = src.read(banda, window=window)
+                dst.write(data, 1, window=window)
+    return salida
+
+
+def extrae_bandas(
+    future_raster_path,
+    bandas,
+    salidas,
+    hilos=HILOS,
+    multiplo=MULTIPLO_BLOQUE,
+    profundidad=PROFUNDIDAD,
+    cola_escritura=COLA_ESCRITURA,
+    **opciones_perfil,
+):
+    # Una sola lectura por ventana de TODAS las bandas pedidas
+    # (src.read(indexes=[...])) repartida entre N archivos de salida abiertos.
+    # En rasters con bandas intercaladas por pixel cada bloque se decodifica una vez.
+    with rasterio.open(future_raster_path) as src:
+        for banda in bandas:
             if banda > src.count:
-                raise ValueError("La banda no existe")
+                raise ValueError(f"La banda {banda} no existe")
+        profile = perfil_salida(src.profile, **opciones_perfil)
+
+    def kernel_bandas(window, datos):
+        data = datos["src"]
+        return {banda: data[i] for i, banda in enumerate(bandas)}
 
-            profile = src.profile.copy()
-            profile.update(count=1)
+    procesa_bloques(
+        {"src": (future_raster_path, list(bandas))},
+        kernel_bandas,
+        salidas={banda: (salida, profile) for banda, salida in zip(bandas, salidas)},
+        hilos=hilos,
+        multiplo=multiplo,
+        profundidad=profundidad,
+        cola_escritura=cola_escritura,
+    )
+    return salidas
 
-            with rasterio.open(salida, "w", **profile) as dst:
-                # Itera sobre los bloques internos del raster
-                for _, window in src.block_windows(banda):
-                    data = src.read(banda, window=window)
-                    dst.write(data, 1, window=window)
+
+@instrumenta("organizacion")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extrae las bandas BIO del raster futuro multibanda"
+    )
+    agrega_argumento_workers(
+        parser, "procesos en paralelo, uno por banda; solo con --modo banda (multibanda usa --hilos)"
+    )
+    agrega_argumentos_bloques(parser)
+    agrega_argumentos_anticipacion(parser)
+    parser.add_argument(
+        "--bandas", type=int, nargs="+", default=bandas, help="bandas BIO a extraer"
+    )
+    parser.add_argument("--gcm", default=GCM, help="modelo climático (GCM)")
+    parser.add_argument("--ssp", default=SSP, help="escenario SSP")
+    parser.add_argument("--periodo", default=PERIODO, help="período, p. ej. 2021-2040")
+    parser.add_argument(
+        "--modo",
+        choices=["multibanda", "banda"],
+        default="multibanda",
+        help="multibanda: una lectura para todas las bandas; banda: una pasada por banda",
+    )
+    parser.add_argument("--compress", default="lzw", help="compresión de salida (none para desactivar)")
+    parser.add_argument("--predictor", type=int, choices=[1, 2, 3], help="predictor GeoTIFF")
+    parser.add_argument("--sin-tiles", action="store_true", help="escribe en tiras en lugar de tiles")
+    parser.add_argument("--tam-tile", type=int, default=512, help="lado del tile de salida")
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    entrada = ruta_futuro(args.gcm, args.ssp, args.periodo)
+    if not entrada.exists():
+        print("ERROR: raster no encontrado")
+        return
+
+    opciones_perfil = {
+        "compress": args.compress,
+        "tiled": not args.sin_tiles,
+        "tam_bloque": args.tam_tile,
+        "predictor": args.predictor,
+    }
+
+    if args.modo == "banda":
+        tareas = {
+            banda: (
+                entrada,
+                banda,
+                ruta_banda(banda),
+                args.compress,
+                not args.sin_tiles,
+                args.tam_tile,
+                args.predictor,
+            )
+            for banda in args.bandas
+        }
+        resultados = ejecuta_tareas(extrae_banda, tareas, workers=args.workers)
+
+        for banda, resultado in resultados.items():
+            if resultado.ok:
+                print(f"Raster {resultado.valor} exportado con exito.")
+            else:
+                print(f"ERROR en la banda {banda}: {resultado.error}")
+        return resultados
+
+    salidas = extrae_bandas(
+        entrada,
+        args.bandas,
+        [ruta_banda(banda) for banda in args.bandas],
+        hilos=args.hilos,
+        multiplo=args.multiplo_bloque,
+        profundidad=args.profundidad,
+        cola_escritura=args.cola_escritura,
+        **opciones_perfil,
+    )
+    for salida in salidas:
         print(f"Raster {salida} exportado con exito.")
+    return salidas
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,48 @@
+import argparse
 from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
 import rasterio
-from rasterio.features import rasterize
-from rasterstats import zonal_stats
+
+from Alineacion import alineacion_virtual
+from bloques import (
+    COLA_ESCRITURA,
+    HILOS,
+    MULTIPLO_BLOQUE,
+    PROFUNDIDAD,
+    agrega_argumentos_anticipacion,
+    agrega_argumentos_bloques,
+    procesa_bloques,
+    ventanas_bloque,
+)
+from cache import agrega_argumentos_cache, cache_de_args
+from cuantizacion import (
+    ESCALAS,
+    TOLERANCIA,
+    FueraDeRango,
+    ajuste_rango,
+    codifica,
+    escala_para,
+    escribe_tabla_regional,
+    perfil_cuantizado,
+)
+from cubo import CUBO_PATH, HIST_PATH, construye_cubo
+from grilla import RegistroGrillas, firma_raster, ruta_alineada
+from instrumentacion import agrega_argumentos_instrumentacion, etapa, instrumenta
+from Organizacion import ruta_futuro
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+from perfiles import agrega_argumento_perfil, aplica_perfil
+from zonas import (
+    SIN_ZONA,
+    EstadisticasZonales,
+    IndiceEspacial,
+    agrega_tocados,
+    rango_z,
+    rasteriza_zonas,
+    tablas_z,
+    z_regional,
+)
 
 # ===================================================
 # CONFIGURACIÓN GENERAL
@@ -14,14 +52,8 @@ RASTER_PATH = Path("./RASTER/modificados/")
 VECTOR_PATH = Path("./VECTOR/Area_Estudio/Area_Estudio.shp")
 OUTPUT_PATH = Path("./RASTER/derivados/")
 NODATA_VAL_OUT = -9999
-
-OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
-
-# ---------------------------------------------------
-# VECTORES
-# ---------------------------------------------------
-
-regiones = gpd.read_file(VECTOR_PATH)
+# Los rasters MEAN_/STD_ ya no son necesarios para el Z-score; solo para depuración
+ESCRIBIR_MEAN_STD = False
 
 # ---------------------------------------------------
 # BIOS
@@ -50,130 +82,344 @@ BIOS = {
     },
 }
 
-# ===================================================
-# A.1 DELTAS BIOCLIMÁTICOS (STREAMING + BIO14 INVERTIDO)
-# ===================================================
-
-for bio_idx, cfg in BIOS.items():
-    # bio_idx, cfg = list(BIOS.items())[1]
-    delta_path = OUTPUT_PATH.joinpath(f"DELTA_bio_{bio_idx}.tif")
-
-    with rasterio.open(cfg["hist_path"]) as src_h, rasterio.open(
-        cfg["fut_path"]
-    ) as src_f:
-        assert src_h.crs == src_f.crs
-        assert src_h.transform == src_f.transform
-        assert src_h.shape == src_f.shape
-
-        profile = src_h.profile.copy()
-        profile.update(dtype="float32", nodata=NODATA_VAL_OUT)
-
-        with rasterio.open(delta_path, "w", **profile) as dst:
-            for _, window in src_h.block_windows(1):
-                h = src_h.read(1, window=window).astype("float32")
-                f = src_f.read(1, window=window).astype("float32")
-
-                delta = f - h
-
-                mask = (h == src_h.nodata) | (f == src_f.nodata) | np.isnan(delta)
-
-                delta[mask] = NODATA_VAL_OUT
-
-                # Inversión temprana BIO14
-                if bio_idx == 14:
-                    delta = -delta
 
-                dst.write(delta, 1, window=window)
-
-    BIOS.get(bio_idx).update({"delta_path": delta_path})
-
-    print(f"Delta bio_{bio_idx} generado")
+def procesa_bio(
+    bio_idx,
+    cfg,
+    regiones_path,
+    n_regiones,
+    hilos=HILOS,
+    multiplo=MULTIPLO_BLOQUE,
+    perfil="nativo",
+    cuantizar=False,
+    tolerancia=TOLERANCIA,
+    cache=None,
+    indice=None,
+    profundidad=PROFUNDIDAD,
+    cola_escritura=COLA_ESCRITURA,
+):
     # ===================================================
-    # A.2 MEDIA Y DESVIACIÓN REGIONAL (VECTORIAL)
+    # A.1 + A.2 DELTA (BIO14 INVERTIDO) Y ESTADÍSTICAS REGIONALES
+    # Una pasada por bloques: el delta se escribe y se acumula por región
     # ===================================================
 
-    stats = zonal_stats(
-        regiones,
-        delta_path,
-        stats=["mean", "std"],
-        nodata=NODATA_VAL_OUT,
-        all_touched=True,
-    )
-
-    regiones[f"mean_bio_{bio_idx}"] = [s["mean"] for s in stats]
-    regiones[f"std_bio_{bio_idx}"] = [s["std"] for s in stats]
-
-    if (regiones[f"std_bio_{bio_idx}"] == 0).any():
-        regiones.loc[
-            regiones[f"std_bio_{bio_idx}"] == 0, [f"std_bio_{bio_idx}"]
-        ] = -9999
-        # raise ValueError(f"STD = 0 detectado en BIO{bio_idx}")
-        print(f"STD = 0 detectado en BIO{bio_idx}")
+    delta_path = OUTPUT_PATH.joinpath(f"DELTA_bio_{bio_idx}.tif")
+    # Cuantizado, los extremos por region acotan el rango de Z_ (zonas.rango_z)
+    estadisticas = EstadisticasZonales(n_regiones, extremos=cuantizar)
+
+    # En el cubo de trabajo hist y fut son bandas de un mismo VRT
+    banda_h = cfg.get("hist_banda", 1)
+    banda_f = cfg.get("fut_banda", 1)
+    # Sin recorte previo, los pixeles fuera de toda región se enmascaran aquí
+    solo_zonas = cfg.get("solo_zonas", False)
+
+    with rasterio.open(regiones_path) as src_r, rasterio.open(
+        cfg["hist_path"]
+    ) as src_h, rasterio.open(cfg["fut_path"]) as src_f:
+        for src in (src_h, src_f):
+            if firma_raster(src) != firma_raster(src_r):
+                raise ValueError(f"{src.name} no comparte la grilla de {regiones_path}")
+
+        # Con el indice espacial de las regiones se saltean las ventanas sin
+        # ninguna región: ahí Z_ (y el delta de solo_zonas) es todo nodata
+        ventanas = list(ventanas_bloque(src_r, multiplo))
+        ventanas_zonas = indice.filtra(ventanas) if indice is not None else ventanas
+
+        nodata_h = src_h.nodatavals[banda_h - 1]
+        nodata_f = src_f.nodatavals[banda_f - 1]
+        profile = src_h.profile.copy()
+        profile.update(driver="GTiff", count=1, dtype="float32", nodata=NODATA_VAL_OUT)
+
+    # Con cuantizar, DELTA_ y Z_ se guardan en int16 con escala/offset
+    escalas = {tipo: escala_para(tipo, tolerancia) for tipo in ESCALAS}
+    offsets = {tipo: 0.0 for tipo in ESCALAS}
+    cuantizados = {tipo: cuantizar for tipo in ESCALAS}
+
+    def perfil_de(tipo):
+        if cuantizados[tipo]:
+            return aplica_perfil(perfil_cuantizado(profile, escalas[tipo], offsets[tipo]), perfil)
+        return aplica_perfil(profile, perfil)
+
+    def calcula_delta(datos):
+        ids = datos["ids"]
+        h = datos["h"].astype("float32")
+        f = datos["f"].astype("float32")
+
+        delta = f - h
+
+        # Inversión temprana BIO14
+        if bio_idx == 14:
+            delta = -delta
+
+        mask = (h == nodata_h) | (f == nodata_f) | np.isnan(delta)
+        if solo_zonas:
+            mask |= ids == SIN_ZONA
+        delta[mask] = NODATA_VAL_OUT
+        return delta, mask
+
+    entradas_delta = {
+        "ids": (regiones_path, 1),
+        "h": (cfg["hist_path"], banda_h),
+        "f": (cfg["fut_path"], banda_f),
+    }
+
+    def kernel_delta(window, datos):
+        ids = datos["ids"]
+        delta, mask = calcula_delta(datos)
+
+        estadisticas.agrega(ids, delta, ~mask & (ids != SIN_ZONA))
+        # Media y desviacion regionales con la regla all_touched (como zonal_stats);
+        # el Z de cada pixel usa la region de su centro (REGIONES_id.tif)
+        if indice is not None:
+            agrega_tocados(estadisticas, indice, window, ids, delta, ~mask)
+        if cuantizados["delta"]:
+            return {"delta": codifica(delta, ~mask, escalas["delta"])}
+        return {"delta": delta}
+
+    def pasada_delta():
+        with etapa("delta", categoria="paso", bio=bio_idx):
+            procesa_bloques(
+                entradas_delta,
+                kernel_delta,
+                salidas={"delta": (delta_path, perfil_de("delta"))},
+                ventanas=ventanas_zonas if solo_zonas else ventanas,
+                hilos=hilos,
+                multiplo=multiplo,
+                profundidad=profundidad,
+                cola_escritura=cola_escritura,
+                cache=cache,
+            )
 
-    print(f"Estadísticas regionales DELTA_bio_{bio_idx} calculadas")
+    # El rango del delta no se conoce antes de la pasada: si no entra en int16,
+    # la pasada se repite (estadisticas desde cero) y DELTA_ queda en float32
+    try:
+        pasada_delta()
+    except FueraDeRango as e:
+        print(f"BIO{bio_idx}: {e}; DELTA_ se guarda en float32")
+        cuantizados["delta"] = False
+        estadisticas = EstadisticasZonales(n_regiones, extremos=cuantizar)
+        pasada_delta()
+
+    media = estadisticas.media()
+    std = estadisticas.std()
+
+    # Tablas por región para el Z-score (posición 0 = fuera de toda región)
+    mean_lut, std_lut = tablas_z(estadisticas)
+
+    # El offset de Z_ centra su rango posible en int16; si ni así entra con la
+    # escala de la tolerancia, Z_ de este BIO se escribe en float32
+    if cuantizar:
+        ajuste = ajuste_rango(*rango_z(estadisticas), escalas["z"])
+        if ajuste is None:
+            print(
+                f"BIO{bio_idx}: el rango de Z no entra en int16 con escala "
+                f"{escalas['z']}, Z_ se guarda en float32"
+            )
+            cuantizados["z"] = False
+        else:
+            escalas["z"], offsets["z"] = ajuste
 
     # ===================================================
-    # A.3 RASTERIZACIÓN DE MEDIA Y STD
+    # A.3 + A.4 NORMALIZACIÓN Z-SCORE REGIONAL (STREAMING)
+    # La media y la desviación se toman de las tablas por región;
+    # MEAN_/STD_ solo se escriben si ESCRIBIR_MEAN_STD está activo; cuantizados
+    # se guardan como tabla por región sobre REGIONES_id.tif
     # ===================================================
 
-    with rasterio.open(BIOS[1]["hist_path"]) as ref:
-        meta = ref.meta.copy()
-        meta.update(dtype="float32", nodata=NODATA_VAL_OUT)
-
-        for stat in ["mean", "std"]:
-            # stat = 'mean'
-            out_path = OUTPUT_PATH.joinpath(f"{stat.upper()}_bio_{bio_idx}.tif")
-
-            shapes = (
-                (geom, val)
-                for geom, val in zip(
-                    regiones.geometry, regiones[f"{stat}_bio_{bio_idx}"]
+    salidas = {
+        "delta": delta_path,
+        "z": OUTPUT_PATH.joinpath(f"Z_bio_{bio_idx}.tif"),
+    }
+    if ESCRIBIR_MEAN_STD:
+        for stat, valores in (("mean", mean_lut), ("std", std_lut)):
+            if cuantizar:
+                salidas[stat] = escribe_tabla_regional(
+                    OUTPUT_PATH.joinpath(f"{stat.upper()}_bio_{bio_idx}.json"),
+                    regiones_path,
+                    valores,
+                    NODATA_VAL_OUT,
+                )
+            else:
+                salidas[stat] = OUTPUT_PATH.joinpath(f"{stat.upper()}_bio_{bio_idx}.tif")
+    rasters_z = ["z", "mean", "std"] if ESCRIBIR_MEAN_STD and not cuantizar else ["z"]
+
+    def kernel_z(window, datos):
+        ids = datos["ids"]
+        # Cuantizado, el delta se recalcula en float desde hist/fut para que el
+        # error de Z_ sea solo el de su propia cuantización
+        d = calcula_delta(datos)[0] if cuantizar else datos["d"]
+        z, valid = z_regional(ids, d, mean_lut, std_lut, NODATA_VAL_OUT)
+
+        if cuantizar:
+            if cuantizados["z"]:
+                z = codifica(z, valid, escalas["z"], offsets["z"])
+            return {"z": z}
+
+        resultados = {"z": z}
+        if ESCRIBIR_MEAN_STD:
+            for stat, arr in (("mean", mean_lut[ids]), ("std", std_lut[ids])):
+                resultados[stat] = np.where(np.isnan(arr), NODATA_VAL_OUT, arr).astype(
+                    "float32"
                 )
+        return resultados
+
+    with etapa("z_score", categoria="paso", bio=bio_idx):
+        procesa_bloques(
+            entradas_delta if cuantizar else {"ids": (regiones_path, 1), "d": (delta_path, 1)},
+            kernel_z,
+            salidas={stat: (salidas[stat], perfil_de("z")) for stat in rasters_z},
+            ventanas=ventanas_zonas,
+            hilos=hilos,
+            multiplo=multiplo,
+            profundidad=profundidad,
+            cola_escritura=cola_escritura,
+            tolerancia=tolerancia,
+            cache=cache,
+        )
+
+    return {"media": media[1:], "std": std[1:], "paths": salidas}
+
+
+def verifica_grillas(bios, ref_path):
+    # Compara las firmas de grilla registradas (sin abrir los rasters): un par
+    # fuera de la grilla de referencia se alinea en el momento como _ali.vrt
+    registro = RegistroGrillas()
+    firma_ref = registro.firma(ref_path)
+    for bio_idx, cfg in bios.items():
+        for clave in ("hist_path", "fut_path"):
+            if registro.firma(cfg[clave]) == firma_ref:
+                continue
+            print(f"BIO{bio_idx}: {cfg[clave].name} no está alineado, se genera su alineación virtual")
+            cfg[clave] = alineacion_virtual(cfg[clave], ref_path)
+            registro.registra(cfg[clave], registro.grilla(ref_path))
+    registro.guarda()
+
+
+@instrumenta("analisis")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Deltas, estadísticas regionales y Z-score de las variables BIO"
+    )
+    agrega_argumento_workers(parser)
+    agrega_argumentos_bloques(parser)
+    agrega_argumentos_anticipacion(parser)
+    agrega_argumento_perfil(parser)
+    parser.add_argument(
+        "--cuantizar",
+        action="store_true",
+        help="guarda DELTA_/Z_ en int16 con escala/offset y MEAN_/STD_ como tabla por región",
+    )
+    parser.add_argument(
+        "--tolerancia",
+        type=float,
+        default=TOLERANCIA,
+        help="error de cuantización máximo admitido al escribir y al leer",
+    )
+    agrega_argumentos_cache(parser)
+    parser.add_argument(
+        "--cubo",
+        action="store_true",
+        help="lee los pares BIO del cubo de trabajo VRT (originales + ventana del área de estudio) "
+        "en lugar de los recorte_*.tif",
+    )
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
+
+    # ---------------------------------------------------
+    # VECTORES
+    # ---------------------------------------------------
+
+    regiones = gpd.read_file(VECTOR_PATH)
+
+    if args.cubo:
+        bandas_cubo = construye_cubo(
+            {bio_idx: HIST_PATH.format(bio_idx) for bio_idx in BIOS},
+            ruta_futuro(),
+            regiones.geometry,
+        )
+        for bio_idx, cfg in BIOS.items():
+            banda_h, banda_f = bandas_cubo[bio_idx]
+            cfg.update(
+                hist_path=CUBO_PATH,
+                hist_banda=banda_h,
+                fut_path=CUBO_PATH,
+                fut_banda=banda_f,
+                solo_zonas=True,
             )
-
-            raster = rasterize(
-                shapes,
-                out_shape=(ref.height, ref.width),
-                transform=ref.transform,
-                fill=NODATA_VAL_OUT,
-                dtype="float32",
+        print(f"Cubo de trabajo generado: {CUBO_PATH}")
+    else:
+        # Si Alineacion.py corrigió un raster se usa su versión alineada (_ali.tif o _ali.vrt)
+        for cfg in BIOS.values():
+            cfg.update(
+                hist_path=ruta_alineada(cfg["hist_path"]),
+                fut_path=ruta_alineada(cfg["fut_path"]),
             )
+        verifica_grillas(BIOS, BIOS[1]["hist_path"])
 
-            with rasterio.open(out_path, "w", **meta) as dst:
-                dst.write(raster, 1)
-
-            print(f"Raster {stat.upper()}_bio_{bio_idx} creado")
-            BIOS.get(bio_idx).update({f"{stat}_path": out_path})
-        # ===================================================
-        # A.4 NORMALIZACIÓN Z-SCORE REGIONAL (STREAMING)
-        # ===================================================
-
-        mean_path = BIOS.get(bio_idx).get("mean_path")
-        std_path = BIOS.get(bio_idx).get("std_path")
-        z_path = OUTPUT_PATH.joinpath(f"Z_bio_{bio_idx}.tif")
-
-    with rasterio.open(delta_path) as src_d, rasterio.open(
-        mean_path
-    ) as src_m, rasterio.open(std_path) as src_s:
-        profile = src_d.profile.copy()
-        profile.update(dtype="float32", nodata=NODATA_VAL_OUT)
-
-        with rasterio.open(z_path, "w", **profile) as dst:
-            for _, window in src_d.block_windows(1):
-                d = src_d.read(1, window=window)
-                m = src_m.read(1, window=window)
-                s = src_s.read(1, window=window)
-
-                z = np.full(d.shape, NODATA_VAL_OUT, dtype="float32")
-
-                valid = s != NODATA_VAL_OUT  # & (s != 0) & (~np.isnan(s))
-
-                z[valid] = (d[valid] - m[valid]) / s[valid]
-
-                dst.write(z, 1, window=window)
-
-    BIOS.get(bio_idx).update({"z_path": z_path})
-
-    print(f"Z-score bio_{bio_idx} generado")
+    # ===================================================
+    # A.0 RASTER DE REGIONES (UNA SOLA VEZ PARA TODOS LOS BIOS)
+    # ===================================================
 
-print("\nDelta, Normalización y Z-score creados")
+    regiones_path = OUTPUT_PATH.joinpath("REGIONES_id.tif")
+    n_regiones = len(regiones)
+
+    rasteriza_zonas(regiones.geometry, BIOS[1]["hist_path"], regiones_path)
+    if not args.cubo:
+        registro = RegistroGrillas()
+        registro.registra(regiones_path, registro.grilla(BIOS[1]["hist_path"]))
+        registro.guarda()
+    print(f"Raster de regiones generado ({n_regiones} regiones)")
+    with rasterio.open(regiones_path) as src_r:
+        indice = IndiceEspacial(regiones.geometry, src_r.transform)
+
+    tareas = {
+        bio_idx: (
+            bio_idx,
+            cfg,
+            regiones_path,
+            n_regiones,
+            args.hilos,
+            args.multiplo_bloque,
+            args.perfil,
+            args.cuantizar,
+            args.tolerancia,
+            cache_de_args(args),
+            indice,
+            args.profundidad,
+            args.cola_escritura,
+        )
+        for bio_idx, cfg in BIOS.items()
+    }
+    resultados = ejecuta_tareas(procesa_bio, tareas, workers=args.workers)
+
+    for bio_idx, resultado in resultados.items():
+        if not resultado.ok:
+            print(f"ERROR al procesar BIO{bio_idx}: {resultado.error}")
+            continue
+
+        BIOS.get(bio_idx).update(
+            {f"{stat}_path": path for stat, path in resultado.valor["paths"].items()}
+        )
+        print(f"Delta bio_{bio_idx} generado")
+
+        regiones[f"mean_bio_{bio_idx}"] = resultado.valor["media"]
+        regiones[f"std_bio_{bio_idx}"] = resultado.valor["std"]
+
+        if (regiones[f"std_bio_{bio_idx}"] == 0).any():
+            regiones.loc[
+                regiones[f"std_bio_{bio_idx}"] == 0, [f"std_bio_{bio_idx}"]
+            ] = -9999
+            # raise ValueError(f"STD = 0 detectado en BIO{bio_idx}")
+            print(f"STD = 0 detectado en BIO{bio_idx}")
+
+        print(f"Estadísticas regionales DELTA_bio_{bio_idx} calculadas")
+        print(f"Z-score bio_{bio_idx} generado")
+
+    print("\nDelta, Normalización y Z-score creados")
+    return regiones, resultados
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,20 @@ import numpy as np
 import geopandas as gpd
 import pandas as pd
 import os
-import matplotlib.pyplot as plt
-from rasterstats import zonal_stats
 from rasterio.enums import Resampling
 import rasterio.warp
-from math import pi
+import argparse
+
+from bloques import procesa_bloques
+from cache import agrega_argumentos_cache, cache_de_args
+from cobertura import cobertura_zonas, estadisticas_cobertura
+from estadisticas import Acumulador
+from indices import INDICES, calcula_indices, lee_indices
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+from perfiles import agrega_argumento_perfil, aplica_perfil
+from reporte import EXTENSION_TABLA, escribe_tabla, genera_reporte
+from zonas import SIN_ZONA, IndiceEspacial, asigna_padres, estadisticas_multicapa, indice_zonas
 
 #Rutas y Datos Principales
 BASE_DIR = "/home/victor/Documentos/Proyección_Hotspots/"
@@ -16,6 +25,9 @@ VECTOR_DIR = os.path.join(BASE_DIR, "VECTOR/")
 OUTPUT_DIR = os.path.join(BASE_DIR, "RESULTADOS/")
 NODATA_VAL_OUT = -9999.0
 OUTPUT_EXCEL = os.path.join(OUTPUT_DIR, "Reporte_Hotspots_Zonal_MultiPais.xlsx")
+# Tabla columnar con las estadisticas de todas las zonas (entrada de reporte.py)
+OUTPUT_TABLA = os.path.join(OUTPUT_DIR, f"Estadisticas_Zonales{EXTENSION_TABLA}")
+RADAR_DIR = os.path.join(OUTPUT_DIR, "RADAR/")
 
 # Rutas de SHP para el Analisis Zonal
 VECTOR_PATHS = {
@@ -23,8 +35,14 @@ VECTOR_PATHS = {
     "URUGUAY_DEPTO": {"path": os.path.join(VECTOR_DIR, "departamentos/c004Polygon.shp"), "field": 'nombre', "nivel": "Departamento"},
     "BRASIL_ESTADO": {"path": os.path.join(VECTOR_DIR, "datos_BR.gpkg"), "field": 'nome', "layer": 'estados_br', "nivel": "Estado"},
     "ARGENTINA_PROV": {"path": os.path.join(VECTOR_DIR, "provincia/Provincias.shp"), "field": 'nam', "nivel": "Provincia"},
-    "ARGENTINA_REGION": {"path": os.path.join(VECTOR_DIR, "regiones/Regiones_ARG.shp"), "field": 'REGION', "nivel": "Región"}
+    # Las regiones son uniones de provincias: se agregan desde ARGENTINA_PROV sin leer rasters
+    "ARGENTINA_REGION": {"path": os.path.join(VECTOR_DIR, "regiones/Regiones_ARG.shp"), "field": 'REGION', "nivel": "Región", "agrega": "ARGENTINA_PROV"}
 }
+# Niveles superiores derivados de la capa mas fina de cada pais
+CAPA_PAISES = "PAISES"
+CAPA_AREA = "AREA_ESTUDIO"
+# Fraccion minima del area de una zona hija dentro de su zona padre
+FRACCION_PADRE = 0.99
 
 # Variables bio
 BIOS = {
@@ -36,285 +54,391 @@ BIOS = {
 FILE_PREFIX_HIST = "bio{}_his.tif"
 FILE_PREFIX_FUT = "bio{}_fut.tif"
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-print(f"Salida: {OUTPUT_DIR}")
-
-## -----------------------------------------------------------
-## PARTE A: DELTAS Y Z-SCORE
-## -----------------------------------------------------------
-
-print("Calculando Deltas y Normalizando Z-Score...")
-delta_rasters_paths = {}
-all_delta_values = []
-
-# Deltas
-for index, name in BIOS.items():
-    hist_path = os.path.join(RASTER_DIR, FILE_PREFIX_HIST.format(index))
-    fut_path = os.path.join(RASTER_DIR, FILE_PREFIX_FUT.format(index))
-    delta_path = os.path.join(OUTPUT_DIR, f"DELTA_{name}.tif") 
-
-    try:
-        with rasterio.open(hist_path) as src_hist, rasterio.open(fut_path) as src_fut:
-            data_hist = src_hist.read(1).astype(np.float32)
-            data_fut = src_fut.read(1).astype(np.float32)
-            delta_data = data_fut - data_hist
-            
-            nodata_hist = src_hist.nodata if src_hist.nodata is not None else NODATA_VAL_OUT
-            nodata_fut = src_fut.nodata if src_fut.nodata is not None else NODATA_VAL_OUT
-            valid_mask = (data_hist != nodata_hist) & (data_fut != nodata_fut) & (~np.isnan(delta_data))
-            delta_data[~valid_mask] = NODATA_VAL_OUT 
-            valid_values = delta_data[valid_mask]
-            
-            if valid_values.size > 0:
-                all_delta_values.append(valid_values)
-            
-            out_meta = src_hist.profile.copy()
-            out_meta.update({"dtype": 'float32', "nodata": NODATA_VAL_OUT})
-            
-            with rasterio.open(delta_path, "w", **out_meta) as dest:
-                dest.write(delta_data, 1)
-            
-            delta_rasters_paths[name] = delta_path
-            
-    except Exception as e:
-        print(f"ERROR al calcular Delta para BIO{index}: {e}")
-        continue
-
-# Calculo Global de Z-Score
-try:
-    all_values_combined = np.concatenate(all_delta_values)
-    mean_global = np.mean(all_values_combined)
-    std_global = np.std(all_values_combined)
-except ValueError:
-    print("ERROR: no hay valores delta validos")
-    exit()
-
-# Normalizacion Z-Score
-normalized_rasters_paths = {}
-for name, delta_path in delta_rasters_paths.items():
-    with rasterio.open(delta_path) as src:
-        delta_data = src.read(1).astype(np.float32)
-        valid_mask = delta_data != NODATA_VAL_OUT
-        z_score_data = np.full(delta_data.shape, NODATA_VAL_OUT, dtype=np.float32)
-        z_score_data[valid_mask] = (delta_data[valid_mask] - mean_global) / std_global
-        z_score_path = os.path.join(OUTPUT_DIR, f"Z_{name}.tif") 
-        out_meta = src.meta.copy()
+
+def calcula_delta(hist_path, fut_path, delta_path, perfil="nativo"):
+    # Delta por bloques; los valores validos alimentan un acumulador en streaming
+    acumulador = Acumulador()
+
+    with rasterio.open(hist_path) as src_hist, rasterio.open(fut_path) as src_fut:
+        nodata_hist = src_hist.nodata if src_hist.nodata is not None else NODATA_VAL_OUT
+        nodata_fut = src_fut.nodata if src_fut.nodata is not None else NODATA_VAL_OUT
+        out_meta = src_hist.profile.copy()
         out_meta.update({"dtype": 'float32', "nodata": NODATA_VAL_OUT})
-        with rasterio.open(z_score_path, "w", **out_meta) as dest:
-            dest.write(z_score_data, 1)
-        normalized_rasters_paths[name] = z_score_path
-
-# Calculo del Indice de impacto Agregado (SUMA DIRECTA, SIN INVERSION de BIO_14)
-print("\nCalculando indice de impacto agregado...")
-z_rasters = [rasterio.open(p) for p in normalized_rasters_paths.values()]
-first_meta = z_rasters[0].meta.copy()
-z_score_arrays = [r.read(1) for r in z_rasters]
-
-impacto_agregado_data = np.zeros_like(z_score_arrays[0])
-valid_sum_mask = np.full(z_score_arrays[0].shape, True)
-
-# Suma directa de todos los Z-scores (Z_BIO1 + Z_BIO5 + Z_BIO14 + Z_BIO15)
-for arr in z_score_arrays:
-    current_valid = (arr != NODATA_VAL_OUT)
-    impacto_agregado_data[current_valid] += arr[current_valid]
-    valid_sum_mask &= current_valid 
-
-impacto_agregado_data[~valid_sum_mask] = NODATA_VAL_OUT
-impacto_agregado_path = os.path.join(OUTPUT_DIR, "INDICE_IMPACTO_AGREGADO.tif")
-first_meta.update({"dtype": 'float32', "nodata": NODATA_VAL_OUT})
-with rasterio.open(impacto_agregado_path, "w", **first_meta) as dest:
-    dest.write(impacto_agregado_data, 1)
-print(f"Indice de impacto agregado creado: {impacto_agregado_path}")
-
-
-## -----------------------------------------------------------
-## PARTE B: ANALISIS ZONAL Y CALCULO DE INDICES COMPUESTOS
-## -----------------------------------------------------------
-
-print("Realizando Analisis Zonal y calculo de indices")
-
-rasters_to_analyze = {
-    'delta_BIO1': delta_rasters_paths['BIO1'], 'delta_BIO5': delta_rasters_paths['BIO5'],
-    'delta_BIO14': delta_rasters_paths['BIO14'], 'delta_BIO15': delta_rasters_paths['BIO15'],
-    'z_BIO1': normalized_rasters_paths['BIO1'], 'z_BIO5': normalized_rasters_paths['BIO5'],
-    'z_BIO14': normalized_rasters_paths['BIO14'], 'z_BIO15': normalized_rasters_paths['BIO15'],
-    'Indice_consolidado_RASTER': impacto_agregado_path # Nombre temporal para evitar conflicto
-}
+        out_meta = aplica_perfil(out_meta, perfil)
 
-all_country_reports = {} 
+    def kernel_delta(window, datos):
+        data_hist = datos['hist'].astype(np.float32)
+        data_fut = datos['fut'].astype(np.float32)
+        delta_data = data_fut - data_hist
 
-for country_key, settings in VECTOR_PATHS.items():
-    
-    if "layer" in settings:
-        area_estudio = gpd.read_file(settings['path'], layer=settings['layer'])
-    else:
-        area_estudio = gpd.read_file(settings['path'])
-        
-    key_field = settings['field']
-    nivel = settings['nivel']
+        valid_mask = (data_hist != nodata_hist) & (data_fut != nodata_fut) & (~np.isnan(delta_data))
+        delta_data[~valid_mask] = NODATA_VAL_OUT
+        acumulador.agrega(delta_data[valid_mask])
+        return {'delta': delta_data}
+
+    procesa_bloques(
+        {'hist': (hist_path, 1), 'fut': (fut_path, 1)},
+        kernel_delta,
+        salidas={'delta': (delta_path, out_meta)},
+    )
+    return acumulador
 
-    if key_field not in area_estudio.columns:
-        area_estudio['NOMBRE_ZONA'] = area_estudio.index
+
+def normaliza_z(delta_path, z_score_path, mean_global, std_global, perfil="nativo", cache=None):
+    with rasterio.open(delta_path) as src:
+        out_meta = src.meta.copy()
+        out_meta.update({"dtype": 'float32', "nodata": NODATA_VAL_OUT})
+        out_meta = aplica_perfil(out_meta, perfil)
+
+    def kernel_z(window, datos):
+        delta_data = datos['delta'].astype(np.float32)
+        valid_mask = delta_data != NODATA_VAL_OUT
+        z_score_data = np.full(delta_data.shape, NODATA_VAL_OUT, dtype=np.float32)
+        z_score_data[valid_mask] = (delta_data[valid_mask] - mean_global) / std_global
+        return {'z': z_score_data}
+
+    procesa_bloques(
+        {'delta': (delta_path, 1)}, kernel_z, salidas={'z': (z_score_path, out_meta)}, cache=cache
+    )
+    return z_score_path
+
+
+def estadisticas_por_etiquetas(capas_gdf, capas_zonales, ref_path, rasters, cache=None, workers=1):
+    # Indice espacial de cada capa: solo se recorren los bloques que tocan alguna zona
+    with rasterio.open(ref_path) as ref:
+        bloques_ref = [window for _, window in ref.block_windows(1)]
+        indices_espaciales = {
+            country_key: IndiceEspacial(gdf.geometry, ref.transform)
+            for country_key, gdf in capas_gdf.items()
+        }
+    toca = {
+        country_key: [indice.toca(w) for w in bloques_ref]
+        for country_key, indice in indices_espaciales.items()
+    }
+
+    # Secuencial: una unica pasada por bloques para todas las capas.
+    # Con --workers cada capa es una tarea independiente del pool de procesos.
+    if workers > 1:
+        tareas = {
+            country_key: (
+                {country_key: capa}, rasters, NODATA_VAL_OUT, True, cache,
+                [w for w, t in zip(bloques_ref, toca[country_key]) if t],
+            )
+            for country_key, capa in capas_zonales.items()
+        }
     else:
-        area_estudio['NOMBRE_ZONA'] = area_estudio[key_field].astype(str).str.title()
-    
-    zonal_results = []
-    
-    for index, row in area_estudio.iterrows():
-        zone_stats = {}
-        for stat_name, raster_path in rasters_to_analyze.items():
-            stats = zonal_stats(
-                vectors=[row.geometry], raster=raster_path,
-                stats=['mean', 'min', 'max'], nodata=NODATA_VAL_OUT
-            )[0]
-            
-            zone_stats.update({
-                f'{stat_name}_mean': stats['mean'],
-                f'{stat_name}_min': stats['min'],
-                f'{stat_name}_max': stats['max']
-            })
-
-        zone_stats['NOMBRE_ZONA'] = row['NOMBRE_ZONA']
-        zone_stats['PAIS_KEY'] = country_key.split('_')[0]
-        zone_stats['NIVEL_ADM'] = nivel
-        zonal_results.append(zone_stats)
-    
-    df_zonal = pd.DataFrame(zonal_results)
-
-    # CALCULO DE INDICES COMPUESTOS (SUMA DIRECTA - SIN INVERSION BIO_14)
-    df_zonal['I_estress_termico'] = df_zonal['z_BIO1_mean'] + df_zonal['z_BIO5_mean']
-    df_zonal['I_estress_hidrico'] = df_zonal['z_BIO14_mean'] + df_zonal['z_BIO15_mean']
-    
-    # Indice Consolidado = Z_BIO1 + Z_BIO5 + Z_BIO14 + Z_BIO15 (Suma directa)
-    df_zonal['Indice_consolidado'] = df_zonal['z_BIO1_mean'] + df_zonal['z_BIO5_mean'] + df_zonal['z_BIO14_mean'] + df_zonal['z_BIO15_mean']
-    
-    # Usamos el calculado directamente, no la media zonal del raster agregado
-    df_zonal.drop(columns=['Indice_consolidado_RASTER_mean', 'Indice_consolidado_RASTER_min', 'Indice_consolidado_RASTER_max'], inplace=True)
-    
-    # Renombrar columnas para el formato del Excel/Radar
-    df_zonal.rename(columns={
-        'delta_BIO1_mean': 'delta_BIO1', 'delta_BIO5_mean': 'delta_BIO5',
-        'delta_BIO14_mean': 'delta_BIO14', 'delta_BIO15_mean': 'delta_BIO15',
-        'z_BIO1_mean': 'z_bio1', 'z_BIO5_mean': 'z_bio5',
-        'z_BIO14_mean': 'z_bio14', 'z_BIO15_mean': 'z_bio15'
-    }, inplace=True)
-    
-    df_ordenado = df_zonal.dropna(subset=['Indice_consolidado'])
-    all_country_reports[country_key] = df_ordenado
-
-
-## -----------------------------------------------------------
-## PARTE C: GENERAR EXCEL Y RADAR
-## -----------------------------------------------------------
-
-print("Generando Excel y Radar...")
-
-#  Excel MultiHoja
-ranking_global_df = pd.concat(all_country_reports.values(), ignore_index=True)
-ranking_global_df = ranking_global_df.sort_values(by='Indice_consolidado', ascending=False).dropna(subset=['Indice_consolidado'])
-ranking_global_df['RANK'] = np.arange(1, len(ranking_global_df) + 1)
-
-cols_output_excel = ['RANK', 'PAIS_KEY', 'NIVEL_ADM', 'NOMBRE_ZONA', 
-               'I_estress_termico', 'I_estress_hidrico', 'Indice_consolidado',
-               'delta_BIO1', 'delta_BIO5', 'delta_BIO14', 'delta_BIO15',
-               'z_bio1', 'z_bio5', 'z_bio14', 'z_bio15']
-
-with pd.ExcelWriter(OUTPUT_EXCEL, engine='xlsxwriter') as writer:
-    ranking_global_df[cols_output_excel].to_excel(writer, sheet_name='Ranking Global de Riesgo', index=False)
-    
-    for country_key, df in all_country_reports.items():
-        df.sort_values(by='Indice_consolidado', ascending=False, inplace=True)
-        cols_sheet = ['PAIS_KEY', 'NIVEL_ADM', 'NOMBRE_ZONA', 
-                      'I_estress_termico', 'I_estress_hidrico', 'Indice_consolidado'] + \
-                     [col for col in df.columns if ('delta_' in col or 'z_' in col or '_min' in col or '_max' in col)]
-        sheet_name = country_key.replace('_DEPTO', ' (Dptos)').replace('_ESTADO', ' (Ests)').replace('_PROV', ' (Prov)').replace('_REGION', ' (Regiones)')
-        df.to_excel(writer, sheet_name=sheet_name, index=False, columns=cols_sheet)
-
-print(f"Excel Estadistico generado: {OUTPUT_EXCEL}")
-
-# ---------------------------------------------------
-# RADAR (Adaptado a Z-scores de 4 BIOs)
-# ---------------------------------------------------
-
-def radar_comparativo_por_pais(df_pais, categorias_zscore, variables_bio, pais_nombre):
-
-    if df_pais.empty or len(df_pais) < 3: 
-        print(f"Datos insuficientes para el Radar de {pais_nombre}. (Se requieren 3 zonas).")
+        ventanas = [w for i, w in enumerate(bloques_ref) if any(t[i] for t in toca.values())]
+        tareas = {'TODAS': (capas_zonales, rasters, NODATA_VAL_OUT, True, cache, ventanas)}
+
+    estadisticas = {}
+    resultados = ejecuta_tareas(estadisticas_multicapa, tareas, workers=workers)
+    for clave, resultado in resultados.items():
+        if not resultado.ok:
+            print(f"ERROR en el analisis zonal de {clave}: {resultado.error}")
+            continue
+        estadisticas.update(resultado.valor)
+    return estadisticas, resultados
+
+
+def estadisticas_por_cobertura(capas_gdf, ref_path, zonas_dir, rasters, cache=None, workers=1):
+    # Matriz de cobertura exacta de cada capa (se construye una vez por capa y
+    # grilla y queda en zonas_dir) y estadisticas ponderadas de cada raster
+    tareas = {
+        country_key: (gdf.geometry, ref_path, country_key, zonas_dir, VECTOR_PATHS[country_key]['path'])
+        for country_key, gdf in capas_gdf.items()
+    }
+    matrices = {}
+    resultados = {
+        ('cobertura', clave): resultado
+        for clave, resultado in ejecuta_tareas(cobertura_zonas, tareas, workers=workers).items()
+    }
+    for (_, country_key), resultado in resultados.items():
+        if not resultado.ok:
+            print(f"ERROR al calcular la cobertura de {country_key}: {resultado.error}")
+            continue
+        matrices[country_key] = resultado.valor
+
+    tareas = {
+        country_key: ({country_key: matriz}, rasters, NODATA_VAL_OUT, cache)
+        for country_key, matriz in matrices.items()
+    }
+    estadisticas = {}
+    for clave, resultado in ejecuta_tareas(estadisticas_cobertura, tareas, workers=workers).items():
+        resultados[clave] = resultado
+        if not resultado.ok:
+            print(f"ERROR en el analisis zonal de {clave}: {resultado.error}")
+            continue
+        estadisticas.update(resultado.valor)
+    return estadisticas, resultados
+
+
+def agrega_niveles(estadisticas, capas_gdf):
+    # Niveles superiores a partir de las estadisticas de las capas base: capas con
+    # "agrega" en VECTOR_PATHS (p. ej. regiones = union de provincias), pais y
+    # area de estudio. Solo se combinan momentos y extremos por zona padre.
+    # Devuelve {clave: {nombre: EstadisticasZonales}} y {clave: (nombres, pais, nivel)}
+    agregadas, zonas = {}, {}
+    for country_key, settings in VECTOR_PATHS.items():
+        hija = settings.get('agrega')
+        if hija is None or country_key not in capas_gdf or hija not in estadisticas:
+            continue
+        padres, fraccion = asigna_padres(capas_gdf[hija].geometry, capas_gdf[country_key].geometry)
+        parciales = int((fraccion < FRACCION_PADRE).sum())
+        if parciales:
+            print(f"AVISO: {parciales} zonas de {hija} no caen enteras en una zona de {country_key}")
+        n_padres = len(capas_gdf[country_key])
+        agregadas[country_key] = {
+            nombre: st.agrupa(padres, n_padres) for nombre, st in estadisticas[hija].items()
+        }
+
+    # Pais: la primera capa base de cada pais (todas sus zonas al mismo padre)
+    base = {}
+    for country_key in estadisticas:
+        if 'agrega' not in VECTOR_PATHS[country_key]:
+            base.setdefault(country_key.split('_')[0], country_key)
+    if not base:
+        return agregadas, zonas
+    por_pais = {}
+    for i, country_key in enumerate(base.values(), start=1):
+        padres = np.full(len(capas_gdf[country_key]) + 1, i)
+        padres[SIN_ZONA] = SIN_ZONA
+        for nombre, st in estadisticas[country_key].items():
+            parcial = st.agrupa(padres, len(base))
+            if nombre in por_pais:
+                por_pais[nombre].combina(parcial)
+            else:
+                por_pais[nombre] = parcial
+    agregadas[CAPA_PAISES] = por_pais
+    zonas[CAPA_PAISES] = ([pais.title() for pais in base], list(base), "País")
+
+    # Area de estudio: todos los paises
+    padres = np.r_[SIN_ZONA, np.ones(len(base), dtype="int64")]
+    agregadas[CAPA_AREA] = {nombre: st.agrupa(padres, 1) for nombre, st in por_pais.items()}
+    zonas[CAPA_AREA] = (["Area De Estudio"], [CAPA_AREA], "Área de estudio")
+    return agregadas, zonas
+
+
+@instrumenta("reporte")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deltas, Z-score global, analisis zonal y reporte de hotspots")
+    agrega_argumento_workers(parser)
+    agrega_argumento_perfil(parser)
+    agrega_argumentos_cache(parser)
+    parser.add_argument("--indices", help="JSON con indices compuestos adicionales {indice: {BIO: peso}}")
+    parser.add_argument(
+        "--cobertura",
+        action="store_true",
+        help="estadisticas zonales ponderadas por la fraccion de cada pixel dentro de la zona (matrices CSR en ZONAS/)",
+    )
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+    workers = args.workers
+    indices_path = args.indices
+    # Con --cache los deltas, Z e indices de zonas se decodifican una sola vez
+    # y las pasadas siguientes (Z, indices, analisis zonal) leen del memmap
+    cache = cache_de_args(args)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    print(f"Salida: {OUTPUT_DIR}")
+
+    ## -----------------------------------------------------------
+    ## PARTE A: DELTAS Y Z-SCORE
+    ## -----------------------------------------------------------
+
+    print("Calculando Deltas y Normalizando Z-Score...")
+    delta_rasters_paths = {}
+
+    # Deltas: una tarea por BIO; cada una devuelve su acumulador de media/varianza
+    tareas = {}
+    for index, name in BIOS.items():
+        hist_path = os.path.join(RASTER_DIR, FILE_PREFIX_HIST.format(index))
+        fut_path = os.path.join(RASTER_DIR, FILE_PREFIX_FUT.format(index))
+        delta_path = os.path.join(OUTPUT_DIR, f"DELTA_{name}.tif")
+        tareas[index] = (hist_path, fut_path, delta_path, args.perfil)
+
+    # Calculo Global de Z-Score: los acumuladores de cada BIO se combinan (Chan)
+    # sin concatenar los valores de los cuatro rasters
+    # Resultados de todas las tareas de la corrida (main los devuelve: pipeline.py
+    # no registra la etapa si alguna fallo)
+    resultados = {}
+    acumulador_global = Acumulador()
+    for index, resultado in ejecuta_tareas(calcula_delta, tareas, workers=workers).items():
+        resultados[('delta', index)] = resultado
+        if not resultado.ok:
+            print(f"ERROR al calcular Delta para BIO{index}: {resultado.error}")
+            continue
+        acumulador_global.combina(resultado.valor)
+        delta_rasters_paths[BIOS[index]] = tareas[index][2]
+
+    if acumulador_global.n == 0:
+        print("ERROR: no hay valores delta validos")
         return
-        
-    df_ordenado = df_pais.sort_values('Indice_consolidado', ascending=False)
-    top_maiores = df_ordenado.head(3)
-    top_menores = df_ordenado.tail(3).sort_values('Indice_consolidado', ascending=True)
-
-    fig = plt.figure(figsize=(14, 6))
-    cores_menores = ['#4daf4a', '#377eb8', '#e41a1c']  
-    cores_maiores = ['#984ea3', '#ff7f00', '#a65628']  
-
-    angles = [n / float(len(categorias_zscore)) * 2 * pi for n in range(len(categorias_zscore))]
-    angles += angles[:1]
-    
-    max_val = df_pais[categorias_zscore].abs().max().max() * 1.2
-    
-    # Plot para mayor riesgo (Top 3)
-    ax1 = fig.add_subplot(121, polar=True)
-    ax1.set_title(f'Top 3 de Mayor Riesgo - {pais_nombre}', size=14, fontweight='bold', pad=20)
-    
-    for i, (idx, row) in enumerate(top_maiores.iterrows()):
-        values = row[categorias_zscore].values.tolist()
-        values += values[:1]
-        ax1.plot(angles, values, linewidth=2, linestyle='solid', label=row['NOMBRE_ZONA'], color=cores_maiores[i])
-        ax1.fill(angles, values, alpha=0.15, color=cores_maiores[i])
-
-    ax1.set_theta_offset(pi / 2)
-    ax1.set_theta_direction(-1)
-    ax1.set_xticks(angles[:-1])
-    ax1.set_xticklabels(variables_bio)
-    ax1.set_rlim(-max_val, max_val)
-    ax1.legend(loc='lower right', bbox_to_anchor=(1.3, -.1), title="Zonas")
-
-    # Plot para menor riesgo (Top 3)
-    ax2 = fig.add_subplot(122, polar=True)
-    ax2.set_title(f'Top 3 de Menor Riesgo - {pais_nombre}', size=14, fontweight='bold', pad=20)
-    
-    for i, (idx, row) in enumerate(top_menores.iterrows()):
-        values = row[categorias_zscore].values.tolist()
-        values += values[:1]
-        ax2.plot(angles, values, linewidth=2, linestyle='solid', label=row['NOMBRE_ZONA'], color=cores_menores[i])
-        ax2.fill(angles, values, alpha=0.15, color=cores_menores[i])
-
-    ax2.set_theta_offset(pi / 2)
-    ax2.set_theta_direction(-1)
-    ax2.set_xticks(angles[:-1])
-    ax2.set_xticklabels(variables_bio)
-    ax2.set_rlim(-max_val, max_val)
-    ax2.legend(loc='lower right', bbox_to_anchor=(1.3, -.1), title="Zonas")
-
-    plt.tight_layout()
-    plt.show()
-
-
-# Radar por Pais 
-
-df_radar = pd.concat([
-    all_country_reports["PARAGUAY_DEPTO"], # departamentos de paraguay
-    all_country_reports["URUGUAY_DEPTO"], # departamentos de uruguay
-    all_country_reports["BRASIL_ESTADO"], # estados de Brasil
-    all_country_reports["ARGENTINA_PROV"] # Provincias de Argentina
-], ignore_index=True)
-
-
-paises_base = ["PARAGUAY", "URUGUAY", "BRASIL", "ARGENTINA"]
-variables_bio_names = ['BIO1', 'BIO5', 'BIO14', 'BIO15']
-categorias_zscore = ['z_bio1', 'z_bio5', 'z_bio14', 'z_bio15']
-
-print("\nGenerando radar de Z-score por pais...")
-for pais in paises_base:
-    df_pais = df_radar[df_radar['PAIS_KEY'] == pais].copy()
-    
-    if not df_pais.empty:
-        nivel = df_pais['NIVEL_ADM'].iloc[0]
-        nombre_completo = f"{pais} ({nivel})"
-        
-        radar_comparativo_por_pais(df_pais, categorias_zscore, variables_bio_names, nombre_completo)
-
-print("Proceso COMPLETADO")
\ No newline at end of file
+    mean_global = acumulador_global.media()
+    std_global = acumulador_global.std()
+
+    # Normalizacion Z-Score
+    normalized_rasters_paths = {
+        name: os.path.join(OUTPUT_DIR, f"Z_{name}.tif") for name in delta_rasters_paths
+    }
+    tareas = {
+        name: (
+            delta_path, normalized_rasters_paths[name], mean_global, std_global, args.perfil, cache
+        )
+        for name, delta_path in delta_rasters_paths.items()
+    }
+    for name, resultado in ejecuta_tareas(normaliza_z, tareas, workers=workers).items():
+        resultados[('z', name)] = resultado
+        if not resultado.ok:
+            print(f"ERROR al normalizar {name}: {resultado.error}")
+            normalized_rasters_paths.pop(name)
+
+    # Calculo de los indices compuestos (SUMA DIRECTA, SIN INVERSION de BIO_14):
+    # INDICE_IMPACTO_AGREGADO = Z_BIO1 + Z_BIO5 + Z_BIO14 + Z_BIO15, I_estress_termico,
+    # I_estress_hidrico y los definidos en --indices, todos en una sola pasada
+    print("\nCalculando indices compuestos...")
+    indices = dict(INDICES)
+    if indices_path is not None:
+        indices.update(lee_indices(indices_path))
+    indices_paths = calcula_indices(
+        normalized_rasters_paths,
+        {indice: os.path.join(OUTPUT_DIR, f"{indice}.tif") for indice in indices},
+        NODATA_VAL_OUT,
+        indices=indices,
+        perfil=args.perfil,
+        cache=cache,
+    )
+    impacto_agregado_path = indices_paths["INDICE_IMPACTO_AGREGADO"]
+    print(f"Indice de impacto agregado creado: {impacto_agregado_path}")
+
+
+    ## -----------------------------------------------------------
+    ## PARTE B: ANALISIS ZONAL Y CALCULO DE INDICES COMPUESTOS
+    ## -----------------------------------------------------------
+
+    print("Realizando Analisis Zonal y calculo de indices")
+
+    rasters_to_analyze = {
+        'delta_BIO1': delta_rasters_paths['BIO1'], 'delta_BIO5': delta_rasters_paths['BIO5'],
+        'delta_BIO14': delta_rasters_paths['BIO14'], 'delta_BIO15': delta_rasters_paths['BIO15'],
+        'z_BIO1': normalized_rasters_paths['BIO1'], 'z_BIO5': normalized_rasters_paths['BIO5'],
+        'z_BIO14': normalized_rasters_paths['BIO14'], 'z_BIO15': normalized_rasters_paths['BIO15'],
+        'Indice_consolidado_RASTER': impacto_agregado_path # Nombre temporal para evitar conflicto
+    }
+
+    all_country_reports = {} 
+
+    # Indice de zonas: cada capa se rasteriza una sola vez sobre la grilla de los deltas
+    # y se guarda como GeoTIFF de etiquetas reutilizable entre corridas
+    ZONAS_DIR = os.path.join(OUTPUT_DIR, "ZONAS/")
+    capas_zonales = {}
+    capas_gdf = {}
+
+    for country_key, settings in VECTOR_PATHS.items():
+
+        if "layer" in settings:
+            area_estudio = gpd.read_file(settings['path'], layer=settings['layer'])
+        else:
+            area_estudio = gpd.read_file(settings['path'])
+
+        key_field = settings['field']
+
+        if key_field not in area_estudio.columns:
+            area_estudio['NOMBRE_ZONA'] = area_estudio.index
+        else:
+            area_estudio['NOMBRE_ZONA'] = area_estudio[key_field].astype(str).str.title()
+
+        capas_gdf[country_key] = area_estudio
+        if 'agrega' in settings:
+            continue
+        if not args.cobertura:
+            indice = indice_zonas(
+                area_estudio.geometry, delta_rasters_paths['BIO1'], country_key,
+                cache_dir=ZONAS_DIR, origen=settings['path']
+            )
+            capas_zonales[country_key] = (indice, len(area_estudio))
+
+    # Solo las capas base se cruzan con los rasters; el resto se agrega despues
+    capas_base = {k: gdf for k, gdf in capas_gdf.items() if 'agrega' not in VECTOR_PATHS[k]}
+
+    if args.cobertura:
+        # Cada pixel pesa por la fraccion de su area dentro de la zona (exacto en los bordes)
+        estadisticas, zonales = estadisticas_por_cobertura(
+            capas_base, delta_rasters_paths['BIO1'], ZONAS_DIR, rasters_to_analyze, cache, workers
+        )
+    else:
+        estadisticas, zonales = estadisticas_por_etiquetas(
+            capas_base, capas_zonales, delta_rasters_paths['BIO1'], rasters_to_analyze, cache, workers
+        )
+    resultados.update({('zonal', clave): resultado for clave, resultado in zonales.items()})
+
+    agregadas, zonas_agregadas = agrega_niveles(estadisticas, capas_gdf)
+    estadisticas.update(agregadas)
+    zonas_reporte = {
+        country_key: (
+            area_estudio['NOMBRE_ZONA'].to_numpy(), country_key.split('_')[0], VECTOR_PATHS[country_key]['nivel']
+        )
+        for country_key, area_estudio in capas_gdf.items()
+    }
+    zonas_reporte.update(zonas_agregadas)
+
+    for country_key, (nombres, pais_key, nivel) in zonas_reporte.items():
+        if country_key not in estadisticas:
+            continue
+
+        zonal_results = {}
+        for stat_name, st in estadisticas[country_key].items():
+            zonal_results[f'{stat_name}_mean'] = st.media()[1:]
+            zonal_results[f'{stat_name}_min'] = st.min()[1:]
+            zonal_results[f'{stat_name}_max'] = st.max()[1:]
+
+        zonal_results['NOMBRE_ZONA'] = nombres
+        zonal_results['CAPA'] = country_key
+        zonal_results['PAIS_KEY'] = pais_key
+        zonal_results['NIVEL_ADM'] = nivel
+        # Pais y area de estudio agregan zonas ya rankeadas: solo van a su hoja
+        zonal_results['AGREGADO'] = country_key in zonas_agregadas
+
+        df_zonal = pd.DataFrame(zonal_results)
+
+        # CALCULO DE INDICES COMPUESTOS (SUMA DIRECTA - SIN INVERSION BIO_14)
+        df_zonal['I_estress_termico'] = df_zonal['z_BIO1_mean'] + df_zonal['z_BIO5_mean']
+        df_zonal['I_estress_hidrico'] = df_zonal['z_BIO14_mean'] + df_zonal['z_BIO15_mean']
+
+        # Indice Consolidado = Z_BIO1 + Z_BIO5 + Z_BIO14 + Z_BIO15 (Suma directa)
+        df_zonal['Indice_consolidado'] = df_zonal['z_BIO1_mean'] + df_zonal['z_BIO5_mean'] + df_zonal['z_BIO14_mean'] + df_zonal['z_BIO15_mean']
+
+        # Usamos el calculado directamente, no la media zonal del raster agregado
+        df_zonal.drop(columns=['Indice_consolidado_RASTER_mean', 'Indice_consolidado_RASTER_min', 'Indice_consolidado_RASTER_max'], inplace=True)
+
+        # Renombrar columnas para el formato del Excel/Radar
+        df_zonal.rename(columns={
+            'delta_BIO1_mean': 'delta_BIO1', 'delta_BIO5_mean': 'delta_BIO5',
+            'delta_BIO14_mean': 'delta_BIO14', 'delta_BIO15_mean': 'delta_BIO15',
+            'z_BIO1_mean': 'z_bio1', 'z_BIO5_mean': 'z_bio5',
+            'z_BIO14_mean': 'z_bio14', 'z_BIO15_mean': 'z_bio15'
+        }, inplace=True)
+
+        all_country_reports[country_key] = df_zonal
+
+
+    ## -----------------------------------------------------------
+    ## PARTE C: GENERAR EXCEL Y RADAR
+    ## -----------------------------------------------------------
+
+    print("Generando Excel y Radar...")
+
+    # Una sola tabla con todas las capas: el ranking, las hojas por capa y los
+    # radares se calculan sobre ella de forma vectorizada (reporte.py)
+    tabla_zonal = pd.concat(all_country_reports.values(), ignore_index=True)
+    escribe_tabla(tabla_zonal, OUTPUT_TABLA)
+    print(f"Tabla zonal generada: {OUTPUT_TABLA}")
+
+    _, radares = genera_reporte(tabla_zonal, OUTPUT_EXCEL, RADAR_DIR, workers=workers)
+    resultados.update({('radar', pais): resultado for pais, resultado in radares.items()})
+
+    print("Proceso COMPLETADO")
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
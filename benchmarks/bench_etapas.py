@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+from benchmarks.fixtures import genera_fixture  # noqa: E402
+
+# Suite de benchmarks por etapa sobre fixtures sinteticas (benchmarks/fixtures.py).
+# Cada etapa corre en su propio proceso dentro del directorio de la fixture: el
+# tiempo es de pared y el RSS pico es el del proceso de la etapa (os.wait4).
+# Los resultados se agregan a un historial JSONL y se comparan con la corrida
+# anterior de la misma maquina y configuracion para detectar regresiones.
+HISTORIAL_PATH = REPO.joinpath("benchmarks", "historial.jsonl")
+UMBRAL = 0.2
+
+ETAPAS = {
+    "extraccion": "Organizacion.py",
+    "recorte": "recorte.py",
+    "alineacion": "Alineacion.py",
+    "analisis": "analisis.py",
+    "reporte_zonal": None,
+}
+# Pasos de analisis.py que se informan por separado (spans "paso" de la instrumentacion)
+PASOS_ANALISIS = {"delta": "delta_estadisticas", "z_score": "z_score"}
+
+
+def _ejecuta(cmd, cwd, log):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO), os.environ.get("PYTHONPATH", "")]))
+    inicio = time.perf_counter()
+    with open(log, "w") as salida:
+        proceso = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=salida, stderr=subprocess.STDOUT)
+        _, estado, uso = os.wait4(proceso.pid, 0)
+    segundos = time.perf_counter() - inicio
+    codigo = os.waitstatus_to_exitcode(estado)
+    # Las etapas informan los errores por tarea sin cortar la corrida: un tiempo
+    # medido con tareas fallidas no sirve para comparar
+    if codigo != 0 or "ERROR al" in Path(log).read_text():
+        raise RuntimeError(f"{' '.join(map(str, cmd))} fallo (codigo {codigo}, ver {log})")
+    divisor = 2**20 if sys.platform == "darwin" else 2**10
+    return segundos, uso.ru_maxrss / divisor
+
+
+def reporte_zonal():
+    # Nucleo del reporte de analisis_sin_invertir.py sobre la fixture: indice de
+    # zonas + estadisticas de todas las zonas para los DELTA_ y Z_ en una pasada
+    import geopandas as gpd
+
+    from analisis import BIOS, OUTPUT_PATH, VECTOR_PATH
+    from zonas import estadisticas_multicapa, indice_zonas
+
+    zonas = gpd.read_file(VECTOR_PATH)
+    rasters = {}
+    for bio_idx in BIOS:
+        rasters[f"delta_{bio_idx}"] = OUTPUT_PATH.joinpath(f"DELTA_bio_{bio_idx}.tif")
+        rasters[f"z_{bio_idx}"] = OUTPUT_PATH.joinpath(f"Z_bio_{bio_idx}.tif")
+    indice = indice_zonas(zonas.geometry, rasters["delta_1"], "BENCH")
+    estadisticas_multicapa({"BENCH": (indice, len(zonas))}, rasters, -9999)
+
+
+def corre_suite(lado, n_zonas, workers=1, bandas_futuro=19, directorio=None, conservar=False):
+    directorio = Path(directorio or tempfile.mkdtemp(prefix="bench_hotspots_"))
+    directorio.mkdir(parents=True, exist_ok=True)
+    resultados = {}
+    try:
+        inicio = time.perf_counter()
+        genera_fixture(directorio, lado, n_zonas, bandas_futuro)
+        resultados["fixture"] = {"segundos": time.perf_counter() - inicio}
+
+        for etapa, script in ETAPAS.items():
+            reporte = directorio.joinpath(f"rendimiento_{etapa}.json")
+            if script is None:
+                cmd = [sys.executable, __file__, "--reporte-zonal"]
+            else:
+                cmd = [
+                    sys.executable,
+                    REPO.joinpath(script),
+                    "--workers",
+                    str(workers),
+                    "--reporte-rendimiento",
+                    reporte,
+                ]
+            segundos, rss = _ejecuta(cmd, directorio, directorio.joinpath(f"{etapa}.log"))
+            resultados[etapa] = {
+                "segundos": segundos,
+                "rss_pico_mb": rss,
+                "mpix_s": lado * lado / 1e6 / segundos,
+            }
+            print(f"  {etapa:<20}{segundos:>9.2f} s{rss:>9.0f} MB")
+
+            if etapa == "analisis":
+                filas = json.loads(reporte.read_text())["filas"]
+                for paso, nombre in PASOS_ANALISIS.items():
+                    # Suma sobre los BIO (en paralelo con --workers puede superar al total)
+                    suma = sum(f["total_s"] for f in filas if f["categoria"] == "paso" and f["nombre"] == paso)
+                    resultados[nombre] = {"segundos": suma, "mpix_s": lado * lado / 1e6 / suma if suma else None}
+    finally:
+        if not conservar:
+            shutil.rmtree(directorio, ignore_errors=True)
+    return resultados
+
+
+def maquina():
+    return {
+        "nodo": platform.node(),
+        "sistema": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def commit_actual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lee_historial(path=HISTORIAL_PATH):
+    if not Path(path).exists():
+        return []
+    with open(path) as f:
+        return [json.loads(linea) for linea in f if linea.strip()]
+
+
+def compara(registro, historial, umbral=UMBRAL):
+    # Regresiones frente a la ultima corrida de la misma maquina y configuracion
+    previos = [
+        r
+        for r in historial
+        if r["maquina"]["nodo"] == registro["maquina"]["nodo"]
+        and r["parametros"] == registro["parametros"]
+    ]
+    if not previos:
+        return []
+    anterior = previos[-1]["etapas"]
+    regresiones = []
+    for etapa, actual in registro["etapas"].items():
+        previo = anterior.get(etapa)
+        if not previo:
+            continue
+        if actual.get("mpix_s") and previo.get("mpix_s") and actual["mpix_s"] < previo["mpix_s"] * (1 - umbral):
+            regresiones.append(f"{etapa}: {previo['mpix_s']:.2f} -> {actual['mpix_s']:.2f} Mpix/s")
+        if actual.get("rss_pico_mb") and previo.get("rss_pico_mb") and actual["rss_pico_mb"] > previo["rss_pico_mb"] * (1 + umbral):
+            regresiones.append(f"{etapa}: RSS {previo['rss_pico_mb']:.0f} -> {actual['rss_pico_mb']:.0f} MB")
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks por etapa sobre fixtures sinteticas tipo WorldClim"
+    )
+    parser.add_argument("--lados", type=int, nargs="+", default=[1024], help="pixeles por lado (p. ej. 1024 4096 40000)")
+    parser.add_argument("--zonas", type=int, nargs="+", default=[10], help="cantidad de zonas (p. ej. 10 5000)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--bandas-futuro", type=int, default=19)
+    parser.add_argument("--historial", type=Path, default=HISTORIAL_PATH)
+    parser.add_argument("--umbral", type=float, default=UMBRAL, help="caida de throughput / aumento de RSS tolerado")
+    parser.add_argument("--estricto", action="store_true", help="sale con codigo 1 si hay regresiones")
+    parser.add_argument("--directorio", type=Path, help="directorio de la fixture (por defecto temporal)")
+    parser.add_argument("--conservar", action="store_true", help="no borra la fixture al terminar")
+    parser.add_argument("--reporte-zonal", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.reporte_zonal:
+        reporte_zonal()
+        return
+
+    historial = lee_historial(args.historial)
+    hay_regresiones = False
+    for lado in args.lados:
+        for n_zonas in args.zonas:
+            print(f"Fixture {lado}x{lado}, {n_zonas} zonas, {args.workers} workers")
+            registro = {
+                "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "commit": commit_actual(),
+                "maquina": maquina(),
+                "parametros": {
+                    "lado": lado,
+                    "zonas": n_zonas,
+                    "workers": args.workers,
+                    "bandas_futuro": args.bandas_futuro,
+                },
+                "etapas": corre_suite(
+                    lado,
+                    n_zonas,
+                    args.workers,
+                    args.bandas_futuro,
+                    args.directorio.joinpath(f"{lado}_{n_zonas}") if args.directorio else None,
+                    args.conservar,
+                ),
+            }
+            for regresion in compara(registro, historial, args.umbral):
+                hay_regresiones = True
+                print(f"  REGRESION {regresion}")
+
+            args.historial.parent.mkdir(parents=True, exist_ok=True)
+            with open(args.historial, "a") as f:
+                f.write(json.dumps(registro) + "\n")
+            historial.append(registro)
+
+    print(f"Historial: {args.historial}")
+    if hay_regresiones and args.estricto:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
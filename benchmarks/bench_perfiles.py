@@ -0,0 +1,97 @@
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import rasterio
+from rasterio.windows import Window
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bloques import procesa_bloques, ventanas_grilla  # noqa: E402
+from perfiles import PERFILES, aplica_perfil  # noqa: E402
+
+# Compara los perfiles de salida sobre un raster derivado existente:
+# tamaño en disco, lectura completa, lectura de una ventana de 512x512 y
+# lectura decimada (la que hace un visor a bajo zoom, servida por las overviews).
+DECIMACION = 16
+REPETICIONES = 3
+
+
+def _cronometra(funcion):
+    mejor = None
+    for _ in range(REPETICIONES):
+        t0 = time.perf_counter()
+        funcion()
+        dt = time.perf_counter() - t0
+        mejor = dt if mejor is None else min(mejor, dt)
+    return mejor
+
+
+def escribe_perfil(raster_in, salida, perfil):
+    with rasterio.open(raster_in) as src:
+        profile = src.profile.copy()
+    profile = aplica_perfil(profile, perfil)
+
+    t0 = time.perf_counter()
+    procesa_bloques(
+        {"b": (raster_in, 1)},
+        lambda window, datos: {"b": datos["b"]},
+        salidas={"b": (salida, profile)},
+        ventanas=ventanas_grilla(profile["height"], profile["width"], 512),
+    )
+    return time.perf_counter() - t0
+
+
+def mide_lectura(path):
+    with rasterio.open(path) as src:
+        alto, ancho = src.height, src.width
+        centro = Window(max(ancho // 2 - 256, 0), max(alto // 2 - 256, 0), min(512, ancho), min(512, alto))
+        forma = (max(alto // DECIMACION, 1), max(ancho // DECIMACION, 1))
+        return {
+            "overviews": len(src.overviews(1)),
+            "lectura_completa_s": _cronometra(lambda: src.read(1)),
+            "lectura_ventana_s": _cronometra(lambda: src.read(1, window=centro)),
+            "lectura_decimada_s": _cronometra(lambda: src.read(1, out_shape=forma)),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tamaño y latencia de lectura de cada perfil de salida (perfiles.py)"
+    )
+    parser.add_argument("raster", type=Path, help="raster derivado de una banda (p. ej. Z_bio_1.tif)")
+    parser.add_argument("--perfiles", nargs="+", choices=PERFILES, default=PERFILES)
+    parser.add_argument("--json", type=Path, help="guarda los resultados en JSON")
+    args = parser.parse_args(argv)
+
+    resultados = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for perfil in args.perfiles:
+            salida = Path(tmp).joinpath(f"{perfil}.tif")
+            escritura = escribe_perfil(args.raster, salida, perfil)
+            resultados[perfil] = {
+                "bytes": salida.stat().st_size,
+                "escritura_s": escritura,
+                **mide_lectura(salida),
+            }
+
+    base = resultados[args.perfiles[0]]
+    print(f"{'perfil':<10}{'MB':>9}{'x tam':>7}{'ovr':>5}{'escr s':>9}{'compl s':>9}{'512 s':>9}{f'1/{DECIMACION} s':>9}")
+    for perfil, r in resultados.items():
+        print(
+            f"{perfil:<10}{r['bytes'] / 1e6:>9.2f}{r['bytes'] / base['bytes']:>7.2f}{r['overviews']:>5}"
+            f"{r['escritura_s']:>9.3f}{r['lectura_completa_s']:>9.4f}"
+            f"{r['lectura_ventana_s']:>9.4f}{r['lectura_decimada_s']:>9.4f}"
+        )
+
+    if args.json:
+        args.json.write_text(json.dumps({"raster": str(args.raster), "perfiles": resultados}, indent=2))
+        print(f"Resultados guardados en {args.json}")
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
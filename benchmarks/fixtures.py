@@ -0,0 +1,163 @@
+import argparse
+import math
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely import affinity
+from shapely.geometry import Point, box
+
+# Fixtures sinteticas con la estructura de WorldClim v2.1 a 30s, generadas
+# localmente y por ventanas (la memoria no depende del tamaño):
+# - RASTER/originales/wc2.1_30s_bio/wc2.1_30s_bio_{n}.tif (historicos)
+# - RASTER/originales/wc2.1_30s_bioc_<GCM>_<SSP>_<PERIODO>.tif (futuro multibanda)
+# - VECTOR/Area_Estudio/Area_Estudio.shp con N zonas sobre un "continente"
+# El fondo fuera del continente es oceano (nodata), como en la extension de Sudamerica.
+NODATA_WORLDCLIM = -3.4e38
+RESOLUCION = 1 / 120
+ORIGEN = (-82.0, 13.0)
+BIOS_HISTORICOS = [1, 5, 14, 15]
+TAM_BLOQUE = 512
+
+
+def _tierra(y, x):
+    # Continente eliptico ocupando ~60% de la extension
+    return ((x - 0.55) / 0.42) ** 2 + ((y - 0.5) / 0.49) ** 2 <= 1
+
+
+def _campo(y, x, banda, rng):
+    # Gradiente latitudinal + ondas por banda + ruido: valores suaves como los BIO
+    base = 25 - 20 * y + 3 * np.sin(6 * x + banda) + banda
+    return (base + rng.normal(0, 0.5, base.shape)).astype("float32")
+
+
+def _cambio(y, x, banda, rng):
+    return (1 + 2 * y + 0.5 * np.cos(4 * x + banda) + rng.normal(0, 0.2, y.shape)).astype("float32")
+
+
+def _ventanas(lado):
+    for fila in range(0, lado, TAM_BLOQUE):
+        for col in range(0, lado, TAM_BLOQUE):
+            yield Window(col, fila, min(TAM_BLOQUE, lado - col), min(TAM_BLOQUE, lado - fila))
+
+
+def _coordenadas(window, lado):
+    filas = np.arange(window.row_off, window.row_off + window.height)
+    cols = np.arange(window.col_off, window.col_off + window.width)
+    return (filas[:, None] + 0.5) / lado, (cols[None, :] + 0.5) / lado
+
+
+def _perfil(lado, count, transform):
+    return {
+        "driver": "GTiff",
+        "height": lado,
+        "width": lado,
+        "count": count,
+        "dtype": "float32",
+        "crs": "EPSG:4326",
+        "transform": transform,
+        "nodata": NODATA_WORLDCLIM,
+        "tiled": True,
+        "blockxsize": TAM_BLOQUE,
+        "blockysize": TAM_BLOQUE,
+        "compress": "lzw",
+        "BIGTIFF": "IF_SAFER",
+    }
+
+
+def genera_rasters(directorio, lado, bandas_futuro=19, semilla=0, desalinear=True,
+                   gcm="IPSL-CM6A-LR", ssp="ssp585", periodo="2021-2040"):
+    # Con desalinear, el futuro se corre medio pixel: el recorte del futuro queda
+    # en otra grilla y Alineacion.py tiene trabajo real
+    originales = Path(directorio, "RASTER", "originales")
+    originales.joinpath("wc2.1_30s_bio").mkdir(parents=True, exist_ok=True)
+    transform = from_origin(*ORIGEN, RESOLUCION, RESOLUCION)
+    corrimiento = RESOLUCION / 2 if desalinear else 0.0
+    transform_fut = from_origin(ORIGEN[0] + corrimiento, ORIGEN[1] - corrimiento, RESOLUCION, RESOLUCION)
+
+    historicos = {
+        b: rasterio.open(
+            originales.joinpath("wc2.1_30s_bio", f"wc2.1_30s_bio_{b}.tif"), "w", **_perfil(lado, 1, transform)
+        )
+        for b in BIOS_HISTORICOS
+    }
+    futuro_path = originales.joinpath(f"wc2.1_30s_bioc_{gcm}_{ssp}_{periodo}.tif")
+    futuro = rasterio.open(futuro_path, "w", **_perfil(lado, bandas_futuro, transform_fut))
+    try:
+        for window in _ventanas(lado):
+            y, x = _coordenadas(window, lado)
+            oceano = ~_tierra(y, x)
+            rng = np.random.default_rng([semilla, int(window.row_off), int(window.col_off)])
+            pila = np.empty((bandas_futuro, int(window.height), int(window.width)), dtype="float32")
+            for b in range(1, bandas_futuro + 1):
+                hist = _campo(y, x, b, rng)
+                pila[b - 1] = hist + _cambio(y, x, b, rng)
+                pila[b - 1][oceano] = NODATA_WORLDCLIM
+                if b in historicos:
+                    hist[oceano] = NODATA_WORLDCLIM
+                    historicos[b].write(hist, 1, window=window)
+            futuro.write(pila, window=window)
+    finally:
+        for dst in historicos.values():
+            dst.close()
+        futuro.close()
+    return futuro_path
+
+
+def genera_zonas(directorio, lado, n_zonas):
+    # N zonas: celdas de una grilla regular recortadas al continente
+    x0, y1 = ORIGEN
+    ancho = lado * RESOLUCION
+    continente = affinity.scale(
+        Point(x0 + 0.55 * ancho, y1 - 0.5 * ancho).buffer(1, 256), 0.42 * ancho, 0.49 * ancho
+    )
+
+    k = math.ceil(math.sqrt(n_zonas * 1.7))
+    while True:
+        paso = ancho / k
+        celdas = (
+            box(x0 + i * paso, y1 - (j + 1) * paso, x0 + (i + 1) * paso, y1 - j * paso).intersection(continente)
+            for j in range(k)
+            for i in range(k)
+        )
+        zonas = [c for c in celdas if not c.is_empty and c.area > 0.05 * paso * paso]
+        if len(zonas) >= n_zonas:
+            break
+        k += 1
+
+    zonas = zonas[:n_zonas]
+    gdf = gpd.GeoDataFrame(
+        {"nombre": [f"zona_{i + 1}" for i in range(len(zonas))]}, geometry=zonas, crs="EPSG:4326"
+    )
+    salida = Path(directorio, "VECTOR", "Area_Estudio")
+    salida.mkdir(parents=True, exist_ok=True)
+    gdf.to_file(salida.joinpath("Area_Estudio.shp"))
+    return gdf
+
+
+def genera_fixture(directorio, lado, n_zonas, bandas_futuro=19, semilla=0, desalinear=True):
+    genera_rasters(directorio, lado, bandas_futuro, semilla, desalinear)
+    return genera_zonas(directorio, lado, n_zonas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera una fixture sintetica tipo WorldClim")
+    parser.add_argument("directorio", type=Path)
+    parser.add_argument("--lado", type=int, default=1024, help="pixeles por lado")
+    parser.add_argument("--zonas", type=int, default=10)
+    parser.add_argument("--bandas-futuro", type=int, default=19)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--alineado", action="store_true", help="futuro en la misma grilla que los historicos")
+    args = parser.parse_args(argv)
+
+    genera_fixture(
+        args.directorio, args.lado, args.zonas, args.bandas_futuro, args.semilla, not args.alineado
+    )
+    print(f"Fixture generada en {args.directorio} ({args.lado}x{args.lado}, {args.zonas} zonas)")
+
+
+if __name__ == "__main__":
+    main()
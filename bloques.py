@@ -0,0 +1,340 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import rasterio
+from rasterio.windows import Window
+
+from cuantizacion import TOLERANCIA, decodificador
+from instrumentacion import REGISTRO
+from perfiles import SalidaCOG, abre_salida
+
+# Valores por defecto del ejecutor por bloques
+HILOS = 4
+MULTIPLO_BLOQUE = 1
+# Ventanas leidas por adelantado (lookahead) y resultados en cola de escritura
+PROFUNDIDAD = 8
+COLA_ESCRITURA = 8
+
+_FIN = object()
+
+
+def ventanas_bloque(src, multiplo=MULTIPLO_BLOQUE, banda=1):
+    # Ventanas de (multiplo x multiplo) bloques nativos, en orden fila-columna.
+    # Con multiplo=1 coincide con src.block_windows(banda).
+    alto_bloque, ancho_bloque = src.block_shapes[banda - 1]
+    alto = alto_bloque * multiplo
+    ancho = min(ancho_bloque * multiplo, src.width)
+    for fila in range(0, src.height, alto):
+        for col in range(0, src.width, ancho):
+            yield Window(
+                col, fila, min(ancho, src.width - col), min(alto, src.height - fila)
+            )
+
+
+def ventanas_grilla(alto, ancho, tam, fila0=0, col0=0):
+    # Ventanas cuadradas de lado `tam` sobre una grilla de alto x ancho,
+    # desplazadas (fila0, col0) cuando la grilla es una sub-ventana de otra
+    for fila in range(0, alto, tam):
+        for col in range(0, ancho, tam):
+            yield Window(
+                col0 + col, fila0 + fila, min(tam, ancho - col), min(tam, alto - fila)
+            )
+
+
+def _etiqueta(window):
+    return f"{int(window.row_off)},{int(window.col_off)}"
+
+
+class _LectorPorHilo:
+    # Cada hilo lector abre sus propios datasets: un handle de GDAL
+    # no se puede leer desde varios hilos a la vez.
+
+    def __init__(self, entradas, tolerancia=TOLERANCIA, cache=None):
+        self.entradas = entradas
+        self.tolerancia = tolerancia
+        self.cache = cache
+        self.local = threading.local()
+        self.abiertos = []
+        self.lock = threading.Lock()
+
+    def lee(self, window):
+        if not REGISTRO.activo:
+            return self._lee(window)
+        inicio, t0 = time.time(), time.perf_counter()
+        datos = self._lee(window)
+        REGISTRO.evento(
+            "ventana", "lectura", inicio, time.perf_counter() - t0, ventana=_etiqueta(window)
+        )
+        REGISTRO.cuenta(leidos=sum(arr.nbytes for arr in datos.values()))
+        return datos
+
+    def _lee(self, window):
+        if self.cache is not None:
+            # Vistas del memmap ya decodificado: sin handles de GDAL ni copia
+            return {
+                nombre: self.cache.ventana(path, window, banda, self.tolerancia)
+                for nombre, (path, banda) in self.entradas.items()
+            }
+        fuentes = getattr(self.local, "fuentes", None)
+        if fuentes is None:
+            fuentes = {
+                nombre: rasterio.open(path) for nombre, (path, _) in self.entradas.items()
+            }
+            # Los rasters cuantizados (int16 + escala/offset) se leen ya decodificados
+            self.local.decodificadores = {
+                nombre: decodificador(src, self.tolerancia) for nombre, src in fuentes.items()
+            }
+            self.local.fuentes = fuentes
+            with self.lock:
+                self.abiertos.extend(fuentes.values())
+        datos = {}
+        for nombre, (_, banda) in self.entradas.items():
+            datos[nombre] = fuentes[nombre].read(banda, window=window)
+            decodifica = self.local.decodificadores[nombre]
+            if decodifica is not None:
+                datos[nombre] = decodifica(datos[nombre])
+        return datos
+
+    def cierra(self):
+        for src in self.abiertos:
+            src.close()
+
+
+class LecturaAnticipada:
+    # Iterador de (window, datos) que mantiene `profundidad` ventanas leyendose
+    # en `hilos` hilos mientras quien itera procesa la actual (GDAL libera el
+    # GIL al leer y decodificar). Con la instrumentacion activa registra cuanto
+    # espera el consumidor a cada ventana ("espera"/"lectura") y cuantas ya
+    # estaban listas: si la espera es alta con 0 listas, falta lookahead o hilos.
+
+    def __init__(self, lector, ventanas, hilos=HILOS, profundidad=PROFUNDIDAD):
+        self.lector = lector
+        self.ventanas = iter(ventanas)
+        self.profundidad = max(1, profundidad)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, hilos))
+        self.pendientes = deque()
+        for window in self.ventanas:
+            self._pide(window)
+            if len(self.pendientes) >= self.profundidad:
+                break
+
+    def _pide(self, window):
+        self.pendientes.append((window, self.pool.submit(self.lector.lee, window)))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pendientes:
+            raise StopIteration
+        window, futuro = self.pendientes.popleft()
+        if REGISTRO.activo:
+            listas = sum(f.done() for _, f in self.pendientes) + futuro.done()
+            inicio, t0 = time.time(), time.perf_counter()
+            datos = futuro.result()
+            REGISTRO.evento(
+                "espera", "lectura", inicio, time.perf_counter() - t0,
+                ventana=_etiqueta(window), listas=listas, profundidad=self.profundidad,
+            )
+        else:
+            datos = futuro.result()
+        siguiente = next(self.ventanas, None)
+        if siguiente is not None:
+            self._pide(siguiente)
+        return window, datos
+
+    def cierra(self):
+        for _, futuro in self.pendientes:
+            futuro.cancel()
+        self.pool.shutdown(wait=True)
+
+
+def _temporal(path):
+    # Junto al destino (mismo disco, os.replace atomico) y con su extension
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+
+
+class EscrituraDiferida:
+    # Unico hilo escritor con una cola acotada (write-behind): quien produce
+    # solo se bloquea si hay `profundidad` resultados sin escribir. Con la
+    # instrumentacion activa registra esos bloqueos ("espera"/"escritura").
+    # Cada salida se escribe en un temporal que cierra() renombra al destino si
+    # todo termino bien o borra si no: un error nunca deja un raster a medias.
+
+    def __init__(self, salidas, profundidad=COLA_ESCRITURA):
+        self.cola = queue.Queue(maxsize=max(1, profundidad))
+        self.errores = []
+        self.temporales = {path: _temporal(path) for path, _ in salidas.values()}
+        salidas = {
+            nombre: (self.temporales[path], profile) for nombre, (path, profile) in salidas.items()
+        }
+        self.hilo = threading.Thread(target=self._escribe, args=(salidas,))
+        self.hilo.start()
+
+    def escribe(self, window, resultados):
+        if not REGISTRO.activo:
+            self.cola.put((window, resultados))
+            return
+        en_cola = self.cola.qsize()
+        inicio, t0 = time.time(), time.perf_counter()
+        self.cola.put((window, resultados))
+        REGISTRO.evento(
+            "espera", "escritura", inicio, time.perf_counter() - t0,
+            ventana=_etiqueta(window), en_cola=en_cola,
+        )
+
+    def cierra(self, ok=True):
+        self.cola.put(_FIN)
+        self.hilo.join()
+        for path, tmp in self.temporales.items():
+            if ok and not self.errores:
+                os.replace(tmp, path)
+            elif tmp.exists():
+                tmp.unlink()
+
+    def _escribe(self, salidas):
+        # Recibe (window, {salida: array}) en orden y escribe
+        destinos = {}
+        try:
+            destinos = {
+                nombre: abre_salida(path, profile)
+                for nombre, (path, profile) in salidas.items()
+            }
+            while True:
+                item = self.cola.get()
+                if item is _FIN:
+                    break
+                window, resultados = item
+                inicio, t0 = time.time(), time.perf_counter()
+                for nombre, data in resultados.items():
+                    if data.ndim == 3:
+                        destinos[nombre].write(data, window=window)
+                    else:
+                        destinos[nombre].write(data, 1, window=window)
+                if REGISTRO.activo:
+                    REGISTRO.evento(
+                        "ventana", "escritura", inicio, time.perf_counter() - t0, ventana=_etiqueta(window)
+                    )
+                    REGISTRO.cuenta(escritos=sum(data.nbytes for data in resultados.values()))
+        except Exception as e:
+            self.errores.append(e)
+            # Vacia la cola para no bloquear al productor
+            while self.cola.get() is not _FIN:
+                pass
+        finally:
+            for nombre, dst in destinos.items():
+                # El cierre incluye el vaciado final y, en COG, la copia con overviews
+                inicio, t0 = time.time(), time.perf_counter()
+                if isinstance(dst, SalidaCOG):
+                    # Si la escritura fallo no se arma el COG de un raster a medias
+                    dst.close(copia=not self.errores)
+                else:
+                    dst.close()
+                if REGISTRO.activo:
+                    REGISTRO.evento("salida", "cierre", inicio, time.perf_counter() - t0, salida=str(nombre))
+
+
+def procesa_bloques(
+    entradas,
+    kernel,
+    salidas=None,
+    ventanas=None,
+    hilos=HILOS,
+    multiplo=MULTIPLO_BLOQUE,
+    profundidad=PROFUNDIDAD,
+    ventana_salida=None,
+    tolerancia=TOLERANCIA,
+    cache=None,
+    cola_escritura=COLA_ESCRITURA,
+):
+    # Ejecutor por bloques reutilizable:
+    # - entradas: {nombre: (ruta, banda)}, todas sobre la misma grilla; banda puede ser
+    #   una lista de bandas (el array leido es 3D y se escribe en todas las bandas)
+    # - kernel(window, datos) -> {salida: array} (o None); corre en el hilo que llama,
+    #   en el orden de las ventanas, por lo que puede acumular estado
+    # - salidas: {salida: (ruta, profile)}, escritas por un unico hilo escritor;
+    #   el profile puede venir de perfiles.aplica_perfil (incluido COG)
+    # - ventana_salida(window): ventana de escritura cuando la grilla de salida es
+    #   distinta de la de entrada (p. ej. un recorte); por defecto la misma ventana
+    # - tolerancia: error de cuantizacion maximo aceptado en las entradas int16
+    #   con escala/offset, que se leen ya decodificadas (ver cuantizacion.py)
+    # - cache: cache.CacheRaster opcional; las entradas se leen de su memmap
+    # La lectura se reparte en `hilos` hilos con `profundidad` ventanas por
+    # adelantado (LecturaAnticipada) y la escritura va detras con hasta
+    # `cola_escritura` resultados en cola (EscrituraDiferida): lectura, kernel y
+    # escritura se solapan y la memoria queda acotada por las dos profundidades.
+    salidas = salidas or {}
+    if ventanas is None:
+        primera = next(iter(entradas.values()))[0]
+        with rasterio.open(primera) as src:
+            ventanas = list(ventanas_bloque(src, multiplo))
+
+    lector = _LectorPorHilo(entradas, tolerancia, cache)
+    escritura = EscrituraDiferida(salidas, cola_escritura)
+    lectura = None
+    ok = False
+    try:
+        lectura = LecturaAnticipada(lector, ventanas, hilos, profundidad)
+        for window, datos in lectura:
+            inicio, t0 = time.time(), time.perf_counter()
+            resultados = kernel(window, datos)
+            if REGISTRO.activo:
+                REGISTRO.evento(
+                    "ventana", "kernel", inicio, time.perf_counter() - t0, ventana=_etiqueta(window)
+                )
+            if escritura.errores:
+                break
+            if resultados:
+                if ventana_salida is not None:
+                    window = ventana_salida(window)
+                escritura.escribe(window, resultados)
+        ok = True
+    finally:
+        if lectura is not None:
+            lectura.cierra()
+        # Sin ok (error de lectura o del kernel) las salidas temporales se descartan
+        escritura.cierra(ok)
+        lector.cierra()
+
+    if escritura.errores:
+        raise escritura.errores[0]
+
+
+def agrega_argumentos_bloques(parser):
+    parser.add_argument(
+        "--hilos",
+        type=int,
+        default=HILOS,
+        help="hilos de lectura por raster en el procesamiento por bloques",
+    )
+    parser.add_argument(
+        "--multiplo-bloque",
+        type=int,
+        default=MULTIPLO_BLOQUE,
+        help="tamaño de ventana en múltiplos del bloque nativo",
+    )
+    return parser
+
+
+def agrega_argumentos_anticipacion(parser):
+    # Lookahead de lectura y cola de escritura de procesa_bloques; se ajustan
+    # con los eventos "espera" del reporte de rendimiento
+    parser.add_argument(
+        "--profundidad",
+        type=int,
+        default=PROFUNDIDAD,
+        help="ventanas leidas por adelantado mientras se procesa la actual",
+    )
+    parser.add_argument(
+        "--cola-escritura",
+        type=int,
+        default=COLA_ESCRITURA,
+        help="resultados en espera de escritura antes de frenar el procesamiento",
+    )
+    return parser
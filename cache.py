@@ -0,0 +1,152 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from cuantizacion import TOLERANCIA, decodificador, error_cuantizacion, verifica_tolerancia
+from firmas import firma_archivo
+
+# Cache opcional de rasters decodificados: cada banda se decodifica una sola vez
+# a un .npy sin compresion y las lecturas siguientes son vistas de un memmap
+# (sin copia ni descompresion). La clave es la firma del archivo (mtime + tamaño,
+# o SHA-1 del contenido), de modo que un raster modificado se vuelve a decodificar.
+# El espacio en disco se acota con un presupuesto y desalojo LRU (mtime = ultimo uso).
+CACHE_DIR = Path("./RASTER/cache/")
+PRESUPUESTO_MB = 4096
+
+
+class CacheRaster:
+    def __init__(self, directorio=CACHE_DIR, presupuesto_mb=PRESUPUESTO_MB, contenido=False):
+        self.directorio = Path(directorio)
+        self.presupuesto = int(presupuesto_mb * 2**20)
+        self.contenido = contenido
+        self._abiertos = {}
+        self._rutas = {}
+        # Error de cuantizacion declarado por cada raster del cache (None si no
+        # esta cuantizado): la tolerancia de quien lee se verifica en cada acceso
+        self._errores = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Los memmaps abiertos y el lock no viajan a los procesos del pool
+        estado = self.__dict__.copy()
+        estado.update(_abiertos={}, _lock=None)
+        return estado
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self._lock = threading.Lock()
+
+    def _ruta(self, path, banda):
+        # La clave se calcula una vez por (path, banda) y se reutiliza en cada
+        # ventana; solo se recalcula (SHA-1 incluido con contenido=True) si
+        # cambia el mtime + tamaño del archivo
+        estado = firma_archivo(path)
+        memo = self._rutas.get((path, banda))
+        if memo is not None and memo[0] == estado:
+            return memo[1]
+        origen = hashlib.sha1(f"{Path(path).resolve()}|{banda}".encode()).hexdigest()[:16]
+        firma = estado if not self.contenido else firma_archivo(path, True)
+        firma = hashlib.sha1(firma.encode()).hexdigest()[:16]
+        ruta = self.directorio.joinpath(f"{origen}_{firma}.npy")
+        self._rutas[(path, banda)] = (estado, ruta)
+        return ruta
+
+    def arreglo(self, path, banda=1, tolerancia=TOLERANCIA):
+        # memmap de solo lectura (alto, ancho) con la banda ya decodificada.
+        # Como en la lectura directa, un raster cuantizado con un error declarado
+        # mayor que `tolerancia` falla (el array decodificado no depende de ella)
+        ruta = self._ruta(path, banda)
+        arr = self._abiertos.get(ruta)
+        if arr is None:
+            with self._lock:
+                if ruta not in self._abiertos:
+                    with rasterio.open(path) as src:
+                        self._errores[ruta] = error_cuantizacion(src)
+                    verifica_tolerancia(path, self._errores[ruta], tolerancia)
+                    if ruta.exists():
+                        os.utime(ruta)
+                    else:
+                        self._decodifica(path, banda, ruta)
+                    self._abiertos[ruta] = np.load(ruta, mmap_mode="r")
+            arr = self._abiertos[ruta]
+        verifica_tolerancia(path, self._errores[ruta], tolerancia)
+        return arr
+
+    def ventana(self, path, window, banda=1, tolerancia=TOLERANCIA):
+        # Vista sin copia de una ventana; con una lista de bandas, array 3D
+        if isinstance(banda, (list, tuple)):
+            return np.stack([self.ventana(path, window, b, tolerancia) for b in banda])
+        return self.arreglo(path, banda, tolerancia)[window.toslices()]
+
+    def _decodifica(self, path, banda, ruta):
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        origen = ruta.stem.split("_")[0]
+        # Versiones anteriores del mismo raster (otra firma) ya no sirven
+        for viejo in self.directorio.glob(f"{origen}_*.npy"):
+            _elimina(viejo)
+
+        with rasterio.open(path) as src:
+            # La tolerancia ya se verifico en arreglo()
+            decodifica = decodificador(src, tolerancia=None)
+            dtype = np.dtype("float32" if decodifica is not None else src.dtypes[banda - 1])
+            self._libera(src.height * src.width * dtype.itemsize)
+
+            # Se escribe a un temporal y se renombra: otro proceso nunca ve un .npy a medias
+            tmp = ruta.with_name(f"{ruta.stem}.{os.getpid()}.tmp")
+            arr = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=src.shape)
+            for _, window in src.block_windows(banda):
+                datos = src.read(banda, window=window)
+                arr[window.toslices()] = datos if decodifica is None else decodifica(datos)
+            arr.flush()
+            del arr
+        os.replace(tmp, ruta)
+
+    def _libera(self, necesarios):
+        # Desaloja los menos usados hasta que entre el nuevo raster
+        archivos = []
+        for p in self.directorio.glob("*.npy"):
+            try:
+                archivos.append((p.stat().st_mtime, p.stat().st_size, p))
+            except FileNotFoundError:
+                pass
+        archivos.sort()
+        total = sum(tam for _, tam, _ in archivos)
+        for _, tam, p in archivos:
+            if total + necesarios <= self.presupuesto:
+                break
+            _elimina(p)
+            total -= tam
+
+
+def _elimina(path):
+    # Un memmap abierto sigue siendo valido tras borrar el archivo (POSIX)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def agrega_argumentos_cache(parser):
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="decodifica cada raster una vez a un memmap .npy y reutiliza sus ventanas",
+    )
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR)
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        default=PRESUPUESTO_MB,
+        help="presupuesto de disco del cache (MB); se desalojan los menos usados",
+    )
+    return parser
+
+
+def cache_de_args(args):
+    if not args.cache:
+        return None
+    return CacheRaster(args.cache_dir, args.cache_mb)
@@ -0,0 +1,219 @@
+import os
+import time
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.windows import Window
+
+from bloques import ventanas_grilla
+from cuantizacion import decodificador
+from instrumentacion import REGISTRO
+from zonas import EstadisticasZonales, IndiceEspacial, ruta_cache_zonas
+
+# Motor zonal por fraccion de cobertura exacta: cada zona pesa cada pixel por la
+# fraccion de su area que cae dentro del poligono (1 en el interior, la
+# interseccion exacta en el borde). La relacion zona/pixel se calcula una vez
+# por capa y grilla y se guarda como matriz dispersa CSR (zonas x pixeles) en un
+# .npz; las estadisticas de cualquier raster son productos matriz-vector.
+# Sin dependencia de scipy: el producto es un np.bincount sobre las entradas.
+TAM_VENTANA = 512
+# Fracciones menores son ruido de redondeo de bordes que coinciden con los de
+# los pixeles: no se guardan (no deben aportar al min / max de la zona)
+FRACCION_MINIMA = 1e-6
+
+
+class MatrizCobertura:
+    # CSR: las entradas de la zona i (0..N-1) son indices[indptr[i]:indptr[i+1]]
+    # (pixel plano fila * ancho + col) con pesos data[...] en (0, 1].
+    # `orden` recorre las entradas por pixel creciente, para leer por franjas.
+
+    def __init__(self, indptr, indices, data, forma, orden=None):
+        self.indptr = np.asarray(indptr, dtype="int64")
+        self.indices = np.asarray(indices)
+        self.data = np.asarray(data, dtype="float32")
+        self.forma = tuple(int(v) for v in forma)
+        self.orden = np.argsort(self.indices, kind="stable") if orden is None else np.asarray(orden)
+
+    @property
+    def n_zonas(self):
+        return len(self.indptr) - 1
+
+    @property
+    def filas(self):
+        # Zona (0..N-1) de cada entrada
+        return np.repeat(np.arange(self.n_zonas), np.diff(self.indptr))
+
+    def guarda(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            indptr=self.indptr,
+            indices=self.indices,
+            data=self.data,
+            forma=np.array(self.forma),
+            orden=self.orden,
+        )
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def carga(cls, path):
+        with np.load(path) as npz:
+            return cls(npz["indptr"], npz["indices"], npz["data"], npz["forma"], npz["orden"])
+
+    def producto(self, x):
+        # A @ x con x dado por entrada (no por pixel): suma ponderada por zona
+        return np.bincount(self.filas, weights=self.data * x, minlength=self.n_zonas)
+
+    def valores(self, fuentes, cache=None, tolerancia=None):
+        # Valor de cada entrada en cada raster: {nombre: array (nnz,)}.
+        # fuentes: {nombre: (ruta, banda)} sobre la grilla de la matriz. Se leen
+        # franjas de filas completas y solo las que tienen pixeles de alguna zona.
+        alto, ancho = self.forma
+        pixeles = self.indices[self.orden]
+        salida = {}
+        for nombre, (path, banda) in fuentes.items():
+            vals = np.empty(len(self.indices), dtype="float64")
+            with rasterio.open(path) as src:
+                if src.shape != self.forma:
+                    raise ValueError(f"{path} no comparte la grilla de la matriz de cobertura")
+                decodifica = decodificador(src, tolerancia) if cache is None else None
+                for fila in range(0, alto, TAM_VENTANA):
+                    franja = Window(0, fila, ancho, min(TAM_VENTANA, alto - fila))
+                    lo, hi = np.searchsorted(pixeles, [fila * ancho, (fila + franja.height) * ancho])
+                    if lo == hi:
+                        continue
+                    inicio, t0 = time.time(), time.perf_counter()
+                    if cache is not None:
+                        datos = cache.ventana(path, franja, banda, tolerancia)
+                    else:
+                        datos = src.read(banda, window=franja)
+                        if decodifica is not None:
+                            datos = decodifica(datos)
+                    vals[self.orden[lo:hi]] = datos.ravel()[pixeles[lo:hi] - fila * ancho]
+                    if REGISTRO.activo:
+                        REGISTRO.cuenta(leidos=datos.nbytes)
+                        REGISTRO.evento(
+                            "ventana", "cobertura", inicio, time.perf_counter() - t0,
+                            ventana=f"{fila},0", raster=nombre,
+                        )
+            salida[nombre] = vals
+        return salida
+
+    def estadisticas(self, valores, validos):
+        # Media, M2, min y max ponderados por cobertura, como EstadisticasZonales
+        # (posicion 0 = SIN_ZONA, vacia; count = suma de pesos validos)
+        filas = self.filas
+        pesos = np.where(validos, self.data, 0.0)
+        n = self.n_zonas
+
+        w = np.bincount(filas, weights=pesos, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            media = np.bincount(filas, weights=pesos * np.where(validos, valores, 0.0), minlength=n) / w
+        media[w == 0] = 0.0
+        desvio = np.where(validos, valores - media[filas], 0.0)
+        m2 = np.bincount(filas, weights=pesos * desvio * desvio, minlength=n)
+
+        st = EstadisticasZonales(n, extremos=True)
+        st.count = np.r_[0.0, w]
+        st.media_ = np.r_[0.0, media]
+        st.m2 = np.r_[0.0, m2]
+        # Entradas ordenadas por zona: reduceat sobre el inicio de cada zona no vacia
+        inicio = self.indptr[:-1]
+        llenas = np.diff(self.indptr) > 0
+        if llenas.any():
+            st.minimo[1:][llenas] = np.minimum.reduceat(np.where(validos, valores, np.inf), inicio[llenas])
+            st.maximo[1:][llenas] = np.maximum.reduceat(np.where(validos, valores, -np.inf), inicio[llenas])
+        return st
+
+
+def _fracciones_ventana(geometria, window, transform, area_pixel):
+    # (pixeles de la ventana, fraccion) de un poligono: el contorno rasterizado
+    # con all_touched marca los pixeles de borde, que se intersectan exactamente;
+    # el resto de los pixeles con el centro dentro esta entero dentro
+    alto, ancho = int(window.height), int(window.width)
+    borde = rasterize(
+        [geometria.boundary], out_shape=(alto, ancho), transform=transform, all_touched=True, dtype="uint8"
+    ).astype(bool)
+    interior = rasterize([geometria], out_shape=(alto, ancho), transform=transform, dtype="uint8").astype(bool)
+    interior &= ~borde
+
+    filas, cols = np.nonzero(borde)
+    x0, y0 = transform.c, transform.f
+    cajas = shapely.box(
+        x0 + cols * transform.a,
+        y0 + (filas + 1) * transform.e,
+        x0 + (cols + 1) * transform.a,
+        y0 + filas * transform.e,
+    )
+    fraccion = shapely.area(shapely.intersection(cajas, geometria)) / area_pixel
+
+    pix_int = np.flatnonzero(interior)
+    pix_borde = filas * ancho + cols
+    hay = fraccion > FRACCION_MINIMA
+    return (
+        np.r_[pix_int, pix_borde[hay]],
+        np.r_[np.ones(len(pix_int)), np.minimum(fraccion[hay], 1.0)],
+    )
+
+
+def matriz_cobertura(geometrias, ref_path):
+    # Fracciones de cobertura de cada geometria sobre la grilla de ref_path,
+    # por ventanas de 512 con el indice espacial (memoria acotada por ventana)
+    with rasterio.open(ref_path) as ref:
+        transform, alto, ancho = ref.transform, ref.height, ref.width
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError("La matriz de cobertura requiere una grilla sin rotacion")
+
+    indice = IndiceEspacial(geometrias, transform)
+    geometrias = [g if g.is_valid else g.buffer(0) for g in indice.geometrias]
+    area_pixel = abs(transform.a * transform.e)
+    tipo = "uint32" if alto * ancho < 2**32 else "int64"
+
+    zonas, pixeles, pesos = [], [], []
+    for window in ventanas_grilla(alto, ancho, TAM_VENTANA):
+        transform_w = rasterio.windows.transform(window, transform)
+        fila0, col0 = int(window.row_off), int(window.col_off)
+        for i in indice.en_ventana(window):
+            pix, frac = _fracciones_ventana(geometrias[i], window, transform_w, area_pixel)
+            if len(pix) == 0:
+                continue
+            # pixel de la ventana -> pixel plano de la grilla
+            f, c = np.divmod(pix, int(window.width))
+            zonas.append(np.full(len(pix), i, dtype="int64"))
+            pixeles.append(((f + fila0) * ancho + (c + col0)).astype(tipo))
+            pesos.append(frac.astype("float32"))
+
+    zonas = np.concatenate(zonas) if zonas else np.empty(0, dtype="int64")
+    pixeles = np.concatenate(pixeles) if pixeles else np.empty(0, dtype=tipo)
+    pesos = np.concatenate(pesos) if pesos else np.empty(0, dtype="float32")
+    orden = np.lexsort((pixeles, zonas))
+    indptr = np.r_[0, np.cumsum(np.bincount(zonas, minlength=len(geometrias)))]
+    return MatrizCobertura(indptr, pixeles[orden], pesos[orden], (alto, ancho))
+
+
+def cobertura_zonas(geometrias, ref_path, clave, cache_dir, origen=None):
+    # Como zonas.indice_zonas: la matriz se guarda en cache_dir identificada por
+    # la capa, la firma de la grilla y la version del archivo vectorial
+    out_path = ruta_cache_zonas(cache_dir, f"COBERTURA_{clave}", ref_path, origen, ".npz")
+    if not os.path.exists(out_path):
+        matriz_cobertura(geometrias, ref_path).guarda(out_path)
+    return out_path
+
+
+def estadisticas_cobertura(capas, rasters, nodata, cache=None):
+    # Equivalente ponderado de zonas.estadisticas_multicapa.
+    # capas: {clave: ruta .npz o MatrizCobertura}; rasters: {nombre: ruta}
+    # Devuelve {clave: {nombre: EstadisticasZonales}}
+    resultado = {}
+    for clave, matriz in capas.items():
+        if not isinstance(matriz, MatrizCobertura):
+            matriz = MatrizCobertura.carga(matriz)
+        valores = matriz.valores({nombre: (path, 1) for nombre, path in rasters.items()}, cache)
+        resultado[clave] = {
+            nombre: matriz.estadisticas(vals, (vals != nodata) & ~np.isnan(vals))
+            for nombre, vals in valores.items()
+        }
+    return resultado
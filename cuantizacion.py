@@ -0,0 +1,168 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+# Almacenamiento compacto opcional de los derivados:
+# - DELTA_/Z_: int16 con escala/offset en los metadatos del GeoTIFF
+#   (valor = crudo * escala + offset); el error maximo es escala / 2. El offset
+#   de Z_ se ajusta al rango de cada BIO (ajuste_rango)
+# - MEAN_/STD_: el raster de etiquetas uint16 (REGIONES_id.tif) + una tabla
+#   con el valor de cada region, en lugar de un raster float32 constante por region
+# Los lectores del pipeline (bloques.procesa_bloques, zonas) decodifican de forma
+# transparente a float32 con el nodata original.
+NODATA_INT16 = -32768
+MAX_INT16 = 32767
+ESCALAS = {"delta": 0.01, "z": 0.001}
+TOLERANCIA = 0.005
+
+_CLAVES = ("escala", "offset", "nodata_decodificado")
+
+
+class FueraDeRango(ValueError):
+    # Valores que no entran en int16 con la escala/offset pedidos: quien
+    # escribe puede volver a escribir ese raster en float32
+    pass
+
+
+def escala_para(tipo, tolerancia=TOLERANCIA):
+    # La escala por defecto del tipo, reducida si hace falta para cumplir la tolerancia
+    return min(ESCALAS[tipo], 2 * tolerancia)
+
+
+def ajuste_rango(minimo, maximo, escala):
+    # (escala, offset) que centra [minimo, maximo] en el rango int16 sin cambiar
+    # la escala (el error sigue siendo escala / 2), o None si el rango no entra.
+    # El offset se redondea a float32 para que codifica y decodifica usen el mismo.
+    if not (np.isfinite(minimo) and np.isfinite(maximo)):
+        return escala, 0.0
+    offset = float(np.float32((minimo + maximo) / 2))
+    # Un paso de margen por el redondeo en float32 de quien calcula los valores
+    if max(maximo - offset, offset - minimo) + escala > MAX_INT16 * escala:
+        return None
+    return escala, offset
+
+
+def perfil_cuantizado(profile, escala, offset=0.0):
+    # Perfil int16 con la escala/offset que abre_salida graba en el GeoTIFF.
+    # El nodata del perfil original pasa a ser el nodata decodificado.
+    profile = profile.copy()
+    profile.pop("predictor", None)
+    profile.update(
+        dtype="int16",
+        nodata=NODATA_INT16,
+        escala=escala,
+        offset=offset,
+        nodata_decodificado=profile.get("nodata"),
+    )
+    return profile
+
+
+def separa_cuantizacion(profile):
+    # Devuelve (profile de escritura, {escala, offset, nodata_decodificado} o None)
+    if "escala" not in profile:
+        return profile, None
+    profile = profile.copy()
+    return profile, {clave: profile.pop(clave) for clave in _CLAVES}
+
+
+def marca_cuantizacion(dst, escala, offset, nodata_decodificado):
+    dst.scales = (escala,) * dst.count
+    dst.offsets = (offset,) * dst.count
+    dst.update_tags(
+        NODATA_DECODIFICADO=repr(float(nodata_decodificado)),
+        ERROR_CUANTIZACION=repr(escala / 2),
+    )
+
+
+def codifica(valores, validos, escala, offset=0.0):
+    # float -> int16 redondeando al paso de la escala. Un valor fuera del rango
+    # representable es un error: recortarlo rompería la tolerancia declarada.
+    crudo = np.full(valores.shape, NODATA_INT16, dtype="int16")
+    q = np.rint((valores[validos] - offset) / escala)
+    if q.size and np.abs(q).max() > MAX_INT16:
+        raise FueraDeRango(
+            f"Valores fuera del rango int16 con escala {escala}: "
+            f"[{valores[validos].min()}, {valores[validos].max()}]"
+        )
+    crudo[validos] = q.astype("int16")
+    return crudo
+
+
+def decodifica(crudo, escala, offset, nodata, nodata_decodificado):
+    valores = crudo.astype("float32") * np.float32(escala) + np.float32(offset)
+    valores[crudo == nodata] = nodata_decodificado
+    return valores
+
+
+def error_cuantizacion(src):
+    # Error maximo declarado de un raster cuantizado, o None si no lo esta
+    tags = src.tags()
+    if "NODATA_DECODIFICADO" not in tags:
+        return None
+    return float(tags["ERROR_CUANTIZACION"])
+
+
+def verifica_tolerancia(nombre, error, tolerancia=TOLERANCIA):
+    if error is not None and tolerancia is not None and error > tolerancia:
+        raise ValueError(
+            f"{nombre}: error de cuantizacion {error} mayor que la tolerancia {tolerancia}"
+        )
+
+
+def decodificador(src, tolerancia=TOLERANCIA):
+    # Funcion que decodifica lo leido de `src`, o None si no esta cuantizado.
+    # Verifica que el error de cuantizacion declarado este dentro de la tolerancia.
+    error = error_cuantizacion(src)
+    if error is None:
+        return None
+    verifica_tolerancia(src.name, error, tolerancia)
+    tags = src.tags()
+    escala, offset = src.scales[0], src.offsets[0]
+    nodata, nodata_decodificado = src.nodata, float(tags["NODATA_DECODIFICADO"])
+
+    def decodifica_src(crudo):
+        return decodifica(crudo, escala, offset, nodata, nodata_decodificado)
+
+    return decodifica_src
+
+
+def lee_banda(src, banda=1, window=None, tolerancia=TOLERANCIA):
+    # src.read() con decodificacion transparente de los rasters cuantizados
+    datos = src.read(banda, window=window)
+    decodifica_src = decodificador(src, tolerancia)
+    return datos if decodifica_src is None else decodifica_src(datos)
+
+
+# ---------------------------------------------------
+# MEAN_/STD_ como etiquetas + tabla por region
+# ---------------------------------------------------
+
+
+def escribe_tabla_regional(path, etiquetas_path, valores, nodata):
+    # valores[i] = valor de la region i (posicion 0 = fuera de toda region)
+    valores = np.asarray(valores, dtype="float64")
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "etiquetas": str(Path(etiquetas_path).resolve()),
+                "nodata": nodata,
+                "valores": [None if np.isnan(v) else float(v) for v in valores],
+            },
+            f,
+        )
+    return path
+
+
+def lee_tabla_regional(path, window=None):
+    # Reconstruye el raster float32 (o una ventana) como lut[etiquetas]
+    with open(path) as f:
+        tabla = json.load(f)
+    lut = np.array(
+        [tabla["nodata"] if v is None else v for v in tabla["valores"]], dtype="float32"
+    )
+    with rasterio.open(tabla["etiquetas"]) as src:
+        etiquetas = src.read(1, window=window)
+    lut[0] = tabla["nodata"]
+    return lut[etiquetas]
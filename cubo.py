@@ -0,0 +1,140 @@
+import argparse
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import fiona
+import rasterio
+from rasterio import dtypes
+from rasterio.features import geometry_window
+
+from grilla import firma_grilla
+from Organizacion import GCM, PERIODO, SSP, ruta_futuro
+from recorte import SHAPE_PATH
+
+# Cubo de trabajo: un VRT con los pares (histórico, futuro) de cada BIO recortados
+# a la ventana del área de estudio, leídos directamente de los originales.
+# Evita escribir bio_{n}_fut.tif y los recorte_*.tif.
+CUBO_PATH = Path("./RASTER/modificados/cubo_trabajo.vrt")
+HIST_PATH = "./RASTER/originales/wc2.1_30s_bio/wc2.1_30s_bio_{}.tif"
+
+
+def _banda_vrt(raiz, n, path, banda_src, src, ventana, ancho, alto, descripcion):
+    banda = ET.SubElement(
+        raiz,
+        "VRTRasterBand",
+        dataType=dtypes.typename_fwd[dtypes.dtype_rev[src.dtypes[banda_src - 1]]],
+        band=str(n),
+    )
+    ET.SubElement(banda, "Description").text = descripcion
+    nodata = src.nodatavals[banda_src - 1]
+    if nodata is not None:
+        ET.SubElement(banda, "NoDataValue").text = repr(float(nodata))
+
+    fuente = ET.SubElement(banda, "SimpleSource")
+    ET.SubElement(fuente, "SourceFilename", relativeToVRT="0").text = str(
+        Path(path).resolve()
+    )
+    ET.SubElement(fuente, "SourceBand").text = str(banda_src)
+    ET.SubElement(
+        fuente,
+        "SrcRect",
+        xOff=str(int(ventana.col_off)),
+        yOff=str(int(ventana.row_off)),
+        xSize=str(ancho),
+        ySize=str(alto),
+    )
+    ET.SubElement(fuente, "DstRect", xOff="0", yOff="0", xSize=str(ancho), ySize=str(alto))
+
+
+def construye_cubo_ensamble(hist_paths, fut_paths, geometrias, salida=CUBO_PATH):
+    # hist_paths: {bio_idx: ruta del raster histórico}
+    # fut_paths: {miembro: raster multibanda futuro} (la banda n es BIO n)
+    # Todos los futuros comparten la ventana y las bandas históricas del cubo.
+    # Devuelve {bio_idx: {"hist": banda, miembro: banda, ...}} dentro del cubo.
+    primero = next(iter(fut_paths.values()))
+    with rasterio.open(primero) as src_ref:
+        # La misma ventana que el recorte con mask(crop=True)
+        ventana = geometry_window(src_ref, geometrias)
+        ancho, alto = int(ventana.width), int(ventana.height)
+        transform = src_ref.window_transform(ventana)
+        firma_ref = firma_grilla(src_ref.crs, src_ref.transform, src_ref.shape)
+        crs = src_ref.crs
+
+    raiz = ET.Element("VRTDataset", rasterXSize=str(ancho), rasterYSize=str(alto))
+    ET.SubElement(raiz, "SRS").text = crs.to_wkt()
+    ET.SubElement(raiz, "GeoTransform").text = ", ".join(
+        repr(v) for v in transform.to_gdal()
+    )
+
+    fuentes = {}
+
+    def abre(path):
+        if path not in fuentes:
+            src = rasterio.open(path)
+            fuentes[path] = src
+            if firma_grilla(src.crs, src.transform, src.shape) != firma_ref:
+                raise ValueError(
+                    f"{path} no comparte la grilla del raster futuro; usar recorte + Alineacion"
+                )
+        return fuentes[path]
+
+    bandas = {}
+    n = 0
+    try:
+        for bio_idx, hist_path in hist_paths.items():
+            n += 1
+            src_h = abre(hist_path)
+            _banda_vrt(raiz, n, hist_path, 1, src_h, ventana, ancho, alto, f"BIO{bio_idx}_hist")
+            bandas[bio_idx] = {"hist": n}
+
+            for miembro, fut_path in fut_paths.items():
+                src_f = abre(fut_path)
+                if bio_idx > src_f.count:
+                    raise ValueError(f"La banda {bio_idx} no existe en {fut_path}")
+                n += 1
+                _banda_vrt(raiz, n, fut_path, bio_idx, src_f, ventana, ancho, alto, f"BIO{bio_idx}_{miembro}")
+                bandas[bio_idx][miembro] = n
+    finally:
+        for src in fuentes.values():
+            src.close()
+
+    salida = Path(salida)
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    ET.ElementTree(raiz).write(salida)
+    return bandas
+
+
+def construye_cubo(hist_paths, fut_path, geometrias, salida=CUBO_PATH):
+    # Cubo de un único futuro. Devuelve {bio_idx: (banda_hist, banda_fut)} dentro del cubo.
+    bandas = construye_cubo_ensamble(hist_paths, {"fut": fut_path}, geometrias, salida)
+    return {bio_idx: (b["hist"], b["fut"]) for bio_idx, b in bandas.items()}
+
+
+def lee_geometrias(shape_path):
+    with fiona.open(shape_path, "r") as shapefile:
+        return [feature["geometry"] for feature in shapefile]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Genera el cubo de trabajo VRT (histórico + futuro) del área de estudio"
+    )
+    parser.add_argument("--bandas", type=int, nargs="+", default=[1, 5, 14, 15])
+    parser.add_argument("--gcm", default=GCM)
+    parser.add_argument("--ssp", default=SSP)
+    parser.add_argument("--periodo", default=PERIODO)
+    parser.add_argument("--salida", type=Path, default=CUBO_PATH)
+    args = parser.parse_args(argv)
+
+    bandas = construye_cubo(
+        {b: HIST_PATH.format(b) for b in args.bandas},
+        ruta_futuro(args.gcm, args.ssp, args.periodo),
+        lee_geometrias(SHAPE_PATH),
+        args.salida,
+    )
+    print(f"Cubo de trabajo generado: {args.salida} ({2 * len(bandas)} bandas)")
+    return bandas
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import glob
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+
+from analisis import NODATA_VAL_OUT, OUTPUT_PATH, VECTOR_PATH
+from bloques import (
+    COLA_ESCRITURA,
+    HILOS,
+    MULTIPLO_BLOQUE,
+    PROFUNDIDAD,
+    agrega_argumentos_anticipacion,
+    agrega_argumentos_bloques,
+    procesa_bloques,
+    ventanas_bloque,
+)
+from cubo import HIST_PATH, construye_cubo_ensamble
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from Organizacion import ORIGINALES_DIR
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+from perfiles import agrega_argumento_perfil, aplica_perfil
+from zonas import (
+    SIN_ZONA,
+    EstadisticasZonales,
+    IndiceEspacial,
+    agrega_tocados,
+    rasteriza_zonas,
+    tablas_z,
+    z_regional,
+)
+
+# Modo ensamble: varios futuros (GCM x SSP x período) contra los mismos históricos.
+# El histórico, la ventana del área de estudio y el raster de regiones se comparten
+# entre todos los miembros; cada ventana del histórico se lee una sola vez.
+ENSAMBLE_PATH = OUTPUT_PATH.joinpath("ensamble")
+PATRON_FUTUROS = str(ORIGINALES_DIR.joinpath("wc2.1_30s_bioc_*.tif"))
+BIOS_ENSAMBLE = [1, 5, 14, 15]
+ESTADISTICOS = ["media", "mediana", "spread", "acuerdo"]
+
+
+def nombre_miembro(path):
+    # wc2.1_30s_bioc_<GCM>_<SSP>_<PERIODO>.tif -> <GCM>_<SSP>_<PERIODO>
+    return Path(path).stem.replace("wc2.1_30s_bioc_", "")
+
+
+def estadisticos_ensamble(pila, valido):
+    # pila: (miembros, alto, ancho). spread = desviación entre miembros;
+    # acuerdo = fracción de miembros con el mismo signo que la mediana
+    media = pila.mean(axis=0)
+    mediana = np.median(pila, axis=0)
+    spread = pila.std(axis=0)
+    acuerdo = (np.sign(pila) == np.sign(mediana)).mean(axis=0)
+
+    resultados = {}
+    for nombre, arr in zip(ESTADISTICOS, (media, mediana, spread, acuerdo)):
+        arr = arr.astype("float32")
+        arr[~valido] = NODATA_VAL_OUT
+        resultados[nombre] = arr
+    return resultados
+
+
+def procesa_bio_ensamble(
+    bio_idx,
+    cubo_path,
+    bandas,
+    regiones_path,
+    n_regiones,
+    hilos=HILOS,
+    multiplo=MULTIPLO_BLOQUE,
+    perfil="lzw",
+    indice=None,
+    profundidad=PROFUNDIDAD,
+    cola_escritura=COLA_ESCRITURA,
+):
+    # bandas: {"hist": banda, miembro: banda, ...} del BIO dentro del cubo
+    miembros = [m for m in bandas if m != "hist"]
+
+    with rasterio.open(cubo_path) as cubo:
+        nodata = {m: cubo.nodatavals[b - 1] for m, b in bandas.items()}
+        profile = cubo.profile.copy()
+    # Fuera de toda región todas las salidas son nodata: con el indice espacial
+    # esas ventanas no se leen ni se calculan
+    ventanas = None
+    if indice is not None:
+        with rasterio.open(regiones_path) as src_r:
+            ventanas = indice.filtra(ventanas_bloque(src_r, multiplo))
+    profile.update(driver="GTiff", count=1, dtype="float32", nodata=NODATA_VAL_OUT)
+    profile = aplica_perfil(profile, perfil)
+
+    def ruta(tipo, nombre):
+        return ENSAMBLE_PATH.joinpath(f"{tipo}_{nombre}_bio_{bio_idx}.tif")
+
+    # ---------------------------------------------------
+    # Pasada 1: deltas de todos los miembros + estadísticas regionales por miembro
+    # ---------------------------------------------------
+
+    estadisticas = {m: EstadisticasZonales(n_regiones) for m in miembros}
+
+    def kernel_delta(window, datos):
+        ids = datos["ids"]
+        h = datos["hist"].astype("float32")
+        fuera = (h == nodata["hist"]) | (ids == SIN_ZONA)
+
+        deltas = []
+        valido_todos = ~fuera
+        resultados = {}
+        for m in miembros:
+            f = datos[m].astype("float32")
+            delta = f - h
+            # Inversión temprana BIO14
+            if bio_idx == 14:
+                delta = -delta
+            mask = fuera | (f == nodata[m]) | np.isnan(delta)
+            delta[mask] = NODATA_VAL_OUT
+
+            estadisticas[m].agrega(ids, delta, ~mask)
+            # all_touched como analisis.py: los bordes compartidos cuentan para ambas regiones
+            if indice is not None:
+                agrega_tocados(estadisticas[m], indice, window, ids, delta, ~mask)
+            valido_todos &= ~mask
+            deltas.append(delta)
+            resultados[("DELTA", m)] = delta
+
+        for nombre, arr in estadisticos_ensamble(np.stack(deltas), valido_todos).items():
+            resultados[("ENS_DELTA", nombre)] = arr
+        return resultados
+
+    salidas = {("DELTA", m): ruta("DELTA", m) for m in miembros}
+    salidas.update({("ENS_DELTA", e): ruta("ENS_DELTA", e) for e in ESTADISTICOS})
+
+    procesa_bloques(
+        {"ids": (regiones_path, 1), **{m: (cubo_path, b) for m, b in bandas.items()}},
+        kernel_delta,
+        salidas={clave: (path, profile) for clave, path in salidas.items()},
+        ventanas=ventanas,
+        hilos=hilos,
+        multiplo=multiplo,
+        profundidad=profundidad,
+        cola_escritura=cola_escritura,
+    )
+
+    luts = {}
+    filas = []
+    for m in miembros:
+        media = estadisticas[m].media()
+        std = estadisticas[m].std()
+        luts[m] = tablas_z(estadisticas[m])
+        filas.append(
+            pd.DataFrame(
+                {
+                    "miembro": m,
+                    "bio": bio_idx,
+                    "region": np.arange(1, n_regiones + 1),
+                    "mean": media[1:],
+                    "std": std[1:],
+                }
+            )
+        )
+
+    # ---------------------------------------------------
+    # Pasada 2: Z-score regional por miembro + estadísticos del ensamble sobre Z
+    # ---------------------------------------------------
+
+    def kernel_z(window, datos):
+        ids = datos["ids"]
+        zs = []
+        valido_todos = np.ones(ids.shape, dtype=bool)
+        resultados = {}
+        for m in miembros:
+            z, valid = z_regional(ids, datos[m], *luts[m], NODATA_VAL_OUT)
+
+            valido_todos &= valid
+            zs.append(z)
+            resultados[("Z", m)] = z
+
+        for nombre, arr in estadisticos_ensamble(np.stack(zs), valido_todos).items():
+            resultados[("ENS_Z", nombre)] = arr
+        return resultados
+
+    salidas_z = {("Z", m): ruta("Z", m) for m in miembros}
+    salidas_z.update({("ENS_Z", e): ruta("ENS_Z", e) for e in ESTADISTICOS})
+
+    procesa_bloques(
+        {"ids": (regiones_path, 1), **{m: (salidas[("DELTA", m)], 1) for m in miembros}},
+        kernel_z,
+        salidas={clave: (path, profile) for clave, path in salidas_z.items()},
+        ventanas=ventanas,
+        hilos=hilos,
+        multiplo=multiplo,
+        profundidad=profundidad,
+        cola_escritura=cola_escritura,
+    )
+
+    return pd.concat(filas, ignore_index=True)
+
+
+@instrumenta("ensamble")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Deltas, Z-score y estadísticos de ensamble para varios futuros (GCM x SSP x período)"
+    )
+    agrega_argumento_workers(parser)
+    agrega_argumentos_bloques(parser)
+    agrega_argumentos_anticipacion(parser)
+    agrega_argumento_perfil(parser, defecto="lzw")
+    parser.add_argument(
+        "--futuros",
+        nargs="+",
+        help=f"rasters multibanda futuros (por defecto: {PATRON_FUTUROS})",
+    )
+    parser.add_argument("--bandas", type=int, nargs="+", default=BIOS_ENSAMBLE)
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    futuros = args.futuros or sorted(glob.glob(PATRON_FUTUROS))
+    if not futuros:
+        print("ERROR: no se encontraron rasters futuros")
+        return
+    fut_paths = {nombre_miembro(p): Path(p) for p in futuros}
+    print(f"Ensamble de {len(fut_paths)} miembros: {', '.join(fut_paths)}")
+
+    ENSAMBLE_PATH.mkdir(parents=True, exist_ok=True)
+    regiones = gpd.read_file(VECTOR_PATH)
+    n_regiones = len(regiones)
+
+    # Ventana, históricos y raster de regiones compartidos por todos los miembros
+    cubo_path = ENSAMBLE_PATH.joinpath("cubo_ensamble.vrt")
+    bandas_cubo = construye_cubo_ensamble(
+        {b: HIST_PATH.format(b) for b in args.bandas},
+        fut_paths,
+        regiones.geometry,
+        cubo_path,
+    )
+    regiones_path = ENSAMBLE_PATH.joinpath("REGIONES_id.tif")
+    rasteriza_zonas(regiones.geometry, cubo_path, regiones_path)
+    with rasterio.open(regiones_path) as src_r:
+        indice = IndiceEspacial(regiones.geometry, src_r.transform)
+
+    tareas = {
+        bio_idx: (
+            bio_idx,
+            cubo_path,
+            bandas_cubo[bio_idx],
+            regiones_path,
+            n_regiones,
+            args.hilos,
+            args.multiplo_bloque,
+            args.perfil,
+            indice,
+            args.profundidad,
+            args.cola_escritura,
+        )
+        for bio_idx in args.bandas
+    }
+    resultados = ejecuta_tareas(procesa_bio_ensamble, tareas, workers=args.workers)
+
+    tablas = []
+    for bio_idx, resultado in resultados.items():
+        if resultado.ok:
+            tablas.append(resultado.valor)
+            print(f"Ensamble bio_{bio_idx} generado")
+        else:
+            print(f"ERROR al procesar BIO{bio_idx}: {resultado.error}")
+
+    if tablas:
+        tabla_path = ENSAMBLE_PATH.joinpath("estadisticas_regionales.csv")
+        pd.concat(tablas, ignore_index=True).to_csv(tabla_path, index=False)
+        print(f"Estadísticas regionales por miembro: {tabla_path}")
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def combina_momentos(n_a, media_a, m2_a, n_b, media_b, m2_b):
+    # Fusión de Chan et al. de (n, media, M2) de dos conjuntos disjuntos.
+    # Funciona con escalares o con vectores (una posición por zona).
+    n = n_a + n_b
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = media_b - media_a
+        peso_b = np.where(n > 0, n_b / np.where(n > 0, n, 1), 0.0)
+        media = media_a + delta * peso_b
+        m2 = m2_a + m2_b + delta * delta * n_a * peso_b
+    return n, media, m2
+
+
+class Acumulador:
+    # Media y varianza en streaming (Welford / Chan): se alimenta ventana a ventana
+    # y se puede combinar con el de otro proceso sin guardar los valores.
+
+    def __init__(self):
+        self.n = 0
+        self.media_ = 0.0
+        self.m2 = 0.0
+
+    def agrega(self, valores):
+        valores = np.asarray(valores, dtype="float64").ravel()
+        if valores.size == 0:
+            return self
+        media_b = valores.mean()
+        m2_b = np.square(valores - media_b).sum()
+        self.n, self.media_, self.m2 = (
+            float(v) for v in combina_momentos(self.n, self.media_, self.m2, valores.size, media_b, m2_b)
+        )
+        self.n = int(self.n)
+        return self
+
+    def combina(self, otro):
+        n, media, m2 = combina_momentos(self.n, self.media_, self.m2, otro.n, otro.media_, otro.m2)
+        self.n, self.media_, self.m2 = int(n), float(media), float(m2)
+        return self
+
+    def media(self):
+        return self.media_ if self.n else np.nan
+
+    def var(self, ddof=0):
+        return self.m2 / (self.n - ddof) if self.n > ddof else np.nan
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
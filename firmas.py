@@ -0,0 +1,29 @@
+import hashlib
+from pathlib import Path
+
+# Firmas de archivos compartidas por el manifiesto del pipeline, el registro de
+# grillas y el cache de rasters. No importa ningun otro modulo del proyecto, asi
+# que cualquiera puede usarlo sin depender del orquestador (pipeline.py).
+
+
+def archivos_vectoriales(path):
+    # Un shapefile son varios archivos (.shp, .shx, .dbf, .prj, ...): todos cuentan
+    path = Path(path)
+    if path.suffix.lower() == ".shp":
+        return sorted(path.parent.glob(path.stem + ".*"))
+    return [path]
+
+
+def firma_archivo(path, contenido=False):
+    # mtime + tamaño por defecto; con contenido=True, hash SHA-1 del archivo
+    path = Path(path)
+    if not path.exists():
+        return None
+    stat = path.stat()
+    if not contenido:
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            sha.update(bloque)
+    return f"{stat.st_size}:{sha.hexdigest()}"
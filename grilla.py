@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from firmas import firma_archivo
+
+# Registro persistente de grillas: evita abrir cada raster para comparar grillas
+FIRMAS_PATH = Path("./RASTER/firmas_grilla.json")
+
+
+def firma_grilla(crs, transform, shape):
+    # Clave compacta de la grilla: CRS (WKT) + transform + dimensiones.
+    # Dos rasters con la misma firma son comparables pixel a pixel.
+    texto = "|".join(
+        [
+            crs.to_wkt() if crs is not None else "",
+            ",".join(f"{v:.12g}" for v in tuple(transform)[:6]),
+            f"{shape[0]}x{shape[1]}",
+        ]
+    )
+    return hashlib.sha1(texto.encode()).hexdigest()[:16]
+
+
+def firma_raster(src):
+    return firma_grilla(src.crs, src.transform, src.shape)
+
+
+def ruta_recorte(path):
+    # Un recorte armado como GeoTIFF o, con recorte.py --mosaico, como mosaico
+    # VRT de sus tiles (mismo nombre con .vrt): se usa el que exista
+    mosaico = path.with_suffix(".vrt")
+    if not path.exists() and mosaico.exists():
+        return mosaico
+    return path
+
+
+def ruta_alineada(path):
+    # Version alineada de un raster recortado, si existe: primero el GeoTIFF
+    # materializado (_ali.tif) y luego la alineacion virtual (_ali.vrt); si no,
+    # el recorte mismo (GeoTIFF o mosaico)
+    for sufijo in ("_ali.tif", "_ali.vrt"):
+        candidato = path.with_name(path.stem + sufijo)
+        if candidato.exists():
+            return candidato
+    return ruta_recorte(path)
+
+
+# ---------------------------------------------------
+# REGISTRO DE GRILLAS (sin abrir los rasters con GDAL)
+# ---------------------------------------------------
+
+
+class RegistroGrillas:
+    # Firma y metadatos de grilla de cada raster, guardados en un JSON junto a
+    # la firma del archivo (mtime + tamaño). Mientras el archivo no cambie, la
+    # grilla se obtiene con un stat en lugar de abrirlo con GDAL.
+    def __init__(self, path=FIRMAS_PATH):
+        self.path = Path(path)
+        self.entradas = self._lee()
+        self.nuevas = {}
+
+    def _lee(self):
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Un registro ilegible solo obliga a volver a abrir los rasters
+            return {}
+
+    def grilla(self, raster):
+        # {"firma", "crs", "transform", "shape"} del raster
+        clave = str(Path(raster).resolve())
+        archivo = firma_archivo(raster)
+        if archivo is None:
+            raise FileNotFoundError(raster)
+        entrada = self.entradas.get(clave)
+        if entrada is None or entrada["archivo"] != archivo:
+            with rasterio.open(raster) as src:
+                entrada = dict(
+                    _metadatos(src.crs, src.transform, src.shape),
+                    firma=firma_raster(src),
+                    archivo=archivo,
+                )
+            self._agrega(clave, entrada)
+        return entrada
+
+    def firma(self, raster):
+        return self.grilla(raster)["firma"]
+
+    def registra(self, raster, grilla):
+        # Un raster recien escrito sobre una grilla conocida no hace falta abrirlo
+        entrada = dict(grilla, archivo=firma_archivo(raster))
+        self._agrega(str(Path(raster).resolve()), entrada)
+
+    def agrupa(self, rasters):
+        # {firma: [rasters]}: los de un mismo grupo son comparables pixel a pixel
+        grupos = {}
+        for raster in rasters:
+            grupos.setdefault(self.firma(raster), []).append(raster)
+        return grupos
+
+    def _agrega(self, clave, entrada):
+        self.entradas[clave] = entrada
+        self.nuevas[clave] = entrada
+
+    def guarda(self):
+        # Se combina con lo que haya en disco (otra etapa pudo registrar rasters
+        # mientras tanto) y se reemplaza de forma atomica
+        if not self.nuevas:
+            return
+        entradas = self._lee()
+        entradas.update(self.nuevas)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(entradas, f, indent=2, sort_keys=True)
+        tmp.replace(self.path)
+        self.entradas, self.nuevas = entradas, {}
+
+
+def _metadatos(crs, transform, shape):
+    return {
+        "crs": crs.to_wkt() if crs is not None else "",
+        "transform": list(tuple(transform)[:6]),
+        "shape": list(shape),
+    }
+
+
+def diferencias_grilla(grilla, ref, tol=1e-6):
+    # Diferencias de grilla (CRS, resolucion, origen, dimensiones) entre los
+    # metadatos registrados de un raster y los de la referencia
+    problemas = set()
+    a, _, c, _, e, f = grilla["transform"]
+    a_ref, _, c_ref, _, e_ref, f_ref = ref["transform"]
+    alto, ancho = grilla["shape"]
+    alto_ref, ancho_ref = ref["shape"]
+
+    if grilla["crs"] != ref["crs"]:
+        problemas.add("CRS")
+    if not np.allclose((a, -e), (a_ref, -e_ref), atol=tol):
+        problemas.add("RES")
+    if not np.allclose((c, f), (c_ref, f_ref), atol=tol):
+        problemas.add("ORIGIN")
+    if not np.allclose(
+        (c, f + e * alto, c + a * ancho, f),
+        (c_ref, f_ref + e_ref * alto_ref, c_ref + a_ref * ancho_ref, f_ref),
+        atol=tol,
+    ):
+        problemas.add("EXTENT")
+    if (alto, ancho) != (alto_ref, ancho_ref):
+        problemas.add("DIMENSIONS")
+    return problemas
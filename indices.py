@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+import rasterio
+
+from bloques import HILOS, procesa_bloques
+from perfiles import aplica_perfil
+
+# Indices compuestos: {indice: {capa Z: peso}}. Un pixel es valido en un indice
+# solo si lo es en todas sus capas (suma directa, sin inversion de BIO14).
+INDICES = {
+    "INDICE_IMPACTO_AGREGADO": {"BIO1": 1.0, "BIO5": 1.0, "BIO14": 1.0, "BIO15": 1.0},
+    "I_estress_termico": {"BIO1": 1.0, "BIO5": 1.0},
+    "I_estress_hidrico": {"BIO14": 1.0, "BIO15": 1.0},
+}
+
+
+def lee_indices(path):
+    # Configuracion en JSON con la misma forma que INDICES
+    with open(path) as f:
+        return {
+            indice: {capa: float(peso) for capa, peso in pesos.items()}
+            for indice, pesos in json.load(f).items()
+        }
+
+
+def calcula_indices(
+    capas, salidas, nodata, indices=INDICES, hilos=HILOS, perfil="nativo", cache=None
+):
+    # Escribe todos los indices en UNA pasada por bloques sobre las capas Z:
+    # cada capa se lee una sola vez por ventana, sin mantener arrays completos.
+    # capas: {capa: ruta del raster Z}; salidas: {indice: ruta de salida}
+    faltantes = {capa for pesos in indices.values() for capa in pesos} - set(capas)
+    if faltantes:
+        raise ValueError(f"Capas Z faltantes para los indices: {sorted(faltantes)}")
+
+    usadas = [capa for capa in capas if any(capa in pesos for pesos in indices.values())]
+    with rasterio.open(capas[usadas[0]]) as src:
+        meta = src.meta.copy()
+        meta.update({"dtype": "float32", "nodata": nodata})
+        meta = aplica_perfil(meta, perfil)
+
+    def kernel_indices(window, datos):
+        validos = {capa: datos[capa] != nodata for capa in usadas}
+        resultados = {}
+        for indice, pesos in indices.items():
+            valor = np.zeros(datos[usadas[0]].shape, dtype="float32")
+            valido = np.ones(valor.shape, dtype=bool)
+            for capa, peso in pesos.items():
+                valor[validos[capa]] += (peso * datos[capa][validos[capa]]).astype("float32")
+                valido &= validos[capa]
+            valor[~valido] = nodata
+            resultados[indice] = valor
+        return resultados
+
+    procesa_bloques(
+        {capa: (capas[capa], 1) for capa in usadas},
+        kernel_indices,
+        salidas={indice: (salidas[indice], meta) for indice in indices},
+        hilos=hilos,
+        cache=cache,
+    )
+    return salidas
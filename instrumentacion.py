@@ -0,0 +1,238 @@
+import argparse
+import csv
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from rasterio.env import get_gdal_config
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# Instrumentacion liviana de todo el pipeline. Desactivada no cuesta nada:
+# cada punto de medicion es un `if REGISTRO.activo`. Activada registra
+# - etapas: tiempo de pared de cada etapa/tarea (context manager `etapa`)
+# - ventanas: lectura, kernel y escritura de cada ventana del ejecutor por bloques
+# - esperas: cuanto espera el kernel a la lectura anticipada y a la cola de escritura
+# - bytes leidos/escritos (arrays decodificados) y RSS pico del proceso e hijos
+# y produce un reporte JSON/CSV y, opcionalmente, una traza para chrome://tracing.
+
+
+class Registro:
+    def __init__(self):
+        self.activo = False
+        self.eventos = []
+        self.bytes_leidos = 0
+        self.bytes_escritos = 0
+        # etapa/tarea en curso: los eventos de ventana quedan asociados a ella
+        self.actual = None
+        self.lock = threading.Lock()
+
+    def activa(self):
+        self.activo = True
+        return self
+
+    def vacia(self):
+        with self.lock:
+            eventos, self.eventos = self.eventos, []
+            leidos, escritos = self.bytes_leidos, self.bytes_escritos
+            self.bytes_leidos = self.bytes_escritos = 0
+        return {"eventos": eventos, "bytes_leidos": leidos, "bytes_escritos": escritos}
+
+    def incorpora(self, datos):
+        # Eventos y contadores de un proceso del pool
+        with self.lock:
+            self.eventos.extend(datos["eventos"])
+            self.bytes_leidos += datos["bytes_leidos"]
+            self.bytes_escritos += datos["bytes_escritos"]
+
+    def evento(self, categoria, nombre, inicio, duracion, **args):
+        # inicio en segundos de reloj de pared (comparable entre procesos)
+        with self.lock:
+            self.eventos.append(
+                {
+                    "categoria": categoria,
+                    "nombre": nombre,
+                    "inicio": inicio,
+                    "duracion": duracion,
+                    "etapa": self.actual if categoria in ("ventana", "espera", "salida") else None,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def cuenta(self, leidos=0, escritos=0):
+        with self.lock:
+            self.bytes_leidos += leidos
+            self.bytes_escritos += escritos
+
+
+REGISTRO = Registro()
+
+
+@contextmanager
+def etapa(nombre, categoria="etapa", **args):
+    if not REGISTRO.activo:
+        yield
+        return
+    inicio = time.time()
+    t0 = time.perf_counter()
+    anterior, REGISTRO.actual = REGISTRO.actual, nombre
+    try:
+        yield
+    finally:
+        REGISTRO.actual = anterior
+        REGISTRO.evento(categoria, nombre, inicio, time.perf_counter() - t0, **args)
+
+
+def rss_pico_mb():
+    # ru_maxrss esta en KB en Linux (bytes en macOS)
+    divisor = 2**20 if sys.platform == "darwin" else 2**10
+    return {
+        "proceso": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor,
+        "hijos": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor,
+    }
+
+
+def estado_gdal():
+    # GDAL no expone aciertos del cache de bloques via rasterio: se informa el
+    # limite configurado y, si las bindings de osgeo estan instaladas, el uso
+    estado = {"GDAL_CACHEMAX": get_gdal_config("GDAL_CACHEMAX")}
+    if gdal is not None:
+        estado.update(cache_usado=gdal.GetCacheUsed(), cache_max=gdal.GetCacheMax())
+    return estado
+
+
+def _percentil(valores, q):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(q * len(valores)))]
+
+
+def resumen(registro=REGISTRO):
+    # Una fila por (categoria, nombre, etapa): p. ej. la lectura de ventanas de
+    # cada tarea por separado, para ver donde se va el tiempo
+    grupos = {}
+    for ev in registro.eventos:
+        clave = (ev["categoria"], ev["nombre"], ev.get("etapa"))
+        grupos.setdefault(clave, []).append(ev["duracion"])
+    filas = [
+        {
+            "categoria": categoria,
+            "nombre": nombre,
+            "etapa": etapa_ev,
+            "n": len(duraciones),
+            "total_s": sum(duraciones),
+            "media_s": sum(duraciones) / len(duraciones),
+            "p95_s": _percentil(duraciones, 0.95),
+            "max_s": max(duraciones),
+        }
+        for (categoria, nombre, etapa_ev), duraciones in grupos.items()
+    ]
+    return {
+        "filas": filas,
+        "bytes_leidos": registro.bytes_leidos,
+        "bytes_escritos": registro.bytes_escritos,
+        "rss_pico_mb": rss_pico_mb(),
+        "gdal": estado_gdal(),
+    }
+
+
+def escribe_reporte(path, registro=REGISTRO):
+    # JSON o CSV segun la extension
+    path = Path(path)
+    datos = resumen(registro)
+    if path.suffix.lower() == ".csv":
+        with open(path, "w", newline="") as f:
+            escritor = csv.DictWriter(
+                f,
+                fieldnames=["categoria", "nombre", "etapa", "n", "total_s", "media_s", "p95_s", "max_s"],
+            )
+            escritor.writeheader()
+            escritor.writerows(datos["filas"])
+            for clave in ("bytes_leidos", "bytes_escritos"):
+                escritor.writerow({"categoria": "total", "nombre": clave, "n": datos[clave]})
+            for clave, mb in datos["rss_pico_mb"].items():
+                escritor.writerow({"categoria": "rss_pico_mb", "nombre": clave, "n": round(mb, 1)})
+    else:
+        with open(path, "w") as f:
+            json.dump(datos, f, indent=2, default=str)
+    return path
+
+
+def escribe_traza(path, registro=REGISTRO):
+    # Formato Trace Event (chrome://tracing, Perfetto): eventos completos "X" en us
+    eventos = [
+        {
+            "name": ev["nombre"],
+            "cat": ev["categoria"],
+            "ph": "X",
+            "ts": ev["inicio"] * 1e6,
+            "dur": ev["duracion"] * 1e6,
+            "pid": ev["pid"],
+            "tid": ev["tid"],
+            "args": dict(ev["args"], etapa=ev.get("etapa")) if ev.get("etapa") else ev["args"],
+        }
+        for ev in registro.eventos
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": eventos, "displayTimeUnit": "ms"}, f, default=str)
+    return path
+
+
+def agrega_argumentos_instrumentacion(parser):
+    parser.add_argument(
+        "--reporte-rendimiento",
+        type=Path,
+        metavar="RUTA",
+        help="guarda tiempos por etapa/ventana, bytes y RSS pico (.json o .csv)",
+    )
+    parser.add_argument(
+        "--traza",
+        type=Path,
+        metavar="RUTA",
+        help="guarda una traza para chrome://tracing o Perfetto",
+    )
+    return parser
+
+
+@contextmanager
+def corrida(nombre, args):
+    # Activa el registro si se pidio un reporte o una traza (o sigue activo si ya
+    # lo estaba, p. ej. desde pipeline.py), mide la corrida y los escribe al final
+    pedido = args.reporte_rendimiento is not None or args.traza is not None
+    if pedido:
+        REGISTRO.activa()
+    with etapa(nombre):
+        yield
+    if args.reporte_rendimiento is not None:
+        escribe_reporte(args.reporte_rendimiento)
+        print(f"Reporte de rendimiento: {args.reporte_rendimiento}")
+    if args.traza is not None:
+        escribe_traza(args.traza)
+        print(f"Traza: {args.traza}")
+
+
+def instrumenta(nombre):
+    # Decorador para el main(argv) de cada script: toma --reporte-rendimiento y
+    # --traza de argv (el parser del script los declara con
+    # agrega_argumentos_instrumentacion) y envuelve la corrida en una etapa
+    def decorador(main):
+        @functools.wraps(main)
+        def envoltura(argv=None):
+            parser = agrega_argumentos_instrumentacion(argparse.ArgumentParser(add_help=False))
+            args, _ = parser.parse_known_args(argv)
+            with corrida(nombre, args):
+                return main(argv)
+
+        return envoltura
+
+    return decorador
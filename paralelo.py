@@ -0,0 +1,83 @@
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from instrumentacion import REGISTRO, etapa
+
+
+@dataclass
+class ResultadoTarea:
+    # Resultado estructurado de una unidad de trabajo (una banda, un raster, una capa...)
+    clave: object
+    ok: bool
+    valor: object = None
+    error: str = None
+    detalle: str = None
+    segundos: float = 0.0
+    # eventos y contadores de instrumentacion registrados en el proceso del pool
+    metricas: dict = None
+
+
+def _ejecuta(clave, funcion, args):
+    inicio = time.perf_counter()
+    try:
+        with etapa(f"{funcion.__name__}[{clave}]", categoria="tarea"):
+            valor = funcion(*args)
+    except Exception as e:
+        return ResultadoTarea(
+            clave,
+            False,
+            error=f"{type(e).__name__}: {e}",
+            detalle=traceback.format_exc(),
+            segundos=time.perf_counter() - inicio,
+        )
+    return ResultadoTarea(clave, True, valor=valor, segundos=time.perf_counter() - inicio)
+
+
+def _ejecuta_en_proceso(clave, funcion, args, instrumentar):
+    # En un proceso del pool el registro empieza vacio (con fork se hereda una
+    # copia del padre) y sus eventos vuelven con el resultado
+    if instrumentar:
+        REGISTRO.activa().vacia()
+    resultado = _ejecuta(clave, funcion, args)
+    if instrumentar:
+        resultado.metricas = REGISTRO.vacia()
+    return resultado
+
+
+def ejecuta_tareas(funcion, tareas, workers=1):
+    # Ejecuta funcion(*args) para cada {clave: args} de tareas.
+    # Con workers > 1 las tareas se reparten en un pool de procesos; el resultado es
+    # el mismo que en secuencial y se devuelve en el orden de las tareas.
+    if workers <= 1 or len(tareas) <= 1:
+        return {clave: _ejecuta(clave, funcion, args) for clave, args in tareas.items()}
+
+    resultados = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(tareas))) as pool:
+        futuros = {
+            clave: pool.submit(_ejecuta_en_proceso, clave, funcion, args, REGISTRO.activo)
+            for clave, args in tareas.items()
+        }
+        for clave, futuro in futuros.items():
+            try:
+                resultados[clave] = futuro.result()
+                if resultados[clave].metricas:
+                    REGISTRO.incorpora(resultados[clave].metricas)
+            except Exception as e:
+                # El proceso murio o el resultado no se pudo transferir
+                resultados[clave] = ResultadoTarea(
+                    clave, False, error=f"{type(e).__name__}: {e}"
+                )
+    return resultados
+
+
+def agrega_argumento_workers(parser, ayuda="procesos en paralelo (1 = secuencial)"):
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help=ayuda,
+    )
+    return parser
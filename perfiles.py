@@ -0,0 +1,125 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+from cuantizacion import marca_cuantizacion, separa_cuantizacion
+
+# Perfiles de salida compartidos por todas las etapas:
+# - nativo: el perfil que arma cada etapa (comportamiento previo)
+# - lzw: GeoTIFF en tiles de 512 con LZW y predictor
+# - cog / cog-zstd: Cloud-Optimized GeoTIFF (tiles internos, DEFLATE o ZSTD con
+#   predictor y overviews internas), para lectura a distintos niveles de zoom
+PERFILES = ["nativo", "lzw", "cog", "cog-zstd"]
+TAM_TILE = 512
+
+
+def _es_flotante(profile):
+    return np.issubdtype(np.dtype(profile["dtype"]), np.floating)
+
+
+def aplica_perfil(profile, perfil="nativo"):
+    # Devuelve una copia del perfil de escritura para el perfil de salida elegido
+    profile = profile.copy()
+    if perfil == "nativo":
+        return profile
+    if perfil not in PERFILES:
+        raise ValueError(f"Perfil de salida desconocido: {perfil}")
+
+    profile.pop("interleave", None)
+    if perfil == "lzw":
+        profile.update(
+            driver="GTiff",
+            tiled=True,
+            blockxsize=TAM_TILE,
+            blockysize=TAM_TILE,
+            compress="lzw",
+            predictor=3 if _es_flotante(profile) else 2,
+        )
+        return profile
+
+    # COG: se escribe en streaming a un GeoTIFF temporal y al cerrar se copia con
+    # el driver COG, que construye las overviews internas y el orden de bloques COG
+    for clave in ("tiled", "blockxsize", "blockysize", "compress", "predictor"):
+        profile.pop(clave, None)
+    profile.update(
+        driver="COG",
+        cog_compress="ZSTD" if perfil == "cog-zstd" else "DEFLATE",
+        cog_resampling="AVERAGE" if _es_flotante(profile) else "NEAREST",
+    )
+    return profile
+
+
+class SalidaCOG:
+    # Dataset de escritura por ventanas que se convierte a COG al cerrarse
+
+    def __init__(self, path, profile):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.stem + "_tmp_cog.tif")
+        self.opciones = {
+            "COMPRESS": profile["cog_compress"],
+            "PREDICTOR": "YES",
+            "BLOCKSIZE": TAM_TILE,
+            "OVERVIEWS": "AUTO",
+            "OVERVIEW_RESAMPLING": profile["cog_resampling"],
+            "BIGTIFF": "IF_SAFER",
+        }
+        profile = {
+            k: v for k, v in profile.items() if k not in ("cog_compress", "cog_resampling")
+        }
+        # El temporal va con LZW (barato) para no ocupar una copia sin comprimir
+        profile.update(
+            driver="GTiff",
+            tiled=True,
+            blockxsize=TAM_TILE,
+            blockysize=TAM_TILE,
+            compress="lzw",
+            BIGTIFF="IF_SAFER",
+        )
+        self.dst = rasterio.open(self.tmp, "w", **profile)
+
+    def __getattr__(self, nombre):
+        return getattr(self.dst, nombre)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        # Con una excepcion en curso el raster quedo a medias: no se copia
+        self.close(copia=tipo is None)
+
+    def close(self, copia=True):
+        if self.dst.closed:
+            return
+        self.dst.close()
+        try:
+            if copia:
+                rasterio.shutil.copy(self.tmp, self.path, driver="COG", **self.opciones)
+        finally:
+            os.remove(self.tmp)
+
+
+def abre_salida(path, profile):
+    # Equivalente a rasterio.open(path, "w", **profile) que entiende el perfil COG
+    # y los perfiles cuantizados (cuantizacion.perfil_cuantizado)
+    profile, cuantizacion = separa_cuantizacion(profile)
+    if profile.get("driver") == "COG":
+        salida = SalidaCOG(path, profile)
+        dst = salida.dst
+    else:
+        salida = dst = rasterio.open(path, "w", **profile)
+    if cuantizacion:
+        marca_cuantizacion(dst, **cuantizacion)
+    return salida
+
+
+def agrega_argumento_perfil(parser, defecto="nativo"):
+    parser.add_argument(
+        "--perfil",
+        choices=PERFILES,
+        default=defecto,
+        help="perfil de los rasters de salida (cog: tiles + DEFLATE/ZSTD + overviews internas)",
+    )
+    return parser
@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import importlib
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from firmas import archivos_vectoriales, firma_archivo
+from instrumentacion import agrega_argumentos_instrumentacion, etapa as mide_etapa, instrumenta
+from paralelo import ResultadoTarea, agrega_argumento_workers
+
+MANIFIESTO_PATH = Path("./pipeline_manifest.json")
+
+
+# ---------------------------------------------------
+# FIRMAS DE ETAPAS (las de archivos estan en firmas.py)
+# ---------------------------------------------------
+
+
+def firma_etapa(entradas, parametros, contenido=False):
+    firmas = {str(p): firma_archivo(p, contenido) for p in entradas}
+    texto = json.dumps({"entradas": firmas, "parametros": parametros}, sort_keys=True, default=str)
+    return hashlib.sha1(texto.encode()).hexdigest(), firmas
+
+
+# ---------------------------------------------------
+# ETAPAS (DAG)
+# ---------------------------------------------------
+
+
+@dataclass
+class Etapa:
+    nombre: str
+    modulo: str
+    # funciones sin argumentos: las rutas dependen de las salidas de etapas previas
+    entradas: object
+    salidas: object
+    parametros: object = dict
+    depende: list = field(default_factory=list)
+
+
+def _organizacion():
+    return importlib.import_module("Organizacion")
+
+
+def _recorte():
+    return importlib.import_module("recorte")
+
+
+def _alineacion():
+    return importlib.import_module("Alineacion")
+
+
+def _analisis():
+    return importlib.import_module("analisis")
+
+
+def _reporte():
+    return importlib.import_module("analisis_sin_invertir")
+
+
+def _salidas_organizacion():
+    org = _organizacion()
+    return [Path(f"./RASTER/originales/bio_{banda}_fut.tif") for banda in org.bandas]
+
+
+def _salidas_recorte():
+    rec = _recorte()
+    return [
+        rec.OUTPUT_DIR.joinpath(f"recorte_{nombre.split('/')[-1]}")
+        for nombre in rec.RASTERS_A_RECORTAR
+    ]
+
+
+def _salidas_alineacion():
+    ali = _alineacion()
+    return sorted(ali.raster_path.glob("recorte_*_ali.*"))
+
+
+def _salidas_analisis():
+    an = _analisis()
+    salidas = [an.OUTPUT_PATH.joinpath("REGIONES_id.tif")]
+    for bio_idx in an.BIOS:
+        salidas += [
+            an.OUTPUT_PATH.joinpath(f"DELTA_bio_{bio_idx}.tif"),
+            an.OUTPUT_PATH.joinpath(f"Z_bio_{bio_idx}.tif"),
+        ]
+    return salidas
+
+
+def _entradas_reporte():
+    rep = _reporte()
+    entradas = []
+    for index in rep.BIOS:
+        entradas.append(Path(rep.RASTER_DIR, rep.FILE_PREFIX_HIST.format(index)))
+        entradas.append(Path(rep.RASTER_DIR, rep.FILE_PREFIX_FUT.format(index)))
+    for settings in rep.VECTOR_PATHS.values():
+        entradas += archivos_vectoriales(settings["path"])
+    return entradas
+
+
+ETAPAS = {
+    "organizacion": Etapa(
+        "organizacion",
+        "Organizacion",
+        entradas=lambda: [_organizacion().future_raster_path],
+        salidas=_salidas_organizacion,
+        parametros=lambda: {"bandas": _organizacion().bandas},
+    ),
+    "recorte": Etapa(
+        "recorte",
+        "recorte",
+        entradas=lambda: [
+            _recorte().RASTER_DIR.joinpath(nombre) for nombre in _recorte().RASTERS_A_RECORTAR
+        ]
+        + archivos_vectoriales(_recorte().SHAPE_PATH),
+        salidas=_salidas_recorte,
+        parametros=lambda: {"tam_bloque": _recorte().TAM_BLOQUE},
+        depende=["organizacion"],
+    ),
+    "alineacion": Etapa(
+        "alineacion",
+        "Alineacion",
+        entradas=_salidas_recorte,
+        salidas=_salidas_alineacion,
+        parametros=lambda: {"nodata": _alineacion().NODATA},
+        depende=["recorte"],
+    ),
+    # delta -> estadísticas regionales -> Z se calculan juntos en analisis.py
+    "analisis": Etapa(
+        "analisis",
+        "analisis",
+        entradas=lambda: _salidas_recorte()
+        + _salidas_alineacion()
+        + archivos_vectoriales(_analisis().VECTOR_PATH),
+        salidas=_salidas_analisis,
+        parametros=lambda: {
+            "nodata": _analisis().NODATA_VAL_OUT,
+            "mean_std": _analisis().ESCRIBIR_MEAN_STD,
+        },
+        depende=["alineacion"],
+    ),
+    "reporte": Etapa(
+        "reporte",
+        "analisis_sin_invertir",
+        entradas=_entradas_reporte,
+        salidas=lambda: [Path(_reporte().OUTPUT_EXCEL)],
+        parametros=lambda: {"nodata": _reporte().NODATA_VAL_OUT},
+        depende=["analisis"],
+    ),
+}
+
+
+def orden_topologico(etapas):
+    orden = []
+    visitadas = set()
+
+    def visita(nombre):
+        if nombre in visitadas:
+            return
+        visitadas.add(nombre)
+        for dep in etapas[nombre].depende:
+            visita(dep)
+        orden.append(nombre)
+
+    for nombre in etapas:
+        visita(nombre)
+    return orden
+
+
+# ---------------------------------------------------
+# MANIFIESTO
+# ---------------------------------------------------
+
+
+def lee_manifiesto(path=MANIFIESTO_PATH):
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def guarda_manifiesto(manifiesto, path=MANIFIESTO_PATH):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifiesto, f, indent=2, sort_keys=True)
+    tmp.replace(path)
+
+
+def al_dia(registro, firma, contenido=False):
+    # La etapa está al día si sus entradas y parámetros no cambiaron y
+    # sus salidas siguen siendo las que se registraron (una salida que no
+    # existia al registrarse no cuenta como al dia)
+    if not registro or registro.get("firma") != firma:
+        return False
+    return all(
+        firma_salida is not None and firma_archivo(path, contenido) == firma_salida
+        for path, firma_salida in registro.get("salidas", {}).items()
+    )
+
+
+def tareas_fallidas(valor):
+    # Tareas con error en lo que devuelve el main de una etapa: {clave: ResultadoTarea}
+    # (o una tupla que lo incluye). None: la etapa se interrumpio antes de terminar.
+    if valor is None:
+        return ["etapa interrumpida"]
+    partes = valor if isinstance(valor, tuple) else (valor,)
+    return [
+        str(clave)
+        for parte in partes
+        if isinstance(parte, dict)
+        for clave, resultado in parte.items()
+        if isinstance(resultado, ResultadoTarea) and not resultado.ok
+    ]
+
+
+def ejecuta_pipeline(workers=1, contenido=False, forzar=(), hasta=None):
+    manifiesto = lee_manifiesto()
+    orden = orden_topologico(ETAPAS)
+    if hasta is not None:
+        orden = orden[: orden.index(hasta) + 1]
+
+    ejecutadas = []
+    for nombre in orden:
+        etapa = ETAPAS[nombre]
+        firma, _ = firma_etapa(etapa.entradas(), etapa.parametros(), contenido)
+
+        if nombre not in forzar and "todas" not in forzar and al_dia(
+            manifiesto.get(nombre), firma, contenido
+        ):
+            print(f"[{nombre}] al día, se omite")
+            continue
+
+        print(f"[{nombre}] ejecutando...")
+        inicio = time.perf_counter()
+        with mide_etapa(nombre, categoria="pipeline"):
+            valor = importlib.import_module(etapa.modulo).main(["--workers", str(workers)])
+        segundos = time.perf_counter() - inicio
+
+        # Con tareas fallidas las salidas pueden estar incompletas: la etapa no se
+        # registra (la proxima corrida la repite) y las siguientes no se ejecutan
+        fallidas = tareas_fallidas(valor)
+        if fallidas:
+            manifiesto.pop(nombre, None)
+            guarda_manifiesto(manifiesto)
+            raise RuntimeError(f"[{nombre}] fallo: {', '.join(fallidas)}")
+
+        # La firma se recalcula: algunas entradas (p. ej. _ali.*) pueden cambiar al ejecutar
+        firma, _ = firma_etapa(etapa.entradas(), etapa.parametros(), contenido)
+        manifiesto[nombre] = {
+            "firma": firma,
+            "parametros": etapa.parametros(),
+            "salidas": {str(p): firma_archivo(p, contenido) for p in etapa.salidas()},
+            "segundos": round(segundos, 3),
+        }
+        guarda_manifiesto(manifiesto)
+        ejecutadas.append(nombre)
+
+    return ejecutadas
+
+
+@instrumenta("pipeline")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Ejecuta el flujo completo recalculando solo las etapas desactualizadas"
+    )
+    agrega_argumento_workers(parser)
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="compara el contenido (SHA-1) de los archivos en lugar de mtime + tamaño",
+    )
+    parser.add_argument(
+        "--forzar",
+        nargs="*",
+        default=[],
+        choices=list(ETAPAS) + ["todas"],
+        help="etapas a ejecutar aunque estén al día",
+    )
+    parser.add_argument("--hasta", choices=list(ETAPAS), help="última etapa a ejecutar")
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        ejecutadas = ejecuta_pipeline(
+            workers=args.workers, contenido=args.hash, forzar=args.forzar, hasta=args.hasta
+        )
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Etapas ejecutadas: {', '.join(ejecutadas) if ejecutadas else 'ninguna'}")
+
+
+if __name__ == "__main__":
+    main()
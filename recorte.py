@@ -1,8 +1,21 @@
+import argparse
+import shutil
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
 import fiona
+import numpy as np
 import rasterio
+from rasterio import dtypes
+from rasterio.features import geometry_mask, geometry_window
 from rasterio.mask import mask
+from rasterio.windows import Window
+
+from bloques import HILOS, agrega_argumentos_bloques, procesa_bloques, ventanas_grilla
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from paralelo import ResultadoTarea, agrega_argumento_workers, ejecuta_tareas
+from perfiles import agrega_argumento_perfil, aplica_perfil
+from zonas import IndiceEspacial
 
 # archivos a recortar
 RASTER_DIR = Path("./RASTER/originales/")
@@ -21,58 +34,351 @@ RASTERS_A_RECORTAR = [
 ]
 # Carpeta resultados recortados
 OUTPUT_DIR = Path("./RASTER/modificados/")
+# Lado (en pixeles) de los bloques del recorte por streaming y de los tiles de salida
+TAM_BLOQUE = 512
+# Lado de los tiles del modo por tiles (multiplo de TAM_BLOQUE): unidad de trabajo del pool
+TAM_TILE = 4096
+
+
+def recorta_raster(input_path, output_path, geometries):
+    # el archivo raster de entrada
+    with rasterio.open(input_path) as src:
+        # La funcion mask recorta el raster usando las geometrias del area de estudio
+        out_image, out_transform = mask(src, geometries, crop=True)
+
+        # Actualizar los metadatos para el nuevo raster
+        out_meta = src.meta.copy()
+        out_meta.update(
+            {
+                "driver": "GTiff",
+                "height": out_image.shape[1],
+                "width": out_image.shape[2],
+                "transform": out_transform,
+                "nodata": src.nodata,
+            }
+        )
+
+        # guardar raster recortado en la carpeta de salida
+        with rasterio.open(output_path, "w", **out_meta) as dest:
+            dest.write(out_image)
+
+    return output_path
+
+
+def _perfil_recorte(src, ventana, tam_bloque, perfil):
+    out_meta = src.meta.copy()
+    out_meta.update(
+        {
+            "driver": "GTiff",
+            "height": int(ventana.height),
+            "width": int(ventana.width),
+            "transform": src.window_transform(ventana),
+            "nodata": src.nodata,
+            "tiled": True,
+            "blockxsize": tam_bloque,
+            "blockysize": tam_bloque,
+            "compress": "lzw",
+            "BIGTIFF": "IF_SAFER",
+        }
+    )
+    return aplica_perfil(out_meta, perfil)
+
+
+def recorta_raster_bloques(
+    input_path,
+    output_path,
+    geometries,
+    hilos=HILOS,
+    tam_bloque=TAM_BLOQUE,
+    perfil="nativo",
+    ventana=None,
+):
+    # Recorte por streaming: mismo resultado que mask(..., crop=True), pero leyendo
+    # la ventana del area de estudio bloque a bloque. La memoria queda acotada por
+    # el tamaño del bloque y no por el de la region.
+    # Con `ventana` (en la grilla de entrada) se recorta solo esa parte de la
+    # ventana del area de estudio: un tile del modo por tiles.
+    with rasterio.open(input_path) as src:
+        # La misma ventana que usa mask(crop=True)
+        recorte = ventana if ventana is not None else geometry_window(src, geometries)
+        src_transform = src.transform
+        nodata = src.nodata if src.nodata is not None else 0
+        bandas = list(range(1, src.count + 1))
+        out_meta = _perfil_recorte(src, recorte, tam_bloque, perfil)
+
+    fila0, col0 = int(recorte.row_off), int(recorte.col_off)
+    alto, ancho = int(recorte.height), int(recorte.width)
+
+    # Ventanas alineadas a los tiles de salida, expresadas en la grilla de entrada.
+    # Las que no tocan ninguna geometria no se leen: el GeoTIFF rellena esos
+    # tiles con nodata al cerrarse
+    indice = IndiceEspacial(geometries, src_transform)
+    ventanas = indice.filtra(ventanas_grilla(alto, ancho, tam_bloque, fila0, col0))
+
+    def ventana_salida(window):
+        return Window(window.col_off - col0, window.row_off - fila0, window.width, window.height)
+
+    def kernel_recorte(window, datos):
+        data = datos["src"]
+        # Mascara rasterizada solo para este bloque y los poligonos que lo tocan
+        fuera = geometry_mask(
+            [indice.geometrias[i] for i in indice.en_ventana(window)],
+            out_shape=(int(window.height), int(window.width)),
+            transform=rasterio.windows.transform(window, src_transform),
+        )
+        return {"recorte": np.where(fuera, np.array(nodata, dtype=data.dtype), data)}
+
+    procesa_bloques(
+        {"src": (input_path, bandas)},
+        kernel_recorte,
+        salidas={"recorte": (output_path, out_meta)},
+        ventanas=ventanas,
+        hilos=hilos,
+        ventana_salida=ventana_salida,
+    )
+
+    return output_path
+
+
+# ---------------------------------------------------
+# RECORTE POR TILES (areas de estudio multi-pais)
+# ---------------------------------------------------
+
+
+def tiles_recorte(input_path, geometries, tam_tile=TAM_TILE):
+    # Grilla de tiles alineada a la ventana del area de estudio (y a sus bloques).
+    # Solo quedan los tiles que tocan alguna geometria, cada uno con los indices
+    # de sus poligonos: entre paises hay grandes areas vacias que no se procesan
+    with rasterio.open(input_path) as src:
+        recorte = geometry_window(src, geometries)
+        indice = IndiceEspacial(geometries, src.transform)
+    tiles = ventanas_grilla(
+        int(recorte.height), int(recorte.width), tam_tile, int(recorte.row_off), int(recorte.col_off)
+    )
+    return recorte, [(tile, indice.en_ventana(tile)) for tile in indice.filtra(tiles)]
+
+
+def tiles_dir(output_path):
+    return output_path.with_name(f"{output_path.stem}_tiles")
+
 
-# Crear directorio de salida si no existe
-if not OUTPUT_DIR.exists():
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+def escribe_mosaico(vrt_path, input_path, recorte, tiles):
+    # VRT con los tiles en su posicion dentro de la ventana del area de estudio.
+    # Donde no hay tile el VRT devuelve nodata (o 0 sin nodata, como mask)
+    with rasterio.open(input_path) as src:
+        transform = src.window_transform(recorte)
+        crs = src.crs
+        tipos = src.dtypes
+        nodatavals = src.nodatavals
 
-# Abre el archivo SHP con fiona y extraer las geometrías
-# Se usa with para asegurar que el archivo se cierre correctamente despues de la lectura
-if SHAPE_PATH.exists():
+    raiz = ET.Element(
+        "VRTDataset", rasterXSize=str(int(recorte.width)), rasterYSize=str(int(recorte.height))
+    )
+    if crs is not None:
+        ET.SubElement(raiz, "SRS").text = crs.to_wkt()
+    ET.SubElement(raiz, "GeoTransform").text = ", ".join(repr(v) for v in transform.to_gdal())
+
+    for n, (tipo, nodata) in enumerate(zip(tipos, nodatavals), start=1):
+        banda = ET.SubElement(
+            raiz, "VRTRasterBand", dataType=dtypes.typename_fwd[dtypes.dtype_rev[tipo]], band=str(n)
+        )
+        if nodata is not None:
+            ET.SubElement(banda, "NoDataValue").text = repr(float(nodata))
+        for tile, tile_path in tiles:
+            ancho, alto = str(int(tile.width)), str(int(tile.height))
+            fuente = ET.SubElement(banda, "SimpleSource")
+            ET.SubElement(fuente, "SourceFilename", relativeToVRT="1").text = str(
+                tile_path.relative_to(vrt_path.parent)
+            )
+            ET.SubElement(fuente, "SourceBand").text = str(n)
+            ET.SubElement(fuente, "SrcRect", xOff="0", yOff="0", xSize=ancho, ySize=alto)
+            ET.SubElement(
+                fuente,
+                "DstRect",
+                xOff=str(int(tile.col_off - recorte.col_off)),
+                yOff=str(int(tile.row_off - recorte.row_off)),
+                xSize=ancho,
+                ySize=alto,
+            )
+
+    ET.ElementTree(raiz).write(vrt_path)
+    return vrt_path
+
+
+def ensambla_mosaico(vrt_path, output_path, input_path, recorte, tiles, hilos=HILOS, perfil="nativo"):
+    # Copia el mosaico a un unico GeoTIFF, solo en los bloques cubiertos por tiles
+    with rasterio.open(input_path) as src:
+        out_meta = _perfil_recorte(src, recorte, TAM_BLOQUE, perfil)
+        bandas = list(range(1, src.count + 1))
+
+    ventanas = [
+        ventana
+        for tile, _ in tiles
+        for ventana in ventanas_grilla(
+            int(tile.height),
+            int(tile.width),
+            TAM_BLOQUE,
+            int(tile.row_off - recorte.row_off),
+            int(tile.col_off - recorte.col_off),
+        )
+    ]
+    procesa_bloques(
+        {"src": (vrt_path, bandas)},
+        lambda window, datos: {"recorte": datos["src"]},
+        salidas={"recorte": (output_path, out_meta)},
+        ventanas=ventanas,
+        hilos=hilos,
+    )
+    return output_path
+
+
+def arma_recorte(input_path, output_path, recorte, archivos, hilos=HILOS, perfil="nativo", mosaico=False):
+    # Mosaico VRT de los tiles; sin `mosaico` se copia a un unico GeoTIFF y los
+    # tiles se borran
+    vrt_path = escribe_mosaico(output_path.with_suffix(".vrt"), input_path, recorte, archivos)
+    if mosaico:
+        # Un GeoTIFF de una corrida anterior taparia al mosaico (grilla.ruta_recorte)
+        output_path.unlink(missing_ok=True)
+        return vrt_path
+    ensambla_mosaico(vrt_path, output_path, input_path, recorte, archivos, hilos, perfil)
+    vrt_path.unlink()
+    shutil.rmtree(tiles_dir(output_path))
+    return output_path
+
+
+def recorta_por_tiles(
+    rasters, geometries, workers=1, hilos=HILOS, perfil="nativo", mosaico=False, tam_tile=TAM_TILE
+):
+    # rasters: {nombre: (input_path, output_path)}. Los tiles de todos los rasters
+    # van a un unico pool de procesos y despues se arma cada raster.
+    if tam_tile % TAM_BLOQUE:
+        raise ValueError(f"El lado de los tiles ({tam_tile}) debe ser multiplo de {TAM_BLOQUE}")
+    resultados = {}
+    planes = {}
+    tareas = {}
+    for nombre, (input_path, output_path) in rasters.items():
+        try:
+            recorte, tiles = tiles_recorte(input_path, geometries, tam_tile)
+        except Exception as e:
+            resultados[nombre] = ResultadoTarea(nombre, False, error=f"{type(e).__name__}: {e}")
+            continue
+        directorio = tiles_dir(output_path)
+        directorio.mkdir(parents=True, exist_ok=True)
+        archivos = []
+        for tile, poligonos in tiles:
+            tile_path = directorio.joinpath(f"tile_{int(tile.row_off)}_{int(tile.col_off)}.tif")
+            archivos.append((tile, tile_path))
+            # Cada tile recibe solo sus poligonos. Los tiles intermedios usan el
+            # perfil nativo y el pedido se aplica al armar el GeoTIFF (en el
+            # mosaico, a cada tile)
+            tareas[(nombre, tile_path.name)] = (
+                input_path,
+                tile_path,
+                [geometries[i] for i in poligonos],
+                hilos,
+                TAM_BLOQUE,
+                perfil if mosaico else "nativo",
+                tile,
+            )
+        planes[nombre] = (input_path, output_path, recorte, archivos, hilos, perfil, mosaico)
+
+    for (nombre, _), resultado in ejecuta_tareas(recorta_raster_bloques, tareas, workers=workers).items():
+        if not resultado.ok and nombre in planes:
+            planes.pop(nombre)
+            resultados[nombre] = ResultadoTarea(nombre, False, error=resultado.error)
+
+    resultados.update(ejecuta_tareas(arma_recorte, planes, workers=workers))
+    return {nombre: resultados[nombre] for nombre in rasters if nombre in resultados}
+
+
+@instrumenta("recorte")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recorta los rasters bioclimaticos al area de estudio"
+    )
+    agrega_argumento_workers(parser)
+    agrega_argumentos_bloques(parser)
+    agrega_argumento_perfil(parser)
+    parser.add_argument(
+        "--modo",
+        choices=["bloques", "tiles", "mask"],
+        default="bloques",
+        help="bloques: recorte por streaming (tiled + LZW); tiles: tiles del area de estudio en "
+        "paralelo (--workers); mask: recorte en memoria con rasterio.mask",
+    )
+    parser.add_argument(
+        "--tam-tile", type=int, default=TAM_TILE, help="lado de los tiles del modo tiles (multiplo de 512)"
+    )
+    parser.add_argument(
+        "--mosaico",
+        action="store_true",
+        help="en modo tiles, deja los tiles y un mosaico recorte_*.vrt en lugar de armar el GeoTIFF",
+    )
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    # Crear directorio de salida si no existe
+    if not OUTPUT_DIR.exists():
+        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    if not SHAPE_PATH.exists():
+        return
+
+    # Abre el archivo SHP con fiona y extraer las geometrías
+    # Se usa with para asegurar que el archivo se cierre correctamente despues de la lectura
     with fiona.open(SHAPE_PATH, "r") as shapefile:
         # La funcion mask de rasterio necesita una lista de geometrias, entocnes recolectamos todas las geometrias de nuestro shp aca
         geometries = [feature["geometry"] for feature in shapefile]
     if not geometries:
         print("ERROR: El archivo SHP no contiene geometrias")
+        return
+
+    print(f"SHP cargado exitosamente: {len(geometries)} geometrias")
+    tareas = {}
+    faltantes = {}
+    for raster_name in RASTERS_A_RECORTAR:
+        input_path = RASTER_DIR.joinpath(raster_name)
+        if not input_path.exists():
+            print("ERROR: raster no encontrado")
+            faltantes[raster_name] = ResultadoTarea(raster_name, False, error=f"no existe {input_path}")
+            continue  # sigue para el proximo
+        output_path = OUTPUT_DIR.joinpath(f"recorte_{raster_name.split('/')[-1]}")
+        if args.modo != "mask":
+            tareas[raster_name] = (
+                input_path, output_path, geometries, args.hilos, TAM_BLOQUE, args.perfil
+            )
+        else:
+            tareas[raster_name] = (input_path, output_path, geometries)
+
+    print(f"Procesando {len(tareas)} rasters...")
+    if args.modo == "tiles":
+        resultados = recorta_por_tiles(
+            {nombre: tarea[:2] for nombre, tarea in tareas.items()},
+            geometries,
+            args.workers,
+            args.hilos,
+            args.perfil,
+            args.mosaico,
+            args.tam_tile,
+        )
     else:
-        print(f"SHP cargado exitosamente: {len(geometries)} geometrias")
-        for raster_name in RASTERS_A_RECORTAR:
-            input_path = RASTER_DIR.joinpath(raster_name)
-            if not input_path.exists():
-                print("ERROR: raster no encontrado")
-                continue  # sigue para el proximo
-            output_path = OUTPUT_DIR.joinpath(f"recorte_{raster_name.split('/')[-1]}")
-
-            try:
-                print(f"Procesando: {raster_name}...")
-                # el archivo raster de entrada
-                with rasterio.open(input_path) as src:
-                    # La funcion mask recorta el raster usando las geometrias obtenidas arriba
-                    out_image, out_transform = mask(src, geometries, crop=True)
-
-                    # Actualizar los metadatos para el nuevo raster
-                    out_meta = src.meta.copy()
-                    out_meta.update(
-                        {
-                            "driver": "GTiff",
-                            "height": out_image.shape[1],
-                            "width": out_image.shape[2],
-                            "transform": out_transform,
-                            "nodata": src.nodata,
-                        }
-                    )
-
-                    # guardar raster recortado en la carpeta de salida
-                    with rasterio.open(output_path, "w", **out_meta) as dest:
-                        dest.write(out_image)
-
-                print(f"Recorte exitoso! Guardado en: {output_path}")
-
-            except rasterio.RasterioIOError:
-                print(
-                    f" ERROR: No se pudo abrir o encontrar el archivo raster: {input_path}"
-                )
-            except Exception as e:
-                print(f" ERROR al procesar {raster_name}: {e}")
-
-        print("Proceso de recorte Completo")
+        funcion = recorta_raster_bloques if args.modo == "bloques" else recorta_raster
+        resultados = ejecuta_tareas(funcion, tareas, workers=args.workers)
+
+    for raster_name, resultado in resultados.items():
+        if resultado.ok:
+            print(f"Recorte exitoso! Guardado en: {resultado.valor}")
+        elif resultado.error.startswith("RasterioIOError"):
+            print(
+                f" ERROR: No se pudo abrir o encontrar el archivo raster: {tareas[raster_name][0]}"
+            )
+        else:
+            print(f" ERROR al procesar {raster_name}: {resultado.error}")
+
+    print("Proceso de recorte Completo")
+    resultados.update(faltantes)
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
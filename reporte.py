@@ -0,0 +1,240 @@
+import argparse
+import os
+from math import pi
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from instrumentacion import agrega_argumentos_instrumentacion, instrumenta
+from paralelo import agrega_argumento_workers, ejecuta_tareas
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
+
+# Reporte de hotspots a partir de la tabla columnar de estadisticas zonales
+# (una fila por zona de cada capa, columna CAPA). Rankings y top/bottom-N se
+# calculan de forma vectorizada para todas las capas a la vez, y los radares se
+# dibujan en paralelo a archivos PNG (Figure sin pyplot: sin backend interactivo).
+# La tabla es Parquet si pyarrow esta instalado; si no, CSV.
+EXTENSION_TABLA = ".parquet" if pyarrow is not None else ".csv"
+N_RADAR = 3
+
+COLS_RANKING = [
+    'RANK', 'PAIS_KEY', 'NIVEL_ADM', 'NOMBRE_ZONA',
+    'I_estress_termico', 'I_estress_hidrico', 'Indice_consolidado',
+    'delta_BIO1', 'delta_BIO5', 'delta_BIO14', 'delta_BIO15',
+    'z_bio1', 'z_bio5', 'z_bio14', 'z_bio15',
+]
+COLS_CAPA = ['PAIS_KEY', 'NIVEL_ADM', 'NOMBRE_ZONA', 'I_estress_termico', 'I_estress_hidrico', 'Indice_consolidado']
+CATEGORIAS_ZSCORE = ['z_bio1', 'z_bio5', 'z_bio14', 'z_bio15']
+VARIABLES_BIO = ['BIO1', 'BIO5', 'BIO14', 'BIO15']
+# Capas que entran al radar por pais (una por pais)
+CAPAS_RADAR = ["PARAGUAY_DEPTO", "URUGUAY_DEPTO", "BRASIL_ESTADO", "ARGENTINA_PROV"]
+
+CORES_MAIORES = ['#984ea3', '#ff7f00', '#a65628']
+CORES_MENORES = ['#4daf4a', '#377eb8', '#e41a1c']
+
+
+# ---------------------------------------------------
+# TABLA ZONAL
+# ---------------------------------------------------
+
+
+def escribe_tabla(tabla, path):
+    if str(path).endswith(".parquet"):
+        tabla.to_parquet(path, index=False)
+    else:
+        tabla.to_csv(path, index=False)
+    return path
+
+
+def lee_tabla(path):
+    if str(path).endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def nombre_hoja(capa):
+    return capa.replace('_DEPTO', ' (Dptos)').replace('_ESTADO', ' (Ests)').replace('_PROV', ' (Prov)').replace('_REGION', ' (Regiones)')
+
+
+# ---------------------------------------------------
+# RANKINGS
+# ---------------------------------------------------
+
+
+def separa_agregados(tabla):
+    # (zonas, niveles agregados): las filas AGREGADO (pais, area de estudio)
+    # resumen zonas que ya estan en la tabla y no entran al ranking ni al radar
+    if 'AGREGADO' not in tabla.columns:
+        return tabla, tabla.iloc[:0]
+    agregado = tabla['AGREGADO'].astype(bool)
+    return tabla[~agregado], tabla[agregado]
+
+
+def ranking(tabla):
+    # Zonas validas ordenadas por indice consolidado (desc) con el rank global
+    # y el rank dentro de su capa; el orden estable respeta el de las capas
+    tabla = tabla.dropna(subset=['Indice_consolidado'])
+    tabla = tabla.sort_values('Indice_consolidado', ascending=False, kind='mergesort', ignore_index=True)
+    tabla['RANK'] = np.arange(1, len(tabla) + 1)
+    tabla['RANK_CAPA'] = tabla.groupby('CAPA', sort=False).cumcount() + 1
+    return tabla
+
+
+def extremos(ordenada, grupo, n=N_RADAR):
+    # Top-n y bottom-n de cada grupo sobre la tabla ya ordenada (desc), sin
+    # iterar por grupo: posicion dentro del grupo contra el tamaño del grupo
+    grupos = ordenada.groupby(grupo, sort=False)
+    posicion = grupos.cumcount()
+    tam = grupos['Indice_consolidado'].transform('size')
+    mayores = ordenada[posicion < n]
+    menores = ordenada[posicion >= tam - n].iloc[::-1]
+    return mayores, menores, tam
+
+
+# ---------------------------------------------------
+# EXCEL
+# ---------------------------------------------------
+
+
+def _escribe_hoja(libro, nombre, df, columnas, encabezado):
+    # Columna a columna con xlsxwriter: la mitad del tiempo que df.to_excel,
+    # que formatea celda por celda. NaN queda como celda vacia (como en pandas).
+    hoja = libro.add_worksheet(nombre)
+    hoja.write_row(0, 0, columnas, encabezado)
+    for j, col in enumerate(columnas):
+        valores = df[col]
+        hoja.write_column(1, j, valores.astype(object).where(valores.notna(), None).tolist())
+
+
+def escribe_excel(path, ordenada, capas, agregados=None):
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        # El mismo formato de encabezado que usa pandas
+        encabezado = writer.book.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        _escribe_hoja(writer.book, 'Ranking Global de Riesgo', ordenada, COLS_RANKING, encabezado)
+
+        cols_sheet = ['RANK_CAPA'] + COLS_CAPA + [
+            col for col in ordenada.columns
+            if ('delta_' in col or 'z_' in col or '_min' in col or '_max' in col)
+        ]
+        # La tabla ya esta ordenada: cada hoja es su capa, en el mismo orden.
+        # Los niveles agregados solo tienen su propia hoja, con su propio rank
+        # (vacio si no tienen indice).
+        por_capa = dict(tuple(ordenada.groupby('CAPA', sort=False)))
+        if agregados is not None and not agregados.empty:
+            agregados = agregados.sort_values('Indice_consolidado', ascending=False, kind='mergesort')
+            rank = agregados.groupby('CAPA', sort=False).cumcount() + 1
+            agregados = agregados.assign(RANK_CAPA=rank.where(agregados['Indice_consolidado'].notna()))
+            por_capa.update(tuple(agregados.groupby('CAPA', sort=False)))
+        for capa in capas:
+            if capa in por_capa:
+                _escribe_hoja(writer.book, nombre_hoja(capa), por_capa[capa], cols_sheet, encabezado)
+    return path
+
+
+# ---------------------------------------------------
+# RADAR (Adaptado a Z-scores de 4 BIOs)
+# ---------------------------------------------------
+
+
+def _panel(fig, posicion, titulo, nombres, valores, colores, angles, variables_bio, max_val):
+    ax = fig.add_subplot(posicion, polar=True)
+    ax.set_title(titulo, size=14, fontweight='bold', pad=20)
+
+    cerrados = np.concatenate([valores, valores[:, :1]], axis=1)
+    for nombre, fila, color in zip(nombres, cerrados, colores):
+        ax.plot(angles, fila, linewidth=2, linestyle='solid', label=nombre, color=color)
+        ax.fill(angles, fila, alpha=0.15, color=color)
+
+    ax.set_theta_offset(pi / 2)
+    ax.set_theta_direction(-1)
+    ax.set_xticks(angles[:-1])
+    ax.set_xticklabels(variables_bio)
+    ax.set_rlim(-max_val, max_val)
+    ax.legend(loc='lower right', bbox_to_anchor=(1.3, -.1), title="Zonas")
+
+
+def dibuja_radar(salida, pais_nombre, mayores, menores, max_val, variables_bio=VARIABLES_BIO):
+    # mayores/menores: (nombres, array zonas x variables)
+    angles = [n / float(len(variables_bio)) * 2 * pi for n in range(len(variables_bio))]
+    angles += angles[:1]
+
+    fig = Figure(figsize=(14, 6))
+    _panel(fig, 121, f'Top 3 de Mayor Riesgo - {pais_nombre}', *mayores, CORES_MAIORES, angles, variables_bio, max_val)
+    _panel(fig, 122, f'Top 3 de Menor Riesgo - {pais_nombre}', *menores, CORES_MENORES, angles, variables_bio, max_val)
+    fig.tight_layout()
+    fig.savefig(salida, dpi=100, bbox_inches="tight")
+    return salida
+
+
+def tareas_radar(ordenada, capas, radar_dir):
+    # Una tarea por pais con los arrays ya seleccionados (livianos para el pool)
+    tabla = ordenada[ordenada['CAPA'].isin(capas)]
+    if tabla.empty:
+        return {}
+    nivel = tabla.groupby('PAIS_KEY', sort=False)['NIVEL_ADM'].first()
+    max_val = tabla[CATEGORIAS_ZSCORE].abs().groupby(tabla['PAIS_KEY']).max().max(axis=1) * 1.2
+
+    mayores, menores, tam = extremos(tabla, 'PAIS_KEY', N_RADAR)
+    tamanos = tam.groupby(tabla['PAIS_KEY']).first()
+    grupos_may = dict(tuple(mayores.groupby('PAIS_KEY', sort=False)))
+    grupos_men = dict(tuple(menores.groupby('PAIS_KEY', sort=False)))
+
+    tareas = {}
+    for pais in pd.unique(tabla['PAIS_KEY']):
+        nombre_completo = f"{pais} ({nivel[pais]})"
+        if tamanos[pais] < N_RADAR:
+            print(f"Datos insuficientes para el Radar de {nombre_completo}. (Se requieren {N_RADAR} zonas).")
+            continue
+        tareas[pais] = (
+            os.path.join(radar_dir, f"RADAR_{pais}.png"),
+            nombre_completo,
+            (grupos_may[pais]['NOMBRE_ZONA'].tolist(), grupos_may[pais][CATEGORIAS_ZSCORE].to_numpy()),
+            (grupos_men[pais]['NOMBRE_ZONA'].tolist(), grupos_men[pais][CATEGORIAS_ZSCORE].to_numpy()),
+            max_val[pais],
+        )
+    return tareas
+
+
+def genera_reporte(tabla, excel_path, radar_dir, capas_radar=CAPAS_RADAR, workers=1):
+    zonas, agregados = separa_agregados(tabla)
+    ordenada = ranking(zonas)
+    capas = list(pd.unique(tabla['CAPA']))
+
+    escribe_excel(excel_path, ordenada, capas, agregados)
+    print(f"Excel Estadistico generado: {excel_path}")
+
+    print("\nGenerando radar de Z-score por pais...")
+    os.makedirs(radar_dir, exist_ok=True)
+    # {pais: ResultadoTarea}; valor es la ruta del PNG
+    radares = ejecuta_tareas(dibuja_radar, tareas_radar(ordenada, capas_radar, radar_dir), workers=workers)
+    for pais, resultado in radares.items():
+        if not resultado.ok:
+            print(f"ERROR al generar el radar de {pais}: {resultado.error}")
+            continue
+        print(f"Radar guardado: {resultado.valor}")
+    return ordenada, radares
+
+
+@instrumenta("reporte_hotspots")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Excel de ranking y radares por pais a partir de la tabla de estadisticas zonales"
+    )
+    parser.add_argument("tabla", help="tabla zonal (.parquet o .csv) generada por analisis_sin_invertir.py")
+    parser.add_argument("--excel", default="Reporte_Hotspots_Zonal_MultiPais.xlsx")
+    parser.add_argument("--radar-dir", default="RADAR")
+    parser.add_argument("--capas-radar", nargs="+", default=CAPAS_RADAR)
+    agrega_argumento_workers(parser)
+    agrega_argumentos_instrumentacion(parser)
+    args = parser.parse_args(argv)
+
+    genera_reporte(lee_tabla(args.tabla), args.excel, args.radar_dir, args.capas_radar, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import hashlib
+import os
+import time
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.windows import bounds
+from rasterio.windows import transform as transform_ventana
+from shapely.geometry import box, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+
+from bloques import ventanas_grilla
+from cuantizacion import decodificador
+from estadisticas import combina_momentos
+from instrumentacion import REGISTRO
+from grilla import RegistroGrillas, firma_raster
+
+# Etiqueta de los pixeles que no pertenecen a ninguna region
+SIN_ZONA = 0
+
+
+def dtype_etiquetas(n_zonas):
+    # uint16 alcanza para cualquier capa administrativa del area de estudio
+    return "uint16" if n_zonas < np.iinfo(np.uint16).max else "uint32"
+
+
+class IndiceEspacial:
+    # STRtree sobre las geometrias de una capa: que poligonos tocan cada ventana
+    # de la grilla. Permite saltear ventanas fuera de toda zona (oceano, fuera del
+    # area de estudio) y rasterizar solo los poligonos de cada ventana.
+
+    def __init__(self, geometrias, transform):
+        self.geometrias = [
+            g if isinstance(g, BaseGeometry) else shape(g) for g in geometrias
+        ]
+        self.transform = transform
+        self.arbol = STRtree(self.geometrias)
+
+    def __getstate__(self):
+        # El arbol se reconstruye en el proceso que lo recibe
+        estado = self.__dict__.copy()
+        del estado["arbol"]
+        return estado
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self.arbol = STRtree(self.geometrias)
+
+    def en_ventana(self, window):
+        # Indices (0..N-1) de las geometrias que intersectan la ventana
+        caja = box(*bounds(window, self.transform))
+        return np.sort(self.arbol.query(caja, predicate="intersects"))
+
+    def toca(self, window):
+        return len(self.en_ventana(window)) > 0
+
+    def filtra(self, ventanas):
+        return [w for w in ventanas if self.toca(w)]
+
+
+def rasteriza_zonas(geometrias, ref_path, out_path=None, all_touched=False):
+    # Rasteriza las geometrias UNA sola vez sobre la grilla de referencia.
+    # Cada pixel recibe el id (1..N) de la region que lo contiene y SIN_ZONA fuera de ellas.
+    # Se recorre por ventanas de 512 con el indice espacial: las ventanas sin
+    # poligonos quedan en SIN_ZONA y el resto rasteriza solo los que la tocan.
+    geometrias = list(geometrias)
+    dtype = dtype_etiquetas(len(geometrias))
+
+    with rasterio.open(ref_path) as ref:
+        indice = IndiceEspacial(geometrias, ref.transform)
+        etiquetas = np.full((ref.height, ref.width), SIN_ZONA, dtype=dtype)
+        for window in ventanas_grilla(ref.height, ref.width, 512):
+            tocan = indice.en_ventana(window)
+            if len(tocan) == 0:
+                continue
+            etiquetas[window.toslices()] = rasterize(
+                ((indice.geometrias[i], i + 1) for i in tocan),
+                out_shape=(int(window.height), int(window.width)),
+                transform=ref.window_transform(window),
+                fill=SIN_ZONA,
+                all_touched=all_touched,
+                dtype=dtype,
+            )
+        profile = ref.profile.copy()
+
+    if out_path is not None:
+        profile.update(
+            driver="GTiff",
+            count=1,
+            dtype=dtype,
+            nodata=SIN_ZONA,
+            compress="lzw",
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+        )
+        with rasterio.open(out_path, "w", **profile) as dst:
+            dst.write(etiquetas, 1)
+
+    return etiquetas
+
+
+def ruta_cache_zonas(cache_dir, prefijo, ref_path, origen=None, extension=".tif"):
+    # Ruta en cache_dir de un derivado de una capa vectorial sobre la grilla de
+    # referencia (indice de etiquetas, matriz de cobertura): <prefijo>_<firma>,
+    # con la firma de la grilla y la version del archivo vectorial (origen)
+    registro = RegistroGrillas()
+    partes = [registro.firma(ref_path)]
+    registro.guarda()
+    if origen is not None and os.path.exists(origen):
+        stat = os.stat(origen)
+        partes += [os.path.abspath(origen), str(stat.st_size), str(stat.st_mtime_ns)]
+    firma = hashlib.sha1("|".join(partes).encode()).hexdigest()[:16]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"{prefijo}_{firma}{extension}")
+
+
+def indice_zonas(geometrias, ref_path, clave, cache_dir=None, origen=None):
+    # Indice de zonas de una capa vectorial sobre la grilla de referencia.
+    # Con cache_dir se guarda como GeoTIFF de etiquetas, identificado por la capa,
+    # la firma de la grilla y la version del archivo vectorial (origen).
+    # Devuelve la ruta del GeoTIFF o, sin cache, el array de etiquetas en memoria.
+    if cache_dir is None:
+        return rasteriza_zonas(geometrias, ref_path)
+
+    out_path = ruta_cache_zonas(cache_dir, f"ZONAS_{clave}", ref_path, origen)
+    if not os.path.exists(out_path):
+        rasteriza_zonas(geometrias, ref_path, out_path)
+    return out_path
+
+
+def asigna_padres(hijas, padres):
+    # Zona padre (1..M) de cada zona hija por mayor area de interseccion, con la
+    # posicion 0 = SIN_ZONA como en EstadisticasZonales (para agrupa()).
+    # Devuelve tambien la fraccion del area de cada hija que cae en su padre.
+    hijas = [g if isinstance(g, BaseGeometry) else shape(g) for g in hijas]
+    padres = np.array([g if isinstance(g, BaseGeometry) else shape(g) for g in padres], dtype=object)
+    arbol = STRtree(padres)
+
+    asignacion = np.full(len(hijas) + 1, SIN_ZONA, dtype="int64")
+    fraccion = np.zeros(len(hijas))
+    for i, hija in enumerate(hijas):
+        candidatos = arbol.query(hija, predicate="intersects")
+        if len(candidatos) == 0:
+            continue
+        areas = shapely.area(shapely.intersection(padres[candidatos], hija))
+        mejor = np.argmax(areas)
+        asignacion[i + 1] = candidatos[mejor] + 1
+        fraccion[i] = areas[mejor] / hija.area if hija.area > 0 else 1.0
+    return asignacion, fraccion
+
+
+def _reduce_extremos(ids, vals, n):
+    # min y max por zona con un unico ordenamiento + ufunc.reduceat
+    minimo = np.full(n, np.inf)
+    maximo = np.full(n, -np.inf)
+    if ids.size == 0:
+        return minimo, maximo
+    orden = np.argsort(ids, kind="stable")
+    ids_ord = ids[orden]
+    vals_ord = vals[orden]
+    inicio = np.flatnonzero(np.r_[True, ids_ord[1:] != ids_ord[:-1]])
+    zonas = ids_ord[inicio]
+    minimo[zonas] = np.minimum.reduceat(vals_ord, inicio)
+    maximo[zonas] = np.maximum.reduceat(vals_ord, inicio)
+    return minimo, maximo
+
+
+class EstadisticasZonales:
+    # Conteo, media y M2 por región (Welford / Chan) y opcionalmente min / max,
+    # acumulados ventana a ventana. Se pueden combinar entre procesos con combina().
+    # La posicion 0 corresponde a SIN_ZONA y se ignora en los resultados.
+
+    def __init__(self, n_zonas, extremos=False):
+        self.n_zonas = n_zonas
+        self.count = np.zeros(n_zonas + 1, dtype="int64")
+        self.media_ = np.zeros(n_zonas + 1, dtype="float64")
+        self.m2 = np.zeros(n_zonas + 1, dtype="float64")
+        self.extremos = extremos
+        if extremos:
+            self.minimo = np.full(n_zonas + 1, np.inf)
+            self.maximo = np.full(n_zonas + 1, -np.inf)
+
+    def agrega(self, etiquetas, valores, validos):
+        ids = etiquetas[validos]
+        vals = valores[validos].astype("float64")
+        n = self.n_zonas + 1
+
+        # Momentos de la ventana por zona y fusión con lo acumulado
+        n_b = np.bincount(ids, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            media_b = np.bincount(ids, weights=vals, minlength=n) / n_b
+        media_b[n_b == 0] = 0.0
+        m2_b = np.bincount(ids, weights=np.square(vals - media_b[ids]), minlength=n)
+        self.count, self.media_, self.m2 = combina_momentos(
+            self.count, self.media_, self.m2, n_b, media_b, m2_b
+        )
+
+        if self.extremos:
+            minimo, maximo = _reduce_extremos(ids, vals, n)
+            np.minimum(self.minimo, minimo, out=self.minimo)
+            np.maximum(self.maximo, maximo, out=self.maximo)
+
+    def combina(self, otro):
+        self.count, self.media_, self.m2 = combina_momentos(
+            self.count, self.media_, self.m2, otro.count, otro.media_, otro.m2
+        )
+        if self.extremos and otro.extremos:
+            np.minimum(self.minimo, otro.minimo, out=self.minimo)
+            np.maximum(self.maximo, otro.maximo, out=self.maximo)
+        return self
+
+    def agrupa(self, padres, n_padres):
+        # Estadisticas de zonas padre (uniones de estas zonas) sin volver a leer
+        # rasters: momentos combinados por grupo (Chan) y extremos por grupo.
+        # padres[i] = zona padre (1..n_padres) de la zona i; 0 = sin padre
+        padres = np.asarray(padres)
+        n = n_padres + 1
+        count = np.bincount(padres, weights=self.count, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            media = np.bincount(padres, weights=self.count * self.media_, minlength=n) / count
+        media[count == 0] = 0.0
+        desvio = self.media_ - media[padres]
+        m2 = np.bincount(padres, weights=self.m2 + self.count * desvio * desvio, minlength=n)
+
+        st = EstadisticasZonales(n_padres, extremos=self.extremos)
+        st.count = count.astype(self.count.dtype)
+        st.media_ = media
+        st.m2 = m2
+        if self.extremos:
+            np.minimum.at(st.minimo, padres, self.minimo)
+            np.maximum.at(st.maximo, padres, self.maximo)
+        return st
+
+    def min(self):
+        return np.where(self.count > 0, self.minimo, np.nan)
+
+    def max(self):
+        return np.where(self.count > 0, self.maximo, np.nan)
+
+    def media(self):
+        return np.where(self.count > 0, self.media_, np.nan)
+
+    def std(self):
+        # Desviacion estandar poblacional (ddof=0), igual que rasterstats
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+
+
+def agrega_tocados(estadisticas, indice, window, ids, valores, validos):
+    # Completa las estadisticas de la ventana (ya agregadas con las etiquetas,
+    # regla del centro) hasta la regla all_touched de rasterstats: cada region
+    # suma ademas los pixeles que su poligono toca sin contener el centro. Un
+    # pixel de un borde compartido cuenta para todas las regiones que lo tocan,
+    # igual que zonal_stats(..., all_touched=True) poligono por poligono.
+    caja = box(*bounds(window, indice.transform))
+    transform = transform_ventana(window, indice.transform)
+    for i in indice.en_ventana(window):
+        geometria = indice.geometrias[i]
+        if geometria.contains(caja):
+            continue
+        tocados = rasterize(
+            [geometria], out_shape=ids.shape, transform=transform, all_touched=True, dtype="uint8"
+        ).view(bool)
+        extra = tocados & validos & (ids != i + 1)
+        if extra.any():
+            estadisticas.agrega(np.where(extra, i + 1, SIN_ZONA), valores, extra)
+
+
+def tabla_lookup(valores_por_zona):
+    # Vector indexable por etiqueta: lut[etiquetas] devuelve el valor de cada pixel.
+    # Las zonas sin valor (o fuera de zona) quedan como NaN.
+    lut = np.asarray(valores_por_zona, dtype="float32").copy()
+    lut[SIN_ZONA] = np.nan
+    return lut
+
+
+def tablas_z(estadisticas):
+    # Media y desviacion por region como tablas indexables por etiqueta; las
+    # regiones con desviacion 0 quedan en NaN (sin Z)
+    mean_lut = tabla_lookup(estadisticas.media())
+    std_lut = tabla_lookup(estadisticas.std())
+    std_lut[std_lut == 0] = np.nan
+    return mean_lut, std_lut
+
+
+def rango_z(estadisticas):
+    # Cotas (min, max) del Z de todas las regiones a partir de su media,
+    # desviacion y extremos (estadisticas con extremos=True). Cubren todos los
+    # pixeles acumulados, asi que tambien los que z_regional asigna por etiqueta.
+    mean_lut, std_lut = tablas_z(estadisticas)
+    with np.errstate(invalid="ignore"):
+        z_min = (estadisticas.min() - mean_lut) / std_lut
+        z_max = (estadisticas.max() - mean_lut) / std_lut
+    validos = ~np.isnan(z_min)
+    if not validos.any():
+        return np.nan, np.nan
+    return float(z_min[validos].min()), float(z_max[validos].max())
+
+
+def z_regional(ids, delta, mean_lut, std_lut, nodata):
+    # Z = (delta - media[id]) / std[id] de una ventana, sin rasters MEAN_/STD_:
+    # las tablas por region se indexan con las etiquetas y solo en los pixeles
+    # validos. Devuelve (z, validos).
+    s = std_lut[ids]
+    validos = (delta != nodata) & ~np.isnan(s)
+    z = np.full(delta.shape, nodata, dtype="float32")
+    z[validos] = (delta[validos] - mean_lut[ids[validos]]) / s[validos]
+    return z, validos
+
+
+def _lee(src, window, cache=None):
+    if cache is not None:
+        return cache.ventana(src.name, window)
+    return src.read(1, window=window)
+
+
+def estadisticas_multicapa(capas, rasters, nodata, extremos=True, cache=None, ventanas=None):
+    # Estadisticas de TODAS las zonas de TODAS las capas para TODOS los rasters
+    # en una sola pasada por bloques: cada raster se lee una unica vez.
+    # capas: {clave: (indice, n_zonas)}, con indice = ruta GeoTIFF o array de etiquetas
+    # rasters: {nombre: ruta}, todos sobre la misma grilla que los indices
+    # cache: cache.CacheRaster opcional; rasters e indices se leen de su memmap
+    # ventanas: ventanas a recorrer (p. ej. las que tocan alguna zona segun
+    # IndiceEspacial); por defecto todos los bloques de la grilla
+    # Devuelve {clave: {nombre: EstadisticasZonales}}
+    resultado = {
+        clave: {nombre: EstadisticasZonales(n, extremos=extremos) for nombre in rasters}
+        for clave, (_, n) in capas.items()
+    }
+
+    with ExitStack() as stack:
+        fuentes = {
+            nombre: stack.enter_context(rasterio.open(path))
+            for nombre, path in rasters.items()
+        }
+        indices = {
+            clave: stack.enter_context(rasterio.open(indice))
+            if isinstance(indice, (str, os.PathLike))
+            else indice
+            for clave, (indice, _) in capas.items()
+        }
+        # Los rasters cuantizados se decodifican al leer
+        decodificadores = {nombre: decodificador(src) for nombre, src in fuentes.items()}
+        ref = next(iter(fuentes.values()))
+        for src in fuentes.values():
+            assert firma_raster(src) == firma_raster(ref)
+
+        if ventanas is None:
+            ventanas = [window for _, window in ref.block_windows(1)]
+        for window in ventanas:
+            inicio, t0 = time.time(), time.perf_counter()
+            etiquetas = {
+                clave: _lee(indice, window, cache)
+                if hasattr(indice, "read")
+                else indice[window.toslices()]
+                for clave, indice in indices.items()
+            }
+            for nombre, src in fuentes.items():
+                vals = _lee(src, window, cache)
+                if cache is None and decodificadores[nombre] is not None:
+                    vals = decodificadores[nombre](vals)
+                if REGISTRO.activo:
+                    REGISTRO.cuenta(leidos=vals.nbytes)
+                validos = (vals != nodata) & ~np.isnan(vals)
+                for clave, ids in etiquetas.items():
+                    resultado[clave][nombre].agrega(
+                        ids, vals, validos & (ids != SIN_ZONA)
+                    )
+            if REGISTRO.activo:
+                REGISTRO.evento(
+                    "ventana", "zonal", inicio, time.perf_counter() - t0,
+                    ventana=f"{int(window.row_off)},{int(window.col_off)}",
+                )
+
+    return resultado